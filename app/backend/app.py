@@ -1,5 +1,4 @@
 import dataclasses
-import io
 import json
 import logging
 import mimetypes
@@ -7,7 +6,7 @@ import os
 import time
 from collections.abc import AsyncGenerator, Awaitable
 from pathlib import Path
-from typing import Any, Callable, Union, cast
+from typing import Any, Callable, Optional, Union, cast
 
 from azure.cognitiveservices.speech import (
     ResultReason,
@@ -34,15 +33,17 @@ from opentelemetry.instrumentation.openai import OpenAIInstrumentor
 from quart import (
     Blueprint,
     Quart,
+    Response,
     abort,
     current_app,
     jsonify,
     make_response,
     request,
-    send_file,
     send_from_directory,
 )
+from quart.json.provider import DefaultJSONProvider
 from quart_cors import cors
+from werkzeug.http import quote_etag, unquote_etag
 
 from approaches.approach import Approach
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
@@ -52,6 +53,7 @@ from chat_history.cosmosdb import chat_history_cosmosdb_bp
 from config import (
     CONFIG_AGENT_CLIENT,
     CONFIG_AGENTIC_RETRIEVAL_ENABLED,
+    CONFIG_ANSWER_CACHE,
     CONFIG_ASK_APPROACH,
     CONFIG_AUTH_CLIENT,
     CONFIG_CHAT_APPROACH,
@@ -59,11 +61,14 @@ from config import (
     CONFIG_CHAT_HISTORY_COSMOS_ENABLED,
     CONFIG_CREDENTIAL,
     CONFIG_DEFAULT_REASONING_EFFORT,
+    CONFIG_DEPENDENCY_CALLER,
     CONFIG_GLOBAL_BLOB_MANAGER,
     CONFIG_INGESTER,
+    CONFIG_INGESTION_QUEUE,
     CONFIG_LANGUAGE_PICKER_ENABLED,
     CONFIG_MULTIMODAL_ENABLED,
     CONFIG_OPENAI_CLIENT,
+    CONFIG_OPENAI_RATE_LIMITERS,
     CONFIG_QUERY_REWRITING_ENABLED,
     CONFIG_RAG_SEARCH_IMAGE_EMBEDDINGS,
     CONFIG_RAG_SEARCH_TEXT_EMBEDDINGS,
@@ -79,13 +84,19 @@ from config import (
     CONFIG_SPEECH_SERVICE_LOCATION,
     CONFIG_SPEECH_SERVICE_TOKEN,
     CONFIG_SPEECH_SERVICE_VOICE,
+    CONFIG_STREAM_COALESCE_SECONDS,
     CONFIG_STREAMING_ENABLED,
     CONFIG_USER_BLOB_MANAGER,
     CONFIG_USER_UPLOAD_ENABLED,
     CONFIG_VECTOR_SEARCH_ENABLED,
 )
+from core.answercache import SemanticAnswerCache
 from core.authentication import AuthenticationHelper
+from core.deadlines import DependencyCaller
+from core.embeddingcache import EmbeddingCache
+from core.ingestionqueue import JOB_SUCCEEDED, IngestionJob, IngestionQueue
 from core.sessionhelper import create_session_id
+from core.streaming import coalesce_delta_events, encode_delta_event
 from decorators import authenticated, authenticated_path
 from error import error_dict, error_response
 from prepdocs import (
@@ -95,12 +106,21 @@ from prepdocs import (
     setup_file_processors,
     setup_image_embeddings_service,
     setup_openai_client,
+    setup_openai_rate_limiters,
     setup_search_info,
 )
-from prepdocslib.blobmanager import AdlsBlobManager, BlobManager
+from prepdocslib.blobcache import BlobContentCache
+from prepdocslib.blobmanager import (
+    AdlsBlobManager,
+    BaseBlobManager,
+    BlobManager,
+    StorageCallCounter,
+    current_storage_calls,
+)
 from prepdocslib.embeddings import ImageEmbeddings
 from prepdocslib.filestrategy import UploadUserFileStrategy
 from prepdocslib.listfilestrategy import File
+from prepdocslib.openailoadbalancer import parse_openai_backends
 
 bp = Blueprint("routes", __name__, static_folder="static")
 # Fix Windows registry issue with mimetypes
@@ -130,6 +150,21 @@ async def assets(path):
     return await send_from_directory(Path(__file__).resolve().parent / "static" / "assets", path)
 
 
+@bp.before_app_request
+async def count_storage_calls():
+    current_storage_calls.set(StorageCallCounter())
+
+
+@bp.after_app_request
+async def log_storage_calls(response: Response):
+    # Content that's streamed after the response is returned, such as by /content, isn't counted
+    if (storage_calls := current_storage_calls.get()) is not None and storage_calls.calls > 0:
+        current_app.logger.debug(
+            "%s %s made %d calls to Azure Storage", request.method, request.path, storage_calls.calls
+        )
+    return response
+
+
 @bp.route("/content/<path>")
 @authenticated_path
 async def content_file(path: str, auth_claims: dict[str, Any]):
@@ -138,7 +173,8 @@ async def content_file(path: str, auth_claims: dict[str, Any]):
     *** NOTE *** if you are using app services authentication, this route will return unauthorized to all users that are not logged in
     if AZURE_ENFORCE_ACCESS_CONTROL is not set or false, logged in users can access all files regardless of access control
     if AZURE_ENFORCE_ACCESS_CONTROL is set to true, logged in users can only access files they have access to
-    This is also slow and memory hungry.
+    Files are streamed in chunks rather than loaded into memory, and range requests are supported,
+    so that PDF viewers can fetch only the pages they show. Conditional requests are answered from the ETag.
     """
     # Remove page number from path, filename-1.txt -> filename.txt
     # This shouldn't typically be necessary as browsers don't send hash fragments to servers
@@ -146,25 +182,21 @@ async def content_file(path: str, auth_claims: dict[str, Any]):
         path_parts = path.rsplit("#page=", 1)
         path = path_parts[0]
     current_app.logger.info("Opening file %s", path)
-    blob_manager: BlobManager = current_app.config[CONFIG_GLOBAL_BLOB_MANAGER]
+    blob_manager: BaseBlobManager = current_app.config[CONFIG_GLOBAL_BLOB_MANAGER]
+    user_oid = None
 
-    # Get bytes and properties from the blob manager
-    result = await blob_manager.download_blob(path)
+    # Get the properties from the blob manager, the content is only downloaded once the response is sent
+    properties = await blob_manager.get_blob_properties(path)
 
-    if result is None:
+    if properties is None:
         current_app.logger.info("Path not found in general Blob container: %s", path)
         if current_app.config[CONFIG_USER_UPLOAD_ENABLED]:
             user_oid = auth_claims["oid"]
-            user_blob_manager: AdlsBlobManager = current_app.config[CONFIG_USER_BLOB_MANAGER]
-            result = await user_blob_manager.download_blob(path, user_oid=user_oid)
-            if result is None:
+            blob_manager = current_app.config[CONFIG_USER_BLOB_MANAGER]
+            properties = await blob_manager.get_blob_properties(path, user_oid=user_oid)
+            if properties is None:
                 current_app.logger.exception("Path not found in DataLake: %s", path)
 
-    if not result:
-        abort(404)
-
-    content, properties = result
-
     if not properties or "content_settings" not in properties:
         abort(404)
 
@@ -172,9 +204,34 @@ async def content_file(path: str, auth_claims: dict[str, Any]):
     if mime_type == "application/octet-stream":
         mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
 
-    # Create a BytesIO object from the bytes
-    blob_file = io.BytesIO(content)
-    return await send_file(blob_file, mimetype=mime_type, as_attachment=False, attachment_filename=path)
+    size = properties.get("size", 0)
+    etag = properties.get("etag")
+    unquoted_etag = unquote_etag(etag)[0] if etag else None
+    headers = {"Accept-Ranges": "bytes"}
+    if unquoted_etag:
+        headers["ETag"] = quote_etag(unquoted_etag)
+        if request.if_none_match.contains_weak(unquoted_etag):
+            return Response("", status=304, headers=headers)
+
+    start, stop = 0, size
+    status = 200
+    # A range is only served when If-Range, if sent, names the current version of the file
+    if_range = request.if_range
+    if request.range and (
+        (if_range.etag is None and if_range.date is None) or (unquoted_etag and if_range.etag == unquoted_etag)
+    ):
+        byte_range = request.range.range_for_length(size)
+        if byte_range is not None:
+            start, stop = byte_range
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+        elif len(request.range.ranges) == 1:
+            return Response("", status=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        # Multiple ranges aren't supported, so the whole file is sent instead
+
+    headers["Content-Length"] = str(stop - start)
+    body = blob_manager.stream_blob(path, start, stop - start, etag=etag, user_oid=user_oid, size=size)
+    return Response(body, status=status, mimetype=mime_type, headers=headers)
 
 
 @bp.route("/ask", methods=["POST"])
@@ -197,15 +254,37 @@ async def ask(auth_claims: dict[str, Any]):
 
 class JSONEncoder(json.JSONEncoder):
     def default(self, o):
+        # Response models serialize their own fields, without the deep copy made by dataclasses.asdict
+        if hasattr(o, "to_json_dict"):
+            return o.to_json_dict()
         if dataclasses.is_dataclass(o) and not isinstance(o, type):
             return dataclasses.asdict(o)
         return super().default(o)
 
 
-async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[str, None]:
+class JSONProvider(DefaultJSONProvider):
+    """
+    Serializes the response models returned by jsonify the same way as the JSONEncoder used for streamed responses.
+    """
+
+    @staticmethod
+    def default(o: Any) -> Any:
+        if hasattr(o, "to_json_dict"):
+            return o.to_json_dict()
+        return DefaultJSONProvider.default(o)
+
+
+# Merged answer tokens are sent once they reach this many characters, even if the coalescing delay hasn't passed
+STREAM_COALESCE_MAX_CHARS = 256
+
+
+async def format_as_ndjson(
+    r: AsyncGenerator[dict, None], coalesce_seconds: float = 0, coalesce_max_chars: int = STREAM_COALESCE_MAX_CHARS
+) -> AsyncGenerator[str, None]:
     try:
-        async for event in r:
-            yield json.dumps(event, ensure_ascii=False, cls=JSONEncoder) + "\n"
+        events = coalesce_delta_events(r, coalesce_seconds, coalesce_max_chars) if coalesce_seconds > 0 else r
+        async for event in events:
+            yield encode_delta_event(event) or json.dumps(event, ensure_ascii=False, cls=JSONEncoder) + "\n"
     except Exception as error:
         logging.exception("Exception while generating response stream: %s", error)
         yield json.dumps(error_dict(error))
@@ -264,7 +343,9 @@ async def chat_stream(auth_claims: dict[str, Any]):
             context=context,
             session_state=session_state,
         )
-        response = await make_response(format_as_ndjson(result))
+        response = await make_response(
+            format_as_ndjson(result, coalesce_seconds=current_app.config[CONFIG_STREAM_COALESCE_SECONDS])
+        )
         response.timeout = None  # type: ignore
         response.mimetype = "application/json-lines"
         return response
@@ -350,6 +431,13 @@ async def speech():
         return jsonify({"error": str(e)}), 500
 
 
+def invalidate_answer_cache():
+    # Cached answers may cite documents that were removed, or miss ones that were added
+    answer_cache: Optional[SemanticAnswerCache] = current_app.config.get(CONFIG_ANSWER_CACHE)
+    if answer_cache:
+        answer_cache.invalidate()
+
+
 @bp.post("/upload")
 @authenticated
 async def upload(auth_claims: dict[str, Any]):
@@ -362,14 +450,33 @@ async def upload(auth_claims: dict[str, Any]):
         file = request_files.getlist("file")[0]
         adls_manager: AdlsBlobManager = current_app.config[CONFIG_USER_BLOB_MANAGER]
         file_url = await adls_manager.upload_blob(file, file.filename, user_oid)
+        ingestion_queue: Optional[IngestionQueue] = current_app.config.get(CONFIG_INGESTION_QUEUE)
+        if ingestion_queue:
+            job = await ingestion_queue.submit(user_oid, file.filename, file_url)
+            return jsonify({"message": "File uploaded, ingestion has started", "job_id": job.id}), 202
         ingester: UploadUserFileStrategy = current_app.config[CONFIG_INGESTER]
         await ingester.add_file(File(content=file, url=file_url, acls={"oids": [user_oid]}), user_oid=user_oid)
+        invalidate_answer_cache()
         return jsonify({"message": "File uploaded successfully"}), 200
     except Exception as error:
         current_app.logger.error("Error uploading file: %s", error)
         return jsonify({"message": "Error uploading file, check server logs for details.", "status": "failed"}), 500
 
 
+@bp.get("/upload_status/<job_id>")
+@authenticated
+async def upload_status(auth_claims: dict[str, Any], job_id: str):
+    ingestion_queue: Optional[IngestionQueue] = current_app.config.get(CONFIG_INGESTION_QUEUE)
+    job = await ingestion_queue.get_job(job_id, auth_claims["oid"]) if ingestion_queue else None
+    if job is None:
+        return jsonify({"message": "Upload job not found", "status": "failed"}), 404
+    status = job.to_dict()
+    del status["user_oid"]
+    if job.error:
+        status["error"] = "Error ingesting file, check server logs for details."
+    return jsonify(status), 200
+
+
 @bp.post("/delete_uploaded")
 @authenticated
 async def delete_uploaded(auth_claims: dict[str, Any]):
@@ -380,6 +487,7 @@ async def delete_uploaded(auth_claims: dict[str, Any]):
     await adls_manager.remove_blob(filename, user_oid)
     ingester: UploadUserFileStrategy = current_app.config[CONFIG_INGESTER]
     await ingester.remove_file(filename, user_oid)
+    invalidate_answer_cache()
     return jsonify({"message": f"File {filename} deleted successfully"}), 200
 
 
@@ -410,10 +518,18 @@ async def setup_clients():
     # Shared by all OpenAI deployments
     OPENAI_HOST = OpenAIHost(os.getenv("OPENAI_HOST", "azure"))
     OPENAI_CHATGPT_MODEL = os.environ["AZURE_OPENAI_CHATGPT_MODEL"]
+    # Maximum number of tokens in the answer prompt, defaults to what the chat model accepts less its response tokens
+    OPENAI_CHATGPT_PROMPT_TOKEN_BUDGET = (
+        int(os.environ["AZURE_OPENAI_CHATGPT_PROMPT_TOKEN_BUDGET"])
+        if os.getenv("AZURE_OPENAI_CHATGPT_PROMPT_TOKEN_BUDGET")
+        else None
+    )
     AZURE_OPENAI_SEARCHAGENT_MODEL = os.getenv("AZURE_OPENAI_SEARCHAGENT_MODEL")
     AZURE_OPENAI_SEARCHAGENT_DEPLOYMENT = os.getenv("AZURE_OPENAI_SEARCHAGENT_DEPLOYMENT")
     OPENAI_EMB_MODEL = os.getenv("AZURE_OPENAI_EMB_MODEL_NAME", "text-embedding-ada-002")
     OPENAI_EMB_DIMENSIONS = int(os.getenv("AZURE_OPENAI_EMB_DIMENSIONS") or 1536)
+    # Number of query embeddings kept in memory, set to 0 to disable caching them
+    AZURE_OPENAI_EMB_CACHE_SIZE = int(os.getenv("AZURE_OPENAI_EMB_CACHE_SIZE") or EmbeddingCache.DEFAULT_MAX_SIZE)
     OPENAI_REASONING_EFFORT = os.getenv("AZURE_OPENAI_REASONING_EFFORT")
     # Used with Azure OpenAI deployments
     AZURE_OPENAI_SERVICE = os.getenv("AZURE_OPENAI_SERVICE")
@@ -422,10 +538,24 @@ async def setup_clients():
         if OPENAI_HOST in [OpenAIHost.AZURE, OpenAIHost.AZURE_CUSTOM]
         else None
     )
+    # Deployment of the same model that hedged chat completions are requested from, when hedging is enabled
+    AZURE_OPENAI_CHATGPT_BACKUP_DEPLOYMENT = (
+        os.getenv("AZURE_OPENAI_CHATGPT_BACKUP_DEPLOYMENT")
+        if OPENAI_HOST in [OpenAIHost.AZURE, OpenAIHost.AZURE_CUSTOM]
+        else None
+    )
     AZURE_OPENAI_EMB_DEPLOYMENT = (
         os.getenv("AZURE_OPENAI_EMB_DEPLOYMENT") if OPENAI_HOST in [OpenAIHost.AZURE, OpenAIHost.AZURE_CUSTOM] else None
     )
     AZURE_OPENAI_CUSTOM_URL = os.getenv("AZURE_OPENAI_CUSTOM_URL")
+    # Other Azure OpenAI endpoints that chat and embedding calls are spread across, as a JSON list
+    AZURE_OPENAI_BACKENDS = parse_openai_backends(os.getenv("AZURE_OPENAI_BACKENDS"))
+    # Queues calls to the chat and embedding deployments so they stay within the deployments' capacity,
+    # in thousands of tokens per minute
+    USE_OPENAI_RATE_LIMITER = os.getenv("USE_OPENAI_RATE_LIMITER", "").lower() == "true"
+    AZURE_OPENAI_CHATGPT_DEPLOYMENT_CAPACITY = int(os.getenv("AZURE_OPENAI_CHATGPT_DEPLOYMENT_CAPACITY") or 30)
+    AZURE_OPENAI_EMB_DEPLOYMENT_CAPACITY = int(os.getenv("AZURE_OPENAI_EMB_DEPLOYMENT_CAPACITY") or 30)
+    OPENAI_RATE_LIMITER_PROCESSES = int(os.getenv("OPENAI_RATE_LIMITER_PROCESSES") or 1)
     # https://learn.microsoft.com/azure/ai-services/openai/api-version-deprecation#latest-ga-api-release
     AZURE_OPENAI_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION") or "2024-10-21"
     AZURE_VISION_ENDPOINT = os.getenv("AZURE_VISION_ENDPOINT", "")
@@ -443,6 +573,8 @@ async def setup_clients():
     AZURE_SERVER_APP_SECRET = os.getenv("AZURE_SERVER_APP_SECRET")
     AZURE_CLIENT_APP_ID = os.getenv("AZURE_CLIENT_APP_ID")
     AZURE_AUTH_TENANT_ID = os.getenv("AZURE_AUTH_TENANT_ID", AZURE_TENANT_ID)
+    # How long a user's Microsoft Graph group memberships are reused before they are listed again
+    AZURE_AUTH_GROUPS_CACHE_TTL_SECONDS = float(os.getenv("AZURE_AUTH_GROUPS_CACHE_TTL_SECONDS") or 300)
 
     KB_FIELDS_CONTENT = os.getenv("KB_FIELDS_CONTENT", "content")
     KB_FIELDS_SOURCEPAGE = os.getenv("KB_FIELDS_SOURCEPAGE", "sourcepage")
@@ -471,6 +603,29 @@ async def setup_clients():
     USE_CHAT_HISTORY_BROWSER = os.getenv("USE_CHAT_HISTORY_BROWSER", "").lower() == "true"
     USE_CHAT_HISTORY_COSMOS = os.getenv("USE_CHAT_HISTORY_COSMOS", "").lower() == "true"
     USE_AGENTIC_RETRIEVAL = os.getenv("USE_AGENTIC_RETRIEVAL", "").lower() == "true"
+    USE_SEMANTIC_ANSWER_CACHE = os.getenv("USE_SEMANTIC_ANSWER_CACHE", "").lower() == "true"
+    SEMANTIC_ANSWER_CACHE_THRESHOLD = float(
+        os.getenv("SEMANTIC_ANSWER_CACHE_THRESHOLD") or SemanticAnswerCache.DEFAULT_SIMILARITY_THRESHOLD
+    )
+    SEMANTIC_ANSWER_CACHE_TTL_SECONDS = float(
+        os.getenv("SEMANTIC_ANSWER_CACHE_TTL_SECONDS") or SemanticAnswerCache.DEFAULT_TTL_SECONDS
+    )
+    # Seconds that a request's calls to Azure AI Search and OpenAI must finish within, unset for no deadline
+    REQUEST_TIMEOUT_SECONDS = (
+        float(os.environ["REQUEST_TIMEOUT_SECONDS"]) if os.getenv("REQUEST_TIMEOUT_SECONDS") else None
+    )
+    # Sends a second request for calls slower than their recent p95 latency, using whichever finishes first
+    USE_HEDGED_REQUESTS = os.getenv("USE_HEDGED_REQUESTS", "").lower() == "true"
+    # Merges the answer tokens streamed within this many milliseconds into one event, 0 sends every token as it arrives
+    STREAM_COALESCE_MS = float(os.getenv("STREAM_COALESCE_MS") or 0)
+    # Keeps the content of the files served by /content on local disk, up to CONTENT_CACHE_MAX_SIZE_MB
+    CONTENT_CACHE_DIRECTORY = os.getenv("CONTENT_CACHE_DIRECTORY")
+    CONTENT_CACHE_MAX_SIZE_MB = int(os.getenv("CONTENT_CACHE_MAX_SIZE_MB") or 1024)
+    # Ingests uploaded files in the background, with this many files ingested at once
+    USE_USER_UPLOAD_QUEUE = os.getenv("USE_USER_UPLOAD_QUEUE", "").lower() == "true"
+    USER_UPLOAD_QUEUE_CONCURRENCY = int(os.getenv("USER_UPLOAD_QUEUE_CONCURRENCY") or 2)
+    # Set by the Gunicorn worker class, and not set when the app runs in a single process without Gunicorn
+    GUNICORN_WORKERS = int(os.getenv("GUNICORN_WORKERS") or 1)
 
     # WEBSITE_HOSTNAME is always set by App Service, RUNNING_IN_PRODUCTION is set in main.bicep
     RUNNING_ON_AZURE = os.getenv("WEBSITE_HOSTNAME") is not None or os.getenv("RUNNING_IN_PRODUCTION") is not None
@@ -517,12 +672,20 @@ async def setup_clients():
         endpoint=AZURE_SEARCH_ENDPOINT, agent_name=AZURE_SEARCH_AGENT, credential=azure_credential
     )
 
+    content_cache = None
+    if CONTENT_CACHE_DIRECTORY:
+        current_app.logger.info("CONTENT_CACHE_DIRECTORY is set, caching content files in %s", CONTENT_CACHE_DIRECTORY)
+        content_cache = BlobContentCache(
+            CONTENT_CACHE_DIRECTORY, max_size_bytes=CONTENT_CACHE_MAX_SIZE_MB * 1024 * 1024
+        )
+
     # Set up the global blob storage manager (used for global content/images, but not user uploads)
     global_blob_manager = BlobManager(
         endpoint=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net",
         credential=azure_credential,
         container=AZURE_STORAGE_CONTAINER,
         image_container=AZURE_IMAGESTORAGE_CONTAINER,
+        content_cache=content_cache,
     )
     current_app.config[CONFIG_GLOBAL_BLOB_MANAGER] = global_blob_manager
 
@@ -546,6 +709,7 @@ async def setup_clients():
         require_access_control=AZURE_ENFORCE_ACCESS_CONTROL,
         enable_global_documents=AZURE_ENABLE_GLOBAL_DOCUMENT_ACCESS,
         enable_unauthenticated_access=AZURE_ENABLE_UNAUTHENTICATED_ACCESS,
+        groups_cache_ttl_seconds=AZURE_AUTH_GROUPS_CACHE_TTL_SECONDS,
     )
 
     if USE_SPEECH_OUTPUT_AZURE:
@@ -560,6 +724,18 @@ async def setup_clients():
         # Wait until token is needed to fetch for the first time
         current_app.config[CONFIG_SPEECH_SERVICE_TOKEN] = None
 
+    openai_rate_limiters = None
+    if USE_OPENAI_RATE_LIMITER:
+        current_app.logger.info("USE_OPENAI_RATE_LIMITER is true, queueing calls to stay within deployment capacity")
+        openai_rate_limiters = setup_openai_rate_limiters(
+            chatgpt_deployment=AZURE_OPENAI_CHATGPT_DEPLOYMENT or OPENAI_CHATGPT_MODEL,
+            chatgpt_deployment_capacity=AZURE_OPENAI_CHATGPT_DEPLOYMENT_CAPACITY,
+            emb_deployment=AZURE_OPENAI_EMB_DEPLOYMENT or OPENAI_EMB_MODEL,
+            emb_deployment_capacity=AZURE_OPENAI_EMB_DEPLOYMENT_CAPACITY,
+            processes=OPENAI_RATE_LIMITER_PROCESSES,
+        )
+    current_app.config[CONFIG_OPENAI_RATE_LIMITERS] = openai_rate_limiters
+
     openai_client = setup_openai_client(
         openai_host=OPENAI_HOST,
         azure_credential=azure_credential,
@@ -569,6 +745,8 @@ async def setup_clients():
         azure_openai_api_key=AZURE_OPENAI_API_KEY_OVERRIDE,
         openai_api_key=OPENAI_API_KEY,
         openai_organization=OPENAI_ORGANIZATION,
+        azure_openai_backends=AZURE_OPENAI_BACKENDS,
+        openai_rate_limiters=openai_rate_limiters,
     )
 
     user_blob_manager = None
@@ -582,6 +760,7 @@ async def setup_clients():
             endpoint=f"https://{AZURE_USERSTORAGE_ACCOUNT}.dfs.core.windows.net",
             container=AZURE_USERSTORAGE_CONTAINER,
             credential=azure_credential,
+            content_cache=content_cache,
         )
         current_app.config[CONFIG_USER_BLOB_MANAGER] = user_blob_manager
 
@@ -614,6 +793,8 @@ async def setup_clients():
             openai_key=clean_key_if_exists(OPENAI_API_KEY),
             openai_org=OPENAI_ORGANIZATION,
             disable_vectors=os.getenv("USE_VECTORS", "").lower() == "false",
+            azure_openai_backends=AZURE_OPENAI_BACKENDS,
+            openai_rate_limiters=openai_rate_limiters,
         )
         image_embeddings_service = setup_image_embeddings_service(
             azure_credential=azure_credential,
@@ -649,6 +830,7 @@ async def setup_clients():
         OPENAI_CHATGPT_MODEL not in Approach.GPT_REASONING_MODELS
         or Approach.GPT_REASONING_MODELS[OPENAI_CHATGPT_MODEL].streaming
     )
+    current_app.config[CONFIG_STREAM_COALESCE_SECONDS] = STREAM_COALESCE_MS / 1000
     current_app.config[CONFIG_VECTOR_SEARCH_ENABLED] = os.getenv("USE_VECTORS", "").lower() != "false"
     current_app.config[CONFIG_USER_UPLOAD_ENABLED] = bool(USE_USER_UPLOAD)
     current_app.config[CONFIG_LANGUAGE_PICKER_ENABLED] = ENABLE_LANGUAGE_PICKER
@@ -666,6 +848,44 @@ async def setup_clients():
 
     prompt_manager = PromptyManager()
 
+    # Query embeddings are shared by both approaches, as /ask and /chat see many of the same questions
+    embedding_cache = EmbeddingCache(max_size=AZURE_OPENAI_EMB_CACHE_SIZE) if AZURE_OPENAI_EMB_CACHE_SIZE > 0 else None
+    answer_cache = None
+    if USE_SEMANTIC_ANSWER_CACHE:
+        current_app.logger.info("USE_SEMANTIC_ANSWER_CACHE is true, caching answers to similar questions")
+        answer_cache = SemanticAnswerCache(
+            similarity_threshold=SEMANTIC_ANSWER_CACHE_THRESHOLD, ttl_seconds=SEMANTIC_ANSWER_CACHE_TTL_SECONDS
+        )
+    current_app.config[CONFIG_ANSWER_CACHE] = answer_cache
+
+    if USE_USER_UPLOAD and USE_USER_UPLOAD_QUEUE:
+        if GUNICORN_WORKERS > 1:
+            # Jobs are kept in the memory of the worker that queued them, so other workers couldn't report their status
+            raise ValueError(
+                f"USE_USER_UPLOAD_QUEUE requires a single Gunicorn worker, but {GUNICORN_WORKERS} are configured. "
+                "Set GUNICORN_CMD_ARGS to '--workers 1 --max-requests 0', or turn off USE_USER_UPLOAD_QUEUE"
+            )
+        current_app.logger.info("USE_USER_UPLOAD_QUEUE is true, ingesting uploaded files in the background")
+
+        def on_ingestion_job_finished(job: IngestionJob):
+            # Cached answers may miss the documents that were added
+            if answer_cache and job.status == JOB_SUCCEEDED:
+                answer_cache.invalidate()
+
+        ingestion_queue = IngestionQueue(
+            process=lambda job, start_stage: ingester.add_uploaded_file(
+                job.filename, job.file_url, job.user_oid, start_stage
+            ),
+            concurrency=USER_UPLOAD_QUEUE_CONCURRENCY,
+            on_job_finished=on_ingestion_job_finished,
+        )
+        ingestion_queue.start()
+        current_app.config[CONFIG_INGESTION_QUEUE] = ingestion_queue
+
+    # Shared by both approaches, so the latencies that hedging is based on and the timeout counts cover all requests
+    dependency_caller = DependencyCaller(request_timeout_seconds=REQUEST_TIMEOUT_SECONDS, hedge=USE_HEDGED_REQUESTS)
+    current_app.config[CONFIG_DEPENDENCY_CALLER] = dependency_caller
+
     # Set up the two default RAG approaches for /ask and /chat
     # RetrieveThenReadApproach is used by /ask for single-turn Q&A
 
@@ -693,6 +913,11 @@ async def setup_clients():
         image_embeddings_client=image_embeddings_client,
         global_blob_manager=global_blob_manager,
         user_blob_manager=user_blob_manager,
+        embedding_cache=embedding_cache,
+        answer_cache=answer_cache,
+        prompt_token_budget=OPENAI_CHATGPT_PROMPT_TOKEN_BUDGET,
+        dependency_caller=dependency_caller,
+        chatgpt_backup_deployment=AZURE_OPENAI_CHATGPT_BACKUP_DEPLOYMENT,
     )
 
     # ChatReadRetrieveReadApproach is used by /chat for multi-turn conversation
@@ -720,11 +945,19 @@ async def setup_clients():
         image_embeddings_client=image_embeddings_client,
         global_blob_manager=global_blob_manager,
         user_blob_manager=user_blob_manager,
+        embedding_cache=embedding_cache,
+        answer_cache=answer_cache,
+        prompt_token_budget=OPENAI_CHATGPT_PROMPT_TOKEN_BUDGET,
+        dependency_caller=dependency_caller,
+        chatgpt_backup_deployment=AZURE_OPENAI_CHATGPT_BACKUP_DEPLOYMENT,
     )
 
 
 @bp.after_app_serving
 async def close_clients():
+    # Ingestion workers are stopped first, as they use the other clients
+    if ingestion_queue := current_app.config.get(CONFIG_INGESTION_QUEUE):
+        await ingestion_queue.close()
     await current_app.config[CONFIG_SEARCH_CLIENT].close()
     await current_app.config[CONFIG_GLOBAL_BLOB_MANAGER].close_clients()
     if user_blob_manager := current_app.config.get(CONFIG_USER_BLOB_MANAGER):
@@ -733,6 +966,7 @@ async def close_clients():
 
 def create_app():
     app = Quart(__name__)
+    app.json = JSONProvider(app)
     app.register_blueprint(bp)
     app.register_blueprint(chat_history_cosmosdb_bp)
 
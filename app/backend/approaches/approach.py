@@ -1,8 +1,13 @@
+import asyncio
 import base64
+import hashlib
+import json
+import sys
+import time
 from abc import ABC
-from collections.abc import AsyncGenerator, Awaitable
+from collections.abc import AsyncGenerator, AsyncIterator, Awaitable
 from dataclasses import dataclass, field
-from typing import Any, Optional, TypedDict, Union, cast
+from typing import Any, Callable, Optional, TypedDict, TypeVar, Union, cast
 
 from azure.search.documents.agent.aio import KnowledgeAgentRetrievalClient
 from azure.search.documents.agent.models import (
@@ -30,14 +35,34 @@ from openai.types.chat import (
     ChatCompletionReasoningEffort,
     ChatCompletionToolParam,
 )
+from typing_extensions import dataclass_transform
 
+from approaches.contextpacker import ContextPacker, PackedContext, RenderPrompt
 from approaches.promptmanager import PromptManager
+from core.answercache import AnswerCacheKey, SemanticAnswerCache
 from core.authentication import AuthenticationHelper
-from prepdocslib.blobmanager import AdlsBlobManager, BlobManager
+from core.cache import LRUCache, SingleFlight
+from core.deadlines import DependencyCaller
+from core.embeddingcache import EmbeddingCache
+from core.reranker import BM25Reranker
+from prepdocslib.blobmanager import AdlsBlobManager, BaseBlobManager, BlobManager
 from prepdocslib.embeddings import ImageEmbeddings
 
+T = TypeVar("T")
 
-@dataclass
+
+@dataclass_transform()
+def slotted_dataclass(cls: type[T]) -> type[T]:
+    """
+    Makes a dataclass with __slots__, so that the many instances created for each response are smaller and faster
+    to access. Slots are only supported by dataclasses from Python 3.10.
+    """
+    if sys.version_info >= (3, 10):
+        return dataclass(slots=True)(cls)
+    return dataclass(cls)
+
+
+@slotted_dataclass
 class Document:
     id: Optional[str] = None
     content: Optional[str] = None
@@ -80,8 +105,15 @@ class Document:
         }
         return result_dict
 
+    def to_json_dict(self) -> dict[str, Any]:
+        return self.serialize_for_results()
 
-@dataclass
+
+# The to_json_dict methods below return their fields without copying them, leaving any nested models
+# to the JSON encoder, unlike dataclasses.asdict which deep copies every prompt message and search result
+
+
+@slotted_dataclass
 class ThoughtStep:
     title: str
     description: Optional[Any]
@@ -91,28 +123,49 @@ class ThoughtStep:
         if self.props:
             self.props["token_usage"] = TokenUsageProps.from_completion_usage(usage)
 
+    def to_json_dict(self) -> dict[str, Any]:
+        return {"title": self.title, "description": self.description, "props": self.props}
 
-@dataclass
+
+@slotted_dataclass
 class DataPoints:
     text: Optional[list[str]] = None
     images: Optional[list] = None
     citations: Optional[list[str]] = None
 
+    def to_json_dict(self) -> dict[str, Any]:
+        return {"text": self.text, "images": self.images, "citations": self.citations}
 
-@dataclass
+
+@slotted_dataclass
 class ExtraInfo:
     data_points: DataPoints
     thoughts: list[ThoughtStep] = field(default_factory=list)
     followup_questions: Optional[list[Any]] = None
 
+    def to_json_dict(self) -> dict[str, Any]:
+        return {
+            "data_points": self.data_points,
+            "thoughts": self.thoughts,
+            "followup_questions": self.followup_questions,
+        }
 
-@dataclass
+
+@slotted_dataclass
 class TokenUsageProps:
     prompt_tokens: int
     completion_tokens: int
     reasoning_tokens: Optional[int]
     total_tokens: int
 
+    def to_json_dict(self) -> dict[str, Any]:
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "reasoning_tokens": self.reasoning_tokens,
+            "total_tokens": self.total_tokens,
+        }
+
     @classmethod
     def from_completion_usage(cls, usage: CompletionUsage) -> "TokenUsageProps":
         return cls(
@@ -125,6 +178,26 @@ class TokenUsageProps:
         )
 
 
+class StageTimer:
+    """
+    Records how long each stage of a request takes, in milliseconds, for reporting in the thought process.
+    Stages that run concurrently are timed independently.
+    """
+
+    def __init__(self):
+        self.timings: dict[str, float] = {}
+
+    async def measure(self, stage: str, awaitable: Awaitable[T]) -> T:
+        start = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.timings[stage] = round((time.perf_counter() - start) * 1000, 1)
+
+    def to_thought_step(self, title: str) -> ThoughtStep:
+        return ThoughtStep(title, None, {f"{stage}_ms": elapsed for stage, elapsed in self.timings.items()})
+
+
 # GPT reasoning models don't support the same set of parameters as other models
 # https://learn.microsoft.com/azure/ai-services/openai/how-to/reasoning
 @dataclass
@@ -134,6 +207,12 @@ class GPTReasoningModelSupport:
 
 
 class Approach(ABC):
+    # The Azure AI Vision model that ImageEmbeddings vectorizes text with, used to key cached multimodal embeddings
+    MULTIMODAL_EMBEDDING_MODEL = "azure-ai-vision-2023-04-15"
+    # Maximum number of images downloaded at once for a single answer
+    MAX_CONCURRENT_IMAGE_DOWNLOADS = 4
+    # Maximum number of images kept in memory as base64 data URIs, along with the ETag they were downloaded at
+    IMAGE_CACHE_SIZE = 128
     # List of GPT reasoning models support
     GPT_REASONING_MODELS = {
         "o1": GPTReasoningModelSupport(streaming=False, minimal_effort=False),
@@ -166,6 +245,11 @@ class Approach(ABC):
         image_embeddings_client: Optional[ImageEmbeddings] = None,
         global_blob_manager: Optional[BlobManager] = None,
         user_blob_manager: Optional[AdlsBlobManager] = None,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        answer_cache: Optional[SemanticAnswerCache] = None,
+        prompt_token_budget: Optional[int] = None,
+        dependency_caller: Optional[DependencyCaller] = None,
+        chatgpt_backup_deployment: Optional[str] = None,
     ):
         self.search_client = search_client
         self.openai_client = openai_client
@@ -184,6 +268,21 @@ class Approach(ABC):
         self.image_embeddings_client = image_embeddings_client
         self.global_blob_manager = global_blob_manager
         self.user_blob_manager = user_blob_manager
+        self.embedding_cache = embedding_cache
+        self.answer_cache = answer_cache
+        self.image_cache: LRUCache[str, tuple[str, str]] = LRUCache(max_size=self.IMAGE_CACHE_SIZE)
+        self.prompt_token_budget = prompt_token_budget
+        self.dependency_caller = dependency_caller or DependencyCaller()
+        self.chatgpt_backup_deployment = chatgpt_backup_deployment
+        self.request_coalescer: SingleFlight[str, dict[str, Any]] = SingleFlight()
+        self.local_reranker = BM25Reranker()
+
+    @property
+    def coalesced_requests(self) -> int:
+        """
+        The number of requests answered by joining an identical request that was already being answered.
+        """
+        return self.request_coalescer.shared_calls
 
     def build_filter(self, overrides: dict[str, Any], auth_claims: dict[str, Any]) -> Optional[str]:
         include_category = overrides.get("include_category")
@@ -212,59 +311,111 @@ class Approach(ABC):
         minimum_reranker_score: Optional[float] = None,
         use_query_rewriting: Optional[bool] = None,
     ) -> list[Document]:
+        return [
+            document
+            async for document in self.search_documents(
+                top,
+                query_text,
+                filter,
+                vectors,
+                use_text_search,
+                use_vector_search,
+                use_semantic_ranker,
+                use_semantic_captions,
+                minimum_search_score,
+                minimum_reranker_score,
+                use_query_rewriting,
+            )
+        ]
+
+    def rerank_documents(self, query_text: str, documents: list[Document], top: int) -> list[Document]:
+        """
+        Keeps the top documents of those fetched for the local reranker, from best to worst.
+        """
+        order = self.local_reranker.rank(query_text, [document.content or "" for document in documents])
+        return [documents[index] for index in order[:top]]
+
+    async def search_documents(
+        self,
+        top: int,
+        query_text: Optional[str],
+        filter: Optional[str],
+        vectors: list[VectorQuery],
+        use_text_search: bool,
+        use_vector_search: bool,
+        use_semantic_ranker: bool,
+        use_semantic_captions: bool,
+        minimum_search_score: Optional[float] = None,
+        minimum_reranker_score: Optional[float] = None,
+        use_query_rewriting: Optional[bool] = None,
+    ) -> AsyncGenerator[Document, None]:
+        """
+        Yields the documents that meet the minimum scores as the search results pages arrive,
+        and stops requesting pages once top documents have been yielded.
+        """
         search_text = query_text if use_text_search else ""
         search_vectors = vectors if use_vector_search else []
-        if use_semantic_ranker:
-            results = await self.search_client.search(
-                search_text=search_text,
-                filter=filter,
-                top=top,
-                query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                query_rewrites="generative" if use_query_rewriting else None,
-                vector_queries=search_vectors,
-                query_type=QueryType.SEMANTIC,
-                query_language=self.query_language,
-                query_speller=self.query_speller,
-                semantic_configuration_name="default",
-                semantic_query=query_text,
-            )
-        else:
-            results = await self.search_client.search(
-                search_text=search_text,
-                filter=filter,
-                top=top,
-                vector_queries=search_vectors,
-            )
 
-        documents: list[Document] = []
-        async for page in results.by_page():
-            async for document in page:
-                documents.append(
-                    Document(
-                        id=document.get("id"),
-                        content=document.get("content"),
-                        category=document.get("category"),
-                        sourcepage=document.get("sourcepage"),
-                        sourcefile=document.get("sourcefile"),
-                        oids=document.get("oids"),
-                        groups=document.get("groups"),
-                        captions=cast(list[QueryCaptionResult], document.get("@search.captions")),
-                        score=document.get("@search.score"),
-                        reranker_score=document.get("@search.reranker_score"),
-                        images=document.get("images"),
-                    )
+        async def fetch_first_page() -> (
+            tuple[AsyncIterator[AsyncIterator[dict[str, Any]]], Optional[AsyncIterator[dict[str, Any]]]]
+        ):
+            # Results are requested lazily, so the call to the search service is made by fetching the first page
+            if use_semantic_ranker:
+                results = await self.search_client.search(
+                    search_text=search_text,
+                    filter=filter,
+                    top=top,
+                    query_caption="extractive|highlight-false" if use_semantic_captions else None,
+                    query_rewrites="generative" if use_query_rewriting else None,
+                    vector_queries=search_vectors,
+                    query_type=QueryType.SEMANTIC,
+                    query_language=self.query_language,
+                    query_speller=self.query_speller,
+                    semantic_configuration_name="default",
+                    semantic_query=query_text,
                 )
-
-            qualified_documents = [
-                doc
-                for doc in documents
-                if (
-                    (doc.score or 0) >= (minimum_search_score or 0)
-                    and (doc.reranker_score or 0) >= (minimum_reranker_score or 0)
+            else:
+                results = await self.search_client.search(
+                    search_text=search_text,
+                    filter=filter,
+                    top=top,
+                    vector_queries=search_vectors,
                 )
-            ]
-
-        return qualified_documents
+            pages = results.by_page()
+            try:
+                return pages, await pages.__anext__()
+            except StopAsyncIteration:
+                return pages, None
+
+        # A hedged search sends the same query again, which the service may route to another replica
+        pages, page = await self.dependency_caller.call("search", fetch_first_page, fetch_first_page)
+        qualified_count = 0
+        while page is not None:
+            async for document in page:
+                score = document.get("@search.score")
+                reranker_score = document.get("@search.reranker_score")
+                if (score or 0) < (minimum_search_score or 0) or (reranker_score or 0) < (minimum_reranker_score or 0):
+                    continue
+                yield Document(
+                    id=document.get("id"),
+                    content=document.get("content"),
+                    category=document.get("category"),
+                    sourcepage=document.get("sourcepage"),
+                    sourcefile=document.get("sourcefile"),
+                    oids=document.get("oids"),
+                    groups=document.get("groups"),
+                    captions=cast(list[QueryCaptionResult], document.get("@search.captions")),
+                    score=score,
+                    reranker_score=reranker_score,
+                    images=document.get("images"),
+                )
+                qualified_count += 1
+                if qualified_count >= top:
+                    return
+            try:
+                page = await pages.__anext__()
+            except StopAsyncIteration:
+                page = None
 
     async def run_agentic_retrieval(
         self,
@@ -379,7 +530,7 @@ class Approach(ABC):
 
         citations = []
         text_sources = []
-        image_sources = []
+        image_urls = []
         seen_urls = set()
 
         for doc in results:
@@ -402,10 +553,18 @@ class Approach(ABC):
                     if img["url"] in seen_urls or not img["url"]:
                         continue
                     seen_urls.add(img["url"])
-                    url = await self.download_blob_as_base64(img["url"], user_oid=user_oid)
-                    if url:
-                        image_sources.append(url)
+                    image_urls.append(img["url"])
                     citations.append(self.get_image_citation(doc.sourcepage or "", img["url"]))
+
+        # Download the images concurrently, keeping them in the order they were referenced
+        semaphore = asyncio.Semaphore(self.MAX_CONCURRENT_IMAGE_DOWNLOADS)
+
+        async def download_image(image_url: str) -> Optional[str]:
+            async with semaphore:
+                return await self.download_blob_as_base64(image_url, user_oid=user_oid)
+
+        downloaded_images = await asyncio.gather(*[download_image(image_url) for image_url in image_urls])
+        image_sources = [image for image in downloaded_images if image]
         return DataPoints(text=text_sources, images=image_sources, citations=citations)
 
     def get_citation(self, sourcepage: Optional[str]):
@@ -441,17 +600,33 @@ class Approach(ABC):
             # Treat as a direct blob path
             blob_path = blob_url
 
-        # Download the blob using the appropriate client
-        result = None
+        # Pick the appropriate client, only user storage needs the user's object ID
+        blob_manager: Optional[BaseBlobManager] = None
+        blob_user_oid = None
         if ".dfs.core.windows.net" in blob_url and self.user_blob_manager:
-            result = await self.user_blob_manager.download_blob(blob_path, user_oid=user_oid)
+            blob_manager = self.user_blob_manager
+            blob_user_oid = user_oid
         elif self.global_blob_manager:
-            result = await self.global_blob_manager.download_blob(blob_path)
+            blob_manager = self.global_blob_manager
+        if blob_manager is None:
+            return None
 
+        # Reuse the encoded image if the blob hasn't changed since it was downloaded,
+        # checking its ETag also verifies that the user can still access it
+        cached_image = self.image_cache.get(blob_url)
+        if cached_image is not None:
+            cached_etag, cached_data_uri = cached_image
+            if await blob_manager.get_blob_etag(blob_path, user_oid=blob_user_oid) == cached_etag:
+                return cached_data_uri
+
+        result = await blob_manager.download_blob(blob_path, user_oid=blob_user_oid)
         if result:
-            content, _ = result  # Unpack the tuple, ignoring properties
+            content, properties = result
             img = base64.b64encode(content).decode("utf-8")
-            return f"data:image/png;base64,{img}"
+            data_uri = f"data:image/png;base64,{img}"
+            if etag := properties.get("etag"):
+                self.image_cache.set(blob_url, (etag, data_uri))
+            return data_uri
         return None
 
     async def compute_text_embedding(self, q: str):
@@ -467,13 +642,25 @@ class Approach(ABC):
         dimensions_args: ExtraArgs = (
             {"dimensions": self.embedding_dimensions} if SUPPORTED_DIMENSIONS_MODEL[self.embedding_model] else {}
         )
-        embedding = await self.openai_client.embeddings.create(
-            # Azure OpenAI takes the deployment name as the model name
-            model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
-            input=q,
-            **dimensions_args,
-        )
-        query_vector = embedding.data[0].embedding
+
+        async def request_embedding() -> list[float]:
+            embedding = await self.openai_client.embeddings.create(
+                # Azure OpenAI takes the deployment name as the model name
+                model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
+                input=q,
+                **dimensions_args,
+            )
+            return embedding.data[0].embedding
+
+        def create_embedding() -> Awaitable[list[float]]:
+            return self.dependency_caller.call("embeddings", request_embedding, request_embedding)
+
+        if self.embedding_cache:
+            query_vector = await self.embedding_cache.get_or_create(
+                self.embedding_model, dimensions_args.get("dimensions"), q, create_embedding
+            )
+        else:
+            query_vector = await create_embedding()
         # This performs an oversampling due to how the search index was setup,
         # so we do not need to explicitly pass in an oversampling parameter here
         return VectorizedQuery(vector=query_vector, k_nearest_neighbors=50, fields=self.embedding_field)
@@ -481,9 +668,28 @@ class Approach(ABC):
     async def compute_multimodal_embedding(self, q: str):
         if not self.image_embeddings_client:
             raise ValueError("Approach is missing an image embeddings client for multimodal queries")
-        multimodal_query_vector = await self.image_embeddings_client.create_embedding_for_text(q)
+        image_embeddings_client = self.image_embeddings_client
+        if self.embedding_cache:
+            multimodal_query_vector = await self.embedding_cache.get_or_create(
+                self.MULTIMODAL_EMBEDDING_MODEL, None, q, lambda: image_embeddings_client.create_embedding_for_text(q)
+            )
+        else:
+            multimodal_query_vector = await image_embeddings_client.create_embedding_for_text(q)
         return VectorizedQuery(vector=multimodal_query_vector, k_nearest_neighbors=50, fields="images/embedding")
 
+    async def compute_query_vectors(
+        self, q: str, search_text_embeddings: bool, search_image_embeddings: bool
+    ) -> list[VectorQuery]:
+        # Both embeddings only depend on the query, so they are requested concurrently
+        embeddings: list[Awaitable[VectorizedQuery]] = []
+        if search_text_embeddings:
+            embeddings.append(self.compute_text_embedding(q))
+        if search_image_embeddings:
+            embeddings.append(self.compute_multimodal_embedding(q))
+        vectors: list[VectorQuery] = []
+        vectors.extend(await asyncio.gather(*embeddings))
+        return vectors
+
     def get_system_prompt_variables(self, override_prompt: Optional[str]) -> dict[str, str]:
         # Allows client to replace the entire prompt, or to inject into the existing prompt using >>>
         if override_prompt is None:
@@ -499,6 +705,20 @@ class Approach(ABC):
 
         return default_limit
 
+    def pack_context(
+        self,
+        model: str,
+        response_token_limit: int,
+        render_prompt: RenderPrompt,
+        text_sources: list[str],
+        past_messages: list[ChatCompletionMessageParam],
+    ) -> PackedContext:
+        """
+        Renders the answer prompt with as many of the sources and past messages as fit the model's prompt token budget.
+        """
+        packer = ContextPacker.for_model(model, response_token_limit, self.prompt_token_budget)
+        return packer.pack(render_prompt, text_sources, past_messages)
+
     def get_lowest_reasoning_effort(self, model: str) -> ChatCompletionReasoningEffort:
         """
         Return the lowest valid reasoning_effort for the given model.
@@ -547,13 +767,23 @@ class Approach(ABC):
 
         params["tools"] = tools
 
-        # Azure OpenAI takes the deployment name as the model name
-        return self.openai_client.chat.completions.create(
-            model=chatgpt_deployment if chatgpt_deployment else chatgpt_model,
-            messages=messages,
-            seed=overrides.get("seed", None),
-            n=n or 1,
-            **params,
+        def create_completion(deployment: Optional[str]) -> Callable[[], Awaitable[Any]]:
+            # Azure OpenAI takes the deployment name as the model name
+            return lambda: self.openai_client.chat.completions.create(
+                model=deployment if deployment else chatgpt_model,
+                messages=messages,
+                seed=overrides.get("seed", None),
+                n=n or 1,
+                **params,
+            )
+
+        # A hedged completion is requested from the backup deployment, when there is one.
+        # For a streamed completion, the deadline applies until the stream starts.
+        backup_deployment = self.chatgpt_backup_deployment if chatgpt_deployment else None
+        return self.dependency_caller.call(
+            "openai",
+            create_completion(chatgpt_deployment),
+            create_completion(backup_deployment) if backup_deployment else None,
         )
 
     def format_thought_step_for_chatcompletion(
@@ -578,6 +808,55 @@ class Approach(ABC):
             properties["token_usage"] = TokenUsageProps.from_completion_usage(usage)
         return ThoughtStep(title, messages, properties)
 
+    def get_coalescing_key(
+        self,
+        messages: list[ChatCompletionMessageParam],
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        stream: bool = False,
+    ) -> str:
+        """
+        Identifies the requests that share an answer while they are being answered: the same conversation,
+        up to the case and spacing of the question, with the same overrides and from users who can see the same documents.
+        """
+        normalized_messages: list[Any] = list(messages)
+        question = messages[-1]["content"]
+        if isinstance(question, str):
+            normalized_messages[-1] = {**messages[-1], "content": " ".join(question.split()).casefold()}
+        fingerprint = json.dumps(
+            [type(self).__name__, stream, normalized_messages, overrides, self.build_filter(overrides, auth_claims)],
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()
+
+    async def get_cached_answer(
+        self,
+        messages: list[ChatCompletionMessageParam],
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        stream: bool = False,
+    ) -> tuple[Optional[Any], Optional[AnswerCacheKey]]:
+        """
+        Looks up the answer to a previous question similar to this one, if the semantic answer cache is enabled.
+        Returns the cached answer, or the key to cache this question's answer under once it has been generated.
+        Only single-turn conversations are cached, since earlier messages change what a question means.
+        """
+        if not self.answer_cache or len(messages) != 1:
+            return None, None
+        question = messages[-1]["content"]
+        if not isinstance(question, str):
+            return None, None
+        partition_key = self.answer_cache.get_partition_key(
+            type(self).__name__, self.build_filter(overrides, auth_claims), overrides, stream
+        )
+        generation = self.answer_cache.generation
+        vector = cast(list[float], (await self.compute_text_embedding(question)).vector)
+        cached_answer = await self.answer_cache.get(partition_key, vector)
+        if cached_answer is not None:
+            return cached_answer, None
+        return None, AnswerCacheKey(partition_key, vector, generation)
+
     async def run(
         self,
         messages: list[ChatCompletionMessageParam],
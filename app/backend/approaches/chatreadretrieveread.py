@@ -1,5 +1,8 @@
+import asyncio
+import hashlib
 import json
 import re
+import time
 from collections.abc import AsyncGenerator, Awaitable
 from typing import Any, Optional, Union, cast
 
@@ -11,16 +14,22 @@ from openai.types.chat import (
     ChatCompletion,
     ChatCompletionChunk,
     ChatCompletionMessageParam,
-    ChatCompletionToolParam,
 )
 
 from approaches.approach import (
     Approach,
     ExtraInfo,
+    StageTimer,
     ThoughtStep,
 )
+from approaches.followupparser import FollowupQuestionParser
 from approaches.promptmanager import PromptManager
+from core.answercache import SemanticAnswerCache
 from core.authentication import AuthenticationHelper
+from core.cache import LRUCache, SingleFlight, SingleFlightStream
+from core.deadlines import DependencyCaller
+from core.embeddingcache import EmbeddingCache
+from core.reranker import BM25Reranker
 from prepdocslib.blobmanager import AdlsBlobManager, BlobManager
 from prepdocslib.embeddings import ImageEmbeddings
 
@@ -33,6 +42,8 @@ class ChatReadRetrieveReadApproach(Approach):
     """
 
     NO_RESPONSE = "0"
+    QUERY_REWRITE_CACHE_SIZE = 1024
+    QUERY_REWRITE_CACHE_TTL_SECONDS = 60 * 60
 
     def __init__(
         self,
@@ -60,6 +71,11 @@ class ChatReadRetrieveReadApproach(Approach):
         image_embeddings_client: Optional[ImageEmbeddings] = None,
         global_blob_manager: Optional[BlobManager] = None,
         user_blob_manager: Optional[AdlsBlobManager] = None,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        answer_cache: Optional[SemanticAnswerCache] = None,
+        prompt_token_budget: Optional[int] = None,
+        dependency_caller: Optional[DependencyCaller] = None,
+        chatgpt_backup_deployment: Optional[str] = None,
     ):
         self.search_client = search_client
         self.search_index_name = search_index_name
@@ -88,6 +104,69 @@ class ChatReadRetrieveReadApproach(Approach):
         self.image_embeddings_client = image_embeddings_client
         self.global_blob_manager = global_blob_manager
         self.user_blob_manager = user_blob_manager
+        self.embedding_cache = embedding_cache
+        self.answer_cache = answer_cache
+        self.image_cache: LRUCache[str, tuple[str, str]] = LRUCache(max_size=self.IMAGE_CACHE_SIZE)
+        self.prompt_token_budget = prompt_token_budget
+        self.dependency_caller = dependency_caller or DependencyCaller()
+        self.chatgpt_backup_deployment = chatgpt_backup_deployment
+        self.request_coalescer: SingleFlight[str, dict[str, Any]] = SingleFlight()
+        self.stream_coalescer: SingleFlightStream[str, dict[str, Any]] = SingleFlightStream()
+        self.local_reranker = BM25Reranker()
+        # Generated search queries, keyed by a hash of the rendered rewrite prompt and the model settings
+        self.query_rewrite_cache: LRUCache[str, ChatCompletion] = LRUCache(
+            max_size=self.QUERY_REWRITE_CACHE_SIZE, ttl_seconds=self.QUERY_REWRITE_CACHE_TTL_SECONDS
+        )
+        self.query_rewrite_calls = 0
+        self.query_rewrite_seconds = 0.0
+        self.query_rewrite_calls_saved = 0
+
+    @property
+    def coalesced_requests(self) -> int:
+        return self.request_coalescer.shared_calls + self.stream_coalescer.shared_calls
+
+    async def rewrite_query(
+        self, query_messages: list[ChatCompletionMessageParam], overrides: dict[str, Any]
+    ) -> tuple[ChatCompletion, bool]:
+        """
+        Generates the search query for the conversation, reusing the completion for an identical rewrite prompt.
+        Returns the completion and whether it came from the cache.
+        """
+        rewrite_settings = {
+            "model": self.chatgpt_model,
+            "deployment": self.chatgpt_deployment,
+            "temperature": overrides.get("temperature"),
+            "seed": overrides.get("seed"),
+            "messages": query_messages,
+        }
+        cache_key = hashlib.sha256(
+            json.dumps(rewrite_settings, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+        cached_completion = self.query_rewrite_cache.get(cache_key)
+        if cached_completion is not None:
+            self.query_rewrite_calls_saved += 1
+            return cached_completion, True
+
+        start = time.monotonic()
+        chat_completion = cast(
+            ChatCompletion,
+            await self.create_chat_completion(
+                self.chatgpt_deployment,
+                self.chatgpt_model,
+                messages=query_messages,
+                overrides=overrides,
+                response_token_limit=self.get_response_token_limit(
+                    self.chatgpt_model, 100
+                ),  # Setting too low risks malformed JSON, setting too high may affect performance
+                temperature=0.0,  # Minimize creativity for search query generation
+                tools=self.query_rewrite_tools,
+                reasoning_effort=self.get_lowest_reasoning_effort(self.chatgpt_model),
+            ),
+        )
+        self.query_rewrite_calls += 1
+        self.query_rewrite_seconds += time.monotonic() - start
+        self.query_rewrite_cache.set(cache_key, chat_completion)
+        return chat_completion, False
 
     def get_search_query(self, chat_completion: ChatCompletion, user_query: str):
         response_message = chat_completion.choices[0].message
@@ -119,6 +198,10 @@ class ChatReadRetrieveReadApproach(Approach):
         auth_claims: dict[str, Any],
         session_state: Any = None,
     ) -> dict[str, Any]:
+        cached_answer, answer_cache_key = await self.get_cached_answer(messages, overrides, auth_claims)
+        if cached_answer is not None:
+            return {**cached_answer, "session_state": session_state}
+
         extra_info, chat_coroutine = await self.run_until_final_call(
             messages, overrides, auth_claims, should_stream=False
         )
@@ -136,6 +219,8 @@ class ChatReadRetrieveReadApproach(Approach):
             "context": extra_info,
             "session_state": session_state,
         }
+        if self.answer_cache and answer_cache_key:
+            self.answer_cache.set(answer_cache_key, chat_app_response)
         return chat_app_response
 
     async def run_with_streaming(
@@ -144,54 +229,100 @@ class ChatReadRetrieveReadApproach(Approach):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         session_state: Any = None,
+    ) -> AsyncGenerator[dict, None]:
+        with self.dependency_caller.request_deadline():
+            cached_chunks, answer_cache_key = await self.get_cached_answer(
+                messages, overrides, auth_claims, stream=True
+            )
+            if cached_chunks is not None:
+                # Replay the chunks streamed for the similar question, with this conversation's session state
+                for chunk in cached_chunks:
+                    yield {**chunk, "session_state": session_state} if "session_state" in chunk else chunk
+                return
+
+            # Identical questions asked while one is being answered follow that answer's stream, from its start
+            coalescing_key = self.get_coalescing_key(messages, overrides, auth_claims, stream=True)
+            chunks: list[dict] = []
+            async for chunk in self.stream_coalescer.stream(
+                coalescing_key, lambda: self.stream_answer(messages, overrides, auth_claims)
+            ):
+                if answer_cache_key:
+                    chunks.append(chunk)
+                yield {**chunk, "session_state": session_state} if "session_state" in chunk else chunk
+        # Only answers that streamed to completion are cached
+        if self.answer_cache and answer_cache_key:
+            self.answer_cache.set(answer_cache_key, chunks)
+
+    async def stream_answer(
+        self,
+        messages: list[ChatCompletionMessageParam],
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        session_state: Any = None,
     ) -> AsyncGenerator[dict, None]:
         extra_info, chat_coroutine = await self.run_until_final_call(
             messages, overrides, auth_claims, should_stream=True
         )
         chat_coroutine = cast(Awaitable[AsyncStream[ChatCompletionChunk]], chat_coroutine)
+        # The context is sent in full once, then only what changes is sent as a patch to it
+        incremental_context = bool(overrides.get("incremental_context"))
         yield {"delta": {"role": "assistant"}, "context": extra_info, "session_state": session_state}
 
-        followup_questions_started = False
-        followup_content = ""
+        followup_parser = FollowupQuestionParser() if overrides.get("suggest_followup_questions") else None
+        followup_questions: list[str] = []
         async for event_chunk in await chat_coroutine:
             # "2023-07-01-preview" API version has a bug where first response has empty choices
-            event = event_chunk.model_dump()  # Convert pydantic model to dict
-            if event["choices"]:
-                # No usage during streaming
-                completion = {
-                    "delta": {
-                        "content": event["choices"][0]["delta"].get("content"),
-                        "role": event["choices"][0]["delta"]["role"],
-                    }
-                }
-                # if event contains << and not >>, it is start of follow-up question, truncate
-                content = completion["delta"].get("content")
-                content = content or ""  # content may either not exist in delta, or explicitly be None
-                if overrides.get("suggest_followup_questions") and "<<" in content:
-                    followup_questions_started = True
-                    earlier_content = content[: content.index("<<")]
-                    if earlier_content:
-                        completion["delta"]["content"] = earlier_content
-                        yield completion
-                    followup_content += content[content.index("<<") :]
-                elif followup_questions_started:
-                    followup_content += content
-                else:
+            if event_chunk.choices:
+                # No usage during streaming, and the delta is read directly rather than dumping the whole chunk
+                delta = event_chunk.choices[0].delta
+                completion = {"delta": {"content": delta.content, "role": delta.role}}
+                if followup_parser is None:
+                    yield completion
+                    continue
+                in_followup_questions = followup_parser.in_followup_questions
+                # content may either not exist in delta, or explicitly be None
+                answer_content, questions = followup_parser.feed(delta.content or "")
+                if answer_content:
+                    completion["delta"]["content"] = answer_content
                     yield completion
+                elif not delta.content and not in_followup_questions:
+                    yield completion
+                if questions:
+                    followup_questions.extend(questions)
+                    # Patches are small, so each question is sent as soon as it is complete
+                    if incremental_context:
+                        yield self.create_context_patch({"followup_questions": list(followup_questions)})
             else:
                 # Final chunk at end of streaming should contain usage
                 # https://cookbook.openai.com/examples/how_to_stream_completions#4-how-to-get-token-usage-data-for-streamed-chat-completion-response
                 if event_chunk.usage and extra_info.thoughts and self.include_token_usage:
-                    extra_info.thoughts[-1].update_token_usage(event_chunk.usage)
-                    yield {"delta": {"role": "assistant"}, "context": extra_info, "session_state": session_state}
-
-        if followup_content:
-            _, followup_questions = self.extract_followup_questions(followup_content)
+                    answer_thought = extra_info.thoughts[-1]
+                    answer_thought.update_token_usage(event_chunk.usage)
+                    if incremental_context:
+                        token_usage = answer_thought.props["token_usage"] if answer_thought.props else None
+                        thought_props = {str(len(extra_info.thoughts) - 1): {"token_usage": token_usage}}
+                        yield self.create_context_patch({"thought_props": thought_props})
+                    else:
+                        yield {"delta": {"role": "assistant"}, "context": extra_info, "session_state": session_state}
+
+        if followup_parser is None:
+            return
+        if remaining_content := followup_parser.finish():
+            yield {"delta": {"content": remaining_content, "role": None}}
+        if followup_parser.in_followup_questions and not incremental_context:
             yield {
                 "delta": {"role": "assistant"},
                 "context": {"context": extra_info, "followup_questions": followup_questions},
             }
 
+    def create_context_patch(self, patch: dict[str, Any]) -> dict[str, Any]:
+        """
+        Creates an event that updates the context sent in the first event of the stream.
+        "thought_props" maps the index of a thought to the props to merge into it,
+        and any other key replaces that key of the context.
+        """
+        return {"delta": {"role": "assistant"}, "context_patch": patch}
+
     async def run(
         self,
         messages: list[ChatCompletionMessageParam],
@@ -200,7 +331,13 @@ class ChatReadRetrieveReadApproach(Approach):
     ) -> dict[str, Any]:
         overrides = context.get("overrides", {})
         auth_claims = context.get("auth_claims", {})
-        return await self.run_without_streaming(messages, overrides, auth_claims, session_state)
+        with self.dependency_caller.request_deadline():
+            # Identical questions asked while one is being answered wait for that answer instead of repeating the work
+            coalescing_key = self.get_coalescing_key(messages, overrides, auth_claims)
+            response = await self.request_coalescer.do(
+                coalescing_key, lambda: self.run_without_streaming(messages, overrides, auth_claims)
+            )
+        return {**response, "session_state": session_state}
 
     async def run_stream(
         self,
@@ -232,18 +369,32 @@ class ChatReadRetrieveReadApproach(Approach):
         else:
             extra_info = await self.run_search_approach(messages, overrides, auth_claims)
 
-        messages = self.prompt_manager.render_prompt(
-            self.answer_prompt,
-            self.get_system_prompt_variables(overrides.get("prompt_template"))
-            | {
-                "include_follow_up_questions": bool(overrides.get("suggest_followup_questions")),
-                "past_messages": messages[:-1],
-                "user_query": original_user_query,
-                "text_sources": extra_info.data_points.text,
-                "image_sources": extra_info.data_points.images,
-                "citations": extra_info.data_points.citations,
-            },
+        def render_answer_prompt(
+            text_sources: list[str], past_messages: list[ChatCompletionMessageParam]
+        ) -> list[ChatCompletionMessageParam]:
+            return self.prompt_manager.render_prompt(
+                self.answer_prompt,
+                self.get_system_prompt_variables(overrides.get("prompt_template"))
+                | {
+                    "include_follow_up_questions": bool(overrides.get("suggest_followup_questions")),
+                    "past_messages": past_messages,
+                    "user_query": original_user_query,
+                    "text_sources": text_sources,
+                    "image_sources": extra_info.data_points.images,
+                    "citations": extra_info.data_points.citations,
+                },
+            )
+
+        response_token_limit = self.get_response_token_limit(self.chatgpt_model, 1024)
+        packed_context = self.pack_context(
+            self.chatgpt_model,
+            response_token_limit,
+            render_answer_prompt,
+            extra_info.data_points.text or [],
+            messages[:-1],
         )
+        messages = packed_context.messages
+        extra_info.data_points.text = packed_context.text_sources
 
         chat_coroutine = cast(
             Union[Awaitable[ChatCompletion], Awaitable[AsyncStream[ChatCompletionChunk]]],
@@ -252,20 +403,21 @@ class ChatReadRetrieveReadApproach(Approach):
                 self.chatgpt_model,
                 messages,
                 overrides,
-                self.get_response_token_limit(self.chatgpt_model, 1024),
+                response_token_limit,
                 should_stream,
             ),
         )
-        extra_info.thoughts.append(
-            self.format_thought_step_for_chatcompletion(
-                title="Prompt to generate answer",
-                messages=messages,
-                overrides=overrides,
-                model=self.chatgpt_model,
-                deployment=self.chatgpt_deployment,
-                usage=None,
-            )
+        answer_thought = self.format_thought_step_for_chatcompletion(
+            title="Prompt to generate answer",
+            messages=messages,
+            overrides=overrides,
+            model=self.chatgpt_model,
+            deployment=self.chatgpt_deployment,
+            usage=None,
         )
+        if packed_context.trimmed and answer_thought.props is not None:
+            answer_thought.props.update(packed_context.to_props())
+        extra_info.thoughts.append(answer_thought)
         return (extra_info, chat_coroutine)
 
     async def run_search_approach(
@@ -286,6 +438,15 @@ class ChatReadRetrieveReadApproach(Approach):
         search_image_embeddings = (
             overrides.get("search_image_embeddings", self.multimodal_enabled) and self.multimodal_enabled
         )
+        # Embedding the user's question while the search query is being generated saves a round trip
+        # whenever the generated query is the question itself, at the cost of an extra embedding otherwise
+        speculative_query_embedding = (
+            bool(overrides.get("speculative_query_embedding"))
+            and use_vector_search
+            and (search_text_embeddings or search_image_embeddings)
+        )
+        include_stage_timings = bool(overrides.get("include_stage_timings"))
+        timer = StageTimer()
 
         original_user_query = messages[-1]["content"]
         if not isinstance(original_user_query, str):
@@ -294,92 +455,131 @@ class ChatReadRetrieveReadApproach(Approach):
         query_messages = self.prompt_manager.render_prompt(
             self.query_rewrite_prompt, {"user_query": original_user_query, "past_messages": messages[:-1]}
         )
-        tools: list[ChatCompletionToolParam] = self.query_rewrite_tools
+        # The user's first question is often a fine search query already, so the rewrite can be skipped
+        skip_query_rewrite = bool(overrides.get("skip_single_turn_query_rewrite")) and len(messages) == 1
+        if skip_query_rewrite:
+            speculative_query_embedding = False
+
+        speculative_vectors: Optional[asyncio.Task[list[VectorQuery]]] = None
+        if speculative_query_embedding:
+            speculative_vectors = asyncio.create_task(
+                timer.measure(
+                    "speculative_embedding",
+                    self.compute_query_vectors(original_user_query, search_text_embeddings, search_image_embeddings),
+                )
+            )
 
-        # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
+        reused_speculative_embedding = False
+        try:
+            # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
 
-        chat_completion = cast(
-            ChatCompletion,
-            await self.create_chat_completion(
-                self.chatgpt_deployment,
-                self.chatgpt_model,
-                messages=query_messages,
-                overrides=overrides,
-                response_token_limit=self.get_response_token_limit(
-                    self.chatgpt_model, 100
-                ),  # Setting too low risks malformed JSON, setting too high may affect performance
-                temperature=0.0,  # Minimize creativity for search query generation
-                tools=tools,
-                reasoning_effort=self.get_lowest_reasoning_effort(self.chatgpt_model),
+            chat_completion: Optional[ChatCompletion] = None
+            query_rewrite_cached = False
+            if skip_query_rewrite:
+                self.query_rewrite_calls_saved += 1
+                query_text = original_user_query
+            else:
+                rewrite_completion, query_rewrite_cached = await timer.measure(
+                    "query_rewrite", self.rewrite_query(query_messages, overrides)
+                )
+                query_text = self.get_search_query(rewrite_completion, original_user_query)
+                chat_completion = rewrite_completion
+
+            # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
+
+            vectors: list[VectorQuery] = []
+            if use_vector_search:
+                if speculative_vectors and query_text.strip() == original_user_query.strip():
+                    vectors = await speculative_vectors
+                    reused_speculative_embedding = True
+                else:
+                    vectors = await timer.measure(
+                        "embedding",
+                        self.compute_query_vectors(query_text, search_text_embeddings, search_image_embeddings),
+                    )
+        finally:
+            if speculative_vectors and not reused_speculative_embedding:
+                if not speculative_vectors.done():
+                    speculative_vectors.cancel()
+                elif not speculative_vectors.cancelled():
+                    # The unused embedding may have failed, which would otherwise be logged as never retrieved
+                    speculative_vectors.exception()
+
+        # Without the semantic ranker, more results can be fetched and reranked here instead
+        use_local_reranker = bool(overrides.get("use_local_reranker")) and not use_semantic_ranker
+        results = await timer.measure(
+            "search",
+            self.search(
+                self.local_reranker.get_candidate_count(top) if use_local_reranker else top,
+                query_text,
+                search_index_filter,
+                vectors,
+                use_text_search,
+                use_vector_search,
+                use_semantic_ranker,
+                use_semantic_captions,
+                minimum_search_score,
+                minimum_reranker_score,
+                use_query_rewriting,
             ),
         )
-
-        query_text = self.get_search_query(chat_completion, original_user_query)
-
-        # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
-
-        vectors: list[VectorQuery] = []
-        if use_vector_search:
-            if search_text_embeddings:
-                vectors.append(await self.compute_text_embedding(query_text))
-            if search_image_embeddings:
-                vectors.append(await self.compute_multimodal_embedding(query_text))
-
-        results = await self.search(
-            top,
-            query_text,
-            search_index_filter,
-            vectors,
-            use_text_search,
-            use_vector_search,
-            use_semantic_ranker,
-            use_semantic_captions,
-            minimum_search_score,
-            minimum_reranker_score,
-            use_query_rewriting,
-        )
+        if use_local_reranker:
+            results = self.rerank_documents(query_text, results, top)
 
         # STEP 3: Generate a contextual and content specific answer using the search results and chat history
-        data_points = await self.get_sources_content(
-            results,
-            use_semantic_captions,
-            include_text_sources=send_text_sources,
-            download_image_sources=send_image_sources,
-            user_oid=auth_claims.get("oid"),
+        data_points = await timer.measure(
+            "sources_content",
+            self.get_sources_content(
+                results,
+                use_semantic_captions,
+                include_text_sources=send_text_sources,
+                download_image_sources=send_image_sources,
+                user_oid=auth_claims.get("oid"),
+            ),
         )
-        extra_info = ExtraInfo(
-            data_points,
-            thoughts=[
+        search_props = {
+            "use_semantic_captions": use_semantic_captions,
+            "use_semantic_ranker": use_semantic_ranker,
+            "use_query_rewriting": use_query_rewriting,
+            "top": top,
+            "filter": search_index_filter,
+            "use_vector_search": use_vector_search,
+            "use_text_search": use_text_search,
+            "search_text_embeddings": search_text_embeddings,
+            "search_image_embeddings": search_image_embeddings,
+        }
+        if speculative_query_embedding:
+            search_props["reused_speculative_embedding"] = reused_speculative_embedding
+        if use_local_reranker:
+            search_props["use_local_reranker"] = True
+        if skip_query_rewrite:
+            search_props["skipped_query_rewrite"] = True
+        if query_rewrite_cached:
+            search_props["query_rewrite_cached"] = True
+        thoughts: list[ThoughtStep] = []
+        if chat_completion:
+            thoughts.append(
                 self.format_thought_step_for_chatcompletion(
                     title="Prompt to generate search query",
                     messages=query_messages,
                     overrides=overrides,
                     model=self.chatgpt_model,
                     deployment=self.chatgpt_deployment,
-                    usage=chat_completion.usage,
+                    # A cached search query didn't use any tokens for this request
+                    usage=None if query_rewrite_cached else chat_completion.usage,
                     reasoning_effort=self.get_lowest_reasoning_effort(self.chatgpt_model),
-                ),
-                ThoughtStep(
-                    "Search using generated search query",
-                    query_text,
-                    {
-                        "use_semantic_captions": use_semantic_captions,
-                        "use_semantic_ranker": use_semantic_ranker,
-                        "use_query_rewriting": use_query_rewriting,
-                        "top": top,
-                        "filter": search_index_filter,
-                        "use_vector_search": use_vector_search,
-                        "use_text_search": use_text_search,
-                        "search_text_embeddings": search_text_embeddings,
-                        "search_image_embeddings": search_image_embeddings,
-                    },
-                ),
-                ThoughtStep(
-                    "Search results",
-                    [result.serialize_for_results() for result in results],
-                ),
-            ],
+                )
+            )
+        thoughts.append(ThoughtStep("Search using generated search query", query_text, search_props))
+        thoughts.append(
+            ThoughtStep(
+                "Search results",
+                [result.serialize_for_results() for result in results],
+            )
         )
+        extra_info = ExtraInfo(data_points, thoughts=thoughts)
+        if include_stage_timings:
+            extra_info.thoughts.append(timer.to_thought_step("Search stage timings"))
         return extra_info
 
     async def run_agentic_retrieval_approach(
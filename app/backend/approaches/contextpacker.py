@@ -0,0 +1,167 @@
+from collections.abc import Sequence
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+import tiktoken
+from openai.types.chat import ChatCompletionMessageParam
+
+# Renders the answer prompt from the text sources and past messages that fit
+RenderPrompt = Callable[[list[str], list[ChatCompletionMessageParam]], list[ChatCompletionMessageParam]]
+
+
+@dataclass
+class PackedContext:
+    messages: list[ChatCompletionMessageParam]
+    text_sources: list[str]
+    past_messages: list[ChatCompletionMessageParam]
+    token_budget: int
+    prompt_tokens: Optional[int] = None
+    dropped_sources: int = 0
+    truncated_sources: int = 0
+    dropped_past_messages: int = 0
+
+    @property
+    def trimmed(self) -> bool:
+        return bool(self.dropped_sources or self.truncated_sources or self.dropped_past_messages)
+
+    def to_props(self) -> dict[str, Any]:
+        return {
+            "prompt_token_budget": self.token_budget,
+            "prompt_tokens": self.prompt_tokens,
+            "dropped_sources": self.dropped_sources,
+            "truncated_sources": self.truncated_sources,
+            "dropped_past_messages": self.dropped_past_messages,
+        }
+
+
+class ContextPacker:
+    """
+    Fits the retrieved sources and the conversation history into the prompt token budget of a chat model.
+    Sources are kept in the order they were ranked, so the lowest-ranked sources are dropped first,
+    and the last source that only partly fits is truncated. The remaining tokens go to the most recent messages,
+    dropping the oldest history first.
+    """
+
+    # Maximum number of input tokens for each chat model, the budget is this less the response token limit
+    MODEL_PROMPT_TOKEN_LIMITS = {
+        "gpt-35-turbo": 16385,
+        "gpt-3.5-turbo": 16385,
+        "gpt-4": 8192,
+        "gpt-4-32k": 32768,
+        "gpt-4o": 128000,
+        "gpt-4o-mini": 128000,
+        "gpt-4.1": 1047576,
+        "gpt-4.1-mini": 1047576,
+        "gpt-4.1-nano": 1047576,
+        "o1": 200000,
+        "o3": 200000,
+        "o3-mini": 200000,
+        "o4-mini": 200000,
+        "gpt-5": 272000,
+        "gpt-5-mini": 272000,
+        "gpt-5-nano": 272000,
+        "gpt-5-chat": 128000,
+    }
+    DEFAULT_PROMPT_TOKEN_LIMIT = 128000
+    # Tokens each message adds for its role and separators, and that prime the reply
+    # https://cookbook.openai.com/examples/how_to_count_tokens_with_tiktoken
+    TOKENS_PER_MESSAGE = 3
+    TOKENS_PER_REPLY = 3
+    # A source is only truncated if at least this many of its tokens fit, otherwise it's dropped
+    MIN_TRUNCATED_SOURCE_TOKENS = 64
+
+    def __init__(self, model: str, token_budget: int):
+        self.model = model
+        self.token_budget = token_budget
+        self.encoding = self.get_encoding(model)
+
+    @classmethod
+    def for_model(cls, model: str, response_token_limit: int, token_budget: Optional[int] = None) -> "ContextPacker":
+        if token_budget is None:
+            token_budget = (
+                cls.MODEL_PROMPT_TOKEN_LIMITS.get(model, cls.DEFAULT_PROMPT_TOKEN_LIMIT) - response_token_limit
+            )
+        return cls(model, token_budget)
+
+    @staticmethod
+    def get_encoding(model: str) -> tiktoken.Encoding:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            # Models newer than the installed tiktoken all use the o200k encoding
+            return tiktoken.get_encoding("o200k_base")
+
+    @staticmethod
+    def get_message_text(message: ChatCompletionMessageParam) -> str:
+        content = message.get("content")
+        if isinstance(content, str):
+            return content
+        if content is None:
+            return ""
+        # Image parts aren't counted, as their cost depends on their resolution
+        return "".join(part["text"] for part in content if part.get("type") == "text")  # type: ignore[union-attr,typeddict-item]
+
+    def count_message_tokens(self, messages: Sequence[ChatCompletionMessageParam]) -> int:
+        tokens = self.TOKENS_PER_REPLY if messages else 0
+        for message in messages:
+            tokens += self.TOKENS_PER_MESSAGE + len(self.encoding.encode(message["role"]))
+            tokens += len(self.encoding.encode(self.get_message_text(message)))
+        return tokens
+
+    def fits_without_counting(self, messages: Sequence[ChatCompletionMessageParam]) -> bool:
+        # A token always covers at least one byte of UTF-8, so a prompt with no more bytes than the budget fits
+        size = sum(
+            self.TOKENS_PER_MESSAGE + len(message["role"]) + len(self.get_message_text(message).encode("utf-8"))
+            for message in messages
+        )
+        return size + self.TOKENS_PER_REPLY <= self.token_budget
+
+    def pack(
+        self,
+        render_prompt: RenderPrompt,
+        text_sources: list[str],
+        past_messages: list[ChatCompletionMessageParam],
+    ) -> PackedContext:
+        messages = render_prompt(text_sources, past_messages)
+        if self.fits_without_counting(messages):
+            return PackedContext(messages, text_sources, past_messages, self.token_budget)
+        prompt_tokens = self.count_message_tokens(messages)
+        if prompt_tokens <= self.token_budget:
+            return PackedContext(messages, text_sources, past_messages, self.token_budget, prompt_tokens)
+
+        available = self.token_budget - self.count_message_tokens(render_prompt([], []))
+        packed_sources: list[str] = []
+        truncated_sources = 0
+        for source in text_sources:
+            source_tokens = self.encoding.encode(source)
+            # Sources are separated by a newline in the prompt
+            if len(source_tokens) + 1 <= available:
+                packed_sources.append(source)
+                available -= len(source_tokens) + 1
+                continue
+            if available - 1 >= self.MIN_TRUNCATED_SOURCE_TOKENS:
+                packed_sources.append(self.encoding.decode(source_tokens[: available - 1]))
+                truncated_sources = 1
+                available = 0
+            break
+
+        kept_messages = 0
+        for message in reversed(past_messages):
+            message_tokens = self.count_message_tokens([message]) - self.TOKENS_PER_REPLY
+            if message_tokens > available:
+                break
+            available -= message_tokens
+            kept_messages += 1
+        packed_messages = past_messages[len(past_messages) - kept_messages :]
+
+        messages = render_prompt(packed_sources, packed_messages)
+        return PackedContext(
+            messages,
+            packed_sources,
+            packed_messages,
+            self.token_budget,
+            prompt_tokens=self.count_message_tokens(messages),
+            dropped_sources=len(text_sources) - len(packed_sources),
+            truncated_sources=truncated_sources,
+            dropped_past_messages=len(past_messages) - kept_messages,
+        )
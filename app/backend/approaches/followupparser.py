@@ -0,0 +1,87 @@
+from typing import Optional
+
+
+class FollowupQuestionParser:
+    """
+    Splits a streamed answer into the answer text and the follow-up questions that end it, each enclosed
+    in << and >>, returning each question as soon as its >> arrives. Delimiters split across chunks are handled
+    by holding back a trailing < or > until the next chunk. Anything after the first << is not part of the answer.
+    """
+
+    ANSWER = "answer"
+    QUESTION = "question"
+    BETWEEN_QUESTIONS = "between_questions"
+
+    def __init__(self):
+        self.state = self.ANSWER
+        # A "<" or ">" that ended the previous chunk and may be the first half of a delimiter
+        self.pending: Optional[str] = None
+        self.question_parts: list[str] = []
+
+    @property
+    def in_followup_questions(self) -> bool:
+        return self.state != self.ANSWER
+
+    def feed(self, content: str) -> tuple[str, list[str]]:
+        """
+        Returns the answer text in this chunk and the follow-up questions completed by it.
+        """
+        answer = ""
+        questions: list[str] = []
+        if not content:
+            return answer, questions
+        position = 0
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            if content.startswith(pending):
+                position = 1
+                if self.state == self.QUESTION:
+                    self.complete_question(questions)
+                else:
+                    self.state = self.QUESTION
+            elif self.state == self.QUESTION:
+                self.question_parts.append(pending)
+            elif self.state == self.ANSWER:
+                answer = pending
+
+        while position < len(content):
+            if self.state == self.QUESTION:
+                end = content.find(">>", position)
+                if end == -1:
+                    self.question_parts.append(self.hold_back(content, position, ">"))
+                    break
+                self.question_parts.append(content[position:end])
+                self.complete_question(questions)
+                position = end + 2
+            else:
+                start = content.find("<<", position)
+                if start == -1:
+                    text = self.hold_back(content, position, "<")
+                    if self.state == self.ANSWER:
+                        answer = answer + text if answer else text
+                    break
+                if self.state == self.ANSWER:
+                    answer = answer + content[position:start] if answer else content[position:start]
+                self.state = self.QUESTION
+                position = start + 2
+        return answer, questions
+
+    def finish(self) -> str:
+        """
+        Returns any answer text held back at the end of the stream.
+        """
+        pending, self.pending = self.pending, None
+        return pending if pending is not None and self.state == self.ANSWER else ""
+
+    def hold_back(self, content: str, position: int, delimiter: str) -> str:
+        if content.endswith(delimiter) and len(content) > position:
+            self.pending = delimiter
+            return content[position:-1]
+        return content[position:]
+
+    def complete_question(self, questions: list[str]):
+        question = "".join(self.question_parts)
+        self.question_parts.clear()
+        self.state = self.BETWEEN_QUESTIONS
+        if question:
+            questions.append(question)
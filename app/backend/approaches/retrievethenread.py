@@ -12,7 +12,12 @@ from approaches.approach import (
     ThoughtStep,
 )
 from approaches.promptmanager import PromptManager
+from core.answercache import SemanticAnswerCache
 from core.authentication import AuthenticationHelper
+from core.cache import LRUCache, SingleFlight
+from core.deadlines import DependencyCaller
+from core.embeddingcache import EmbeddingCache
+from core.reranker import BM25Reranker
 from prepdocslib.blobmanager import AdlsBlobManager, BlobManager
 from prepdocslib.embeddings import ImageEmbeddings
 
@@ -50,6 +55,11 @@ class RetrieveThenReadApproach(Approach):
         image_embeddings_client: Optional[ImageEmbeddings] = None,
         global_blob_manager: Optional[BlobManager] = None,
         user_blob_manager: Optional[AdlsBlobManager] = None,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        answer_cache: Optional[SemanticAnswerCache] = None,
+        prompt_token_budget: Optional[int] = None,
+        dependency_caller: Optional[DependencyCaller] = None,
+        chatgpt_backup_deployment: Optional[str] = None,
     ):
         self.search_client = search_client
         self.search_index_name = search_index_name
@@ -77,6 +87,14 @@ class RetrieveThenReadApproach(Approach):
         self.image_embeddings_client = image_embeddings_client
         self.global_blob_manager = global_blob_manager
         self.user_blob_manager = user_blob_manager
+        self.embedding_cache = embedding_cache
+        self.answer_cache = answer_cache
+        self.image_cache: LRUCache[str, tuple[str, str]] = LRUCache(max_size=self.IMAGE_CACHE_SIZE)
+        self.prompt_token_budget = prompt_token_budget
+        self.dependency_caller = dependency_caller or DependencyCaller()
+        self.chatgpt_backup_deployment = chatgpt_backup_deployment
+        self.request_coalescer: SingleFlight[str, dict[str, Any]] = SingleFlight()
+        self.local_reranker = BM25Reranker()
 
     async def run(
         self,
@@ -86,27 +104,56 @@ class RetrieveThenReadApproach(Approach):
     ) -> dict[str, Any]:
         overrides = context.get("overrides", {})
         auth_claims = context.get("auth_claims", {})
-        use_agentic_retrieval = True if overrides.get("use_agentic_retrieval") else False
-        q = messages[-1]["content"]
-        if not isinstance(q, str):
+        if not isinstance(messages[-1]["content"], str):
             raise ValueError("The most recent message content must be a string.")
 
+        with self.dependency_caller.request_deadline():
+            # Identical questions asked while one is being answered wait for that answer instead of repeating the work
+            coalescing_key = self.get_coalescing_key(messages, overrides, auth_claims)
+            response = await self.request_coalescer.do(
+                coalescing_key, lambda: self.run_without_streaming(messages, overrides, auth_claims)
+            )
+        return {**response, "session_state": session_state}
+
+    async def run_without_streaming(
+        self,
+        messages: list[ChatCompletionMessageParam],
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+    ) -> dict[str, Any]:
+        use_agentic_retrieval = True if overrides.get("use_agentic_retrieval") else False
+        q = cast(str, messages[-1]["content"])
+
+        cached_answer, answer_cache_key = await self.get_cached_answer(messages, overrides, auth_claims)
+        if cached_answer is not None:
+            return cached_answer
+
         if use_agentic_retrieval:
             extra_info = await self.run_agentic_retrieval_approach(messages, overrides, auth_claims)
         else:
             extra_info = await self.run_search_approach(messages, overrides, auth_claims)
 
         # Process results
-        messages = self.prompt_manager.render_prompt(
-            self.answer_prompt,
-            self.get_system_prompt_variables(overrides.get("prompt_template"))
-            | {
-                "user_query": q,
-                "text_sources": extra_info.data_points.text,
-                "image_sources": extra_info.data_points.images or [],
-                "citations": extra_info.data_points.citations,
-            },
+        def render_answer_prompt(
+            text_sources: list[str], past_messages: list[ChatCompletionMessageParam]
+        ) -> list[ChatCompletionMessageParam]:
+            return self.prompt_manager.render_prompt(
+                self.answer_prompt,
+                self.get_system_prompt_variables(overrides.get("prompt_template"))
+                | {
+                    "user_query": q,
+                    "text_sources": text_sources,
+                    "image_sources": extra_info.data_points.images or [],
+                    "citations": extra_info.data_points.citations,
+                },
+            )
+
+        response_token_limit = self.get_response_token_limit(self.chatgpt_model, 1024)
+        packed_context = self.pack_context(
+            self.chatgpt_model, response_token_limit, render_answer_prompt, extra_info.data_points.text or [], []
         )
+        messages = packed_context.messages
+        extra_info.data_points.text = packed_context.text_sources
 
         chat_completion = cast(
             ChatCompletion,
@@ -115,20 +162,21 @@ class RetrieveThenReadApproach(Approach):
                 self.chatgpt_model,
                 messages=messages,
                 overrides=overrides,
-                response_token_limit=self.get_response_token_limit(self.chatgpt_model, 1024),
+                response_token_limit=response_token_limit,
             ),
         )
-        extra_info.thoughts.append(
-            self.format_thought_step_for_chatcompletion(
-                title="Prompt to generate answer",
-                messages=messages,
-                overrides=overrides,
-                model=self.chatgpt_model,
-                deployment=self.chatgpt_deployment,
-                usage=chat_completion.usage,
-            )
+        answer_thought = self.format_thought_step_for_chatcompletion(
+            title="Prompt to generate answer",
+            messages=messages,
+            overrides=overrides,
+            model=self.chatgpt_model,
+            deployment=self.chatgpt_deployment,
+            usage=chat_completion.usage,
         )
-        return {
+        if packed_context.trimmed and answer_thought.props is not None:
+            answer_thought.props.update(packed_context.to_props())
+        extra_info.thoughts.append(answer_thought)
+        response = {
             "message": {
                 "content": chat_completion.choices[0].message.content,
                 "role": chat_completion.choices[0].message.role,
@@ -141,8 +189,10 @@ class RetrieveThenReadApproach(Approach):
                     "citations": extra_info.data_points.citations or [],
                 },
             },
-            "session_state": session_state,
         }
+        if self.answer_cache and answer_cache_key:
+            self.answer_cache.set(answer_cache_key, response)
+        return response
 
     async def run_search_approach(
         self, messages: list[ChatCompletionMessageParam], overrides: dict[str, Any], auth_claims: dict[str, Any]
@@ -166,13 +216,12 @@ class RetrieveThenReadApproach(Approach):
 
         vectors: list[VectorQuery] = []
         if use_vector_search:
-            if search_text_embeddings:
-                vectors.append(await self.compute_text_embedding(q))
-            if search_image_embeddings:
-                vectors.append(await self.compute_multimodal_embedding(q))
+            vectors = await self.compute_query_vectors(q, search_text_embeddings, search_image_embeddings)
 
+        # Without the semantic ranker, more results can be fetched and reranked here instead
+        use_local_reranker = bool(overrides.get("use_local_reranker")) and not use_semantic_ranker
         results = await self.search(
-            top,
+            self.local_reranker.get_candidate_count(top) if use_local_reranker else top,
             q,
             filter,
             vectors,
@@ -184,6 +233,8 @@ class RetrieveThenReadApproach(Approach):
             minimum_reranker_score,
             use_query_rewriting,
         )
+        if use_local_reranker:
+            results = self.rerank_documents(q, results, top)
 
         data_points = await self.get_sources_content(
             results,
@@ -193,24 +244,23 @@ class RetrieveThenReadApproach(Approach):
             user_oid=auth_claims.get("oid"),
         )
 
+        search_props = {
+            "use_semantic_captions": use_semantic_captions,
+            "use_semantic_ranker": use_semantic_ranker,
+            "use_query_rewriting": use_query_rewriting,
+            "top": top,
+            "filter": filter,
+            "use_vector_search": use_vector_search,
+            "use_text_search": use_text_search,
+            "search_text_embeddings": search_text_embeddings,
+            "search_image_embeddings": search_image_embeddings,
+        }
+        if use_local_reranker:
+            search_props["use_local_reranker"] = True
         return ExtraInfo(
             data_points,
             thoughts=[
-                ThoughtStep(
-                    "Search using user query",
-                    q,
-                    {
-                        "use_semantic_captions": use_semantic_captions,
-                        "use_semantic_ranker": use_semantic_ranker,
-                        "use_query_rewriting": use_query_rewriting,
-                        "top": top,
-                        "filter": filter,
-                        "use_vector_search": use_vector_search,
-                        "use_text_search": use_text_search,
-                        "search_text_embeddings": search_text_embeddings,
-                        "search_image_embeddings": search_image_embeddings,
-                    },
-                ),
+                ThoughtStep("Search using user query", q, search_props),
                 ThoughtStep(
                     "Search results",
                     [result.serialize_for_results() for result in results],
@@ -2,6 +2,8 @@ CONFIG_OPENAI_TOKEN = "openai_token"
 CONFIG_CREDENTIAL = "azure_credential"
 CONFIG_ASK_APPROACH = "ask_approach"
 CONFIG_CHAT_APPROACH = "chat_approach"
+CONFIG_ANSWER_CACHE = "answer_cache"
+CONFIG_DEPENDENCY_CALLER = "dependency_caller"
 CONFIG_GLOBAL_BLOB_MANAGER = "global_blob_manager"
 CONFIG_USER_BLOB_MANAGER = "user_blob_manager"
 CONFIG_USER_UPLOAD_ENABLED = "user_upload_enabled"
@@ -13,8 +15,10 @@ CONFIG_DEFAULT_REASONING_EFFORT = "default_reasoning_effort"
 CONFIG_VECTOR_SEARCH_ENABLED = "vector_search_enabled"
 CONFIG_SEARCH_CLIENT = "search_client"
 CONFIG_OPENAI_CLIENT = "openai_client"
+CONFIG_OPENAI_RATE_LIMITERS = "openai_rate_limiters"
 CONFIG_AGENT_CLIENT = "agent_client"
 CONFIG_INGESTER = "ingester"
+CONFIG_INGESTION_QUEUE = "ingestion_queue"
 CONFIG_LANGUAGE_PICKER_ENABLED = "language_picker_enabled"
 CONFIG_SPEECH_INPUT_ENABLED = "speech_input_enabled"
 CONFIG_SPEECH_OUTPUT_BROWSER_ENABLED = "speech_output_browser_enabled"
@@ -24,6 +28,7 @@ CONFIG_SPEECH_SERVICE_LOCATION = "speech_service_location"
 CONFIG_SPEECH_SERVICE_TOKEN = "speech_service_token"
 CONFIG_SPEECH_SERVICE_VOICE = "speech_service_voice"
 CONFIG_STREAMING_ENABLED = "streaming_enabled"
+CONFIG_STREAM_COALESCE_SECONDS = "stream_coalesce_seconds"
 CONFIG_CHAT_HISTORY_BROWSER_ENABLED = "chat_history_browser_enabled"
 CONFIG_CHAT_HISTORY_COSMOS_ENABLED = "chat_history_cosmos_enabled"
 CONFIG_AGENTIC_RETRIEVAL_ENABLED = "agentic_retrieval"
@@ -0,0 +1,122 @@
+import asyncio
+import hashlib
+import json
+import math
+import operator
+import time
+from array import array
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from core.cache import LRUCache
+
+
+@dataclass
+class CachedAnswer:
+    # Normalized to unit length, so the dot product of two vectors is their cosine similarity
+    vector: array
+    response: Any
+    expires_at: float
+
+
+@dataclass
+class AnswerCacheKey:
+    partition_key: str
+    vector: list[float]
+    # Answers computed before the cache was last invalidated are not stored
+    generation: int
+
+
+class SemanticAnswerCache:
+    """
+    Caches answers so that questions similar enough to one already answered reuse its answer,
+    matching questions by the cosine similarity of their embeddings.
+    Answers are partitioned by everything else that shapes them: the search filter (which includes the user's
+    security filter, so answers are never shared with someone who can't see the same documents) and the overrides.
+    Invalidating the cache, such as when documents are added to or removed from the index, discards every answer.
+    """
+
+    DEFAULT_SIMILARITY_THRESHOLD = 0.97
+    # Invalidation only reaches the process that added or removed documents,
+    # so other processes may serve answers that cite removed documents for up to this long
+    DEFAULT_TTL_SECONDS = 5 * 60
+    DEFAULT_MAX_PARTITIONS = 1024
+    # Each lookup compares the question with every answer in its partition, which takes about 0.1ms per answer
+    # for 1536 dimensions, so partitions are kept small
+    DEFAULT_MAX_ANSWERS_PER_PARTITION = 32
+
+    def __init__(
+        self,
+        similarity_threshold: float = DEFAULT_SIMILARITY_THRESHOLD,
+        ttl_seconds: float = DEFAULT_TTL_SECONDS,
+        max_partitions: int = DEFAULT_MAX_PARTITIONS,
+        max_answers_per_partition: int = DEFAULT_MAX_ANSWERS_PER_PARTITION,
+    ):
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_answers_per_partition = max_answers_per_partition
+        self.partitions: LRUCache[str, list[CachedAnswer]] = LRUCache(max_size=max_partitions)
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_partition_key(approach: str, filter: Optional[str], overrides: dict[str, Any], stream: bool) -> str:
+        partition = {"approach": approach, "filter": filter, "overrides": overrides, "stream": stream}
+        return hashlib.sha256(json.dumps(partition, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def normalize(vector: list[float]) -> array:
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return array("f", (value / norm for value in vector))
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    async def get(self, partition_key: str, vector: list[float]) -> Optional[Any]:
+        answers = self.partitions.get(partition_key)
+        best_answer = None
+        if answers:
+            now = time.monotonic()
+            answers[:] = [answer for answer in answers if answer.expires_at > now]
+            if answers:
+                # The comparisons take milliseconds, so they're made off the event loop, on a copy of the partition
+                # since answers may be added meanwhile
+                best_answer = await asyncio.to_thread(self.find_most_similar, list(answers), vector)
+        if best_answer is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return best_answer.response
+
+    def find_most_similar(self, answers: list[CachedAnswer], vector: list[float]) -> Optional[CachedAnswer]:
+        query_vector = self.normalize(vector)
+        best_answer = None
+        best_similarity = self.similarity_threshold
+        for answer in answers:
+            similarity = sum(map(operator.mul, query_vector, answer.vector))
+            if similarity >= best_similarity:
+                best_answer, best_similarity = answer, similarity
+        return best_answer
+
+    def set(self, key: AnswerCacheKey, response: Any):
+        if key.generation != self.generation:
+            return
+        answers = self.partitions.get(key.partition_key)
+        if answers is None:
+            answers = []
+            self.partitions.set(key.partition_key, answers)
+        vector = self.normalize(key.vector)
+        now = time.monotonic()
+        # Requests that were coalesced into one answer all store it under the same question
+        if any(answer.vector == vector and answer.expires_at > now for answer in answers):
+            return
+        answers.append(CachedAnswer(vector, response, now + self.ttl_seconds))
+        # Evict the oldest answers once the partition is full
+        del answers[: -self.max_answers_per_partition]
+
+    def invalidate(self):
+        self.generation += 1
+        self.partitions.clear()
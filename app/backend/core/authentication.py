@@ -1,16 +1,20 @@
 # Refactored from https://github.com/Azure-Samples/ms-identity-python-on-behalf-of
 
+import asyncio
 import base64
+import hashlib
 import json
 import logging
-from typing import Any, Optional
+import time
+from collections.abc import Awaitable
+from typing import Any, Callable, Optional
 
 import aiohttp
 import jwt
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.models import SearchIndex
-from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey
 from msal import ConfidentialClientApplication
 from msal.token_cache import TokenCache
 from tenacity import (
@@ -20,6 +24,8 @@ from tenacity import (
     wait_random_exponential,
 )
 
+from core.cache import LRUCache, SingleFlight
+
 
 # AuthError is raised when the authentication token sent by the client UI cannot be parsed or there is an authentication error accessing the graph API
 class AuthError(Exception):
@@ -31,8 +37,149 @@ class AuthError(Exception):
         return self.error or ""
 
 
+def rsa_public_key_from_jwk(key: dict[str, Any]) -> RSAPublicKey:
+    # Construct the RSA public key from the base64url encoded modulus and exponent of a JSON Web Key
+    public_numbers = rsa.RSAPublicNumbers(
+        e=int.from_bytes(base64.urlsafe_b64decode(key["e"] + "=="), byteorder="big"),
+        n=int.from_bytes(base64.urlsafe_b64decode(key["n"] + "=="), byteorder="big"),
+    )
+    return public_numbers.public_key()
+
+
+class JwksCache:
+    """
+    In-process cache of the signing keys published at the Entra JWKS endpoint, keyed by kid.
+    The key set is refreshed once it is older than the TTL, or when a token is signed with a kid we haven't seen yet
+    (which is how Entra key rotation shows up). Forced refreshes are rate limited so that tokens with bogus kids
+    can't be used to hammer the discovery endpoint.
+    See https://learn.microsoft.com/entra/identity-platform/signing-key-rollover
+    """
+
+    DEFAULT_TTL_SECONDS = 24 * 60 * 60
+    MIN_REFRESH_INTERVAL_SECONDS = 60
+
+    def __init__(
+        self,
+        key_url: str,
+        ttl_seconds: float = DEFAULT_TTL_SECONDS,
+        min_refresh_interval_seconds: float = MIN_REFRESH_INTERVAL_SECONDS,
+    ):
+        self.key_url = key_url
+        self.ttl_seconds = ttl_seconds
+        self.min_refresh_interval_seconds = min_refresh_interval_seconds
+        self.keys: dict[str, RSAPublicKey] = {}
+        self.fetched_at: Optional[float] = None
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self._lock = asyncio.Lock()
+
+    def is_expired(self) -> bool:
+        return self.fetched_at is None or time.monotonic() - self.fetched_at >= self.ttl_seconds
+
+    def can_force_refresh(self) -> bool:
+        return self.fetched_at is None or time.monotonic() - self.fetched_at >= self.min_refresh_interval_seconds
+
+    async def get_signing_key(self, kid: str) -> Optional[RSAPublicKey]:
+        if not self.is_expired() and kid in self.keys:
+            self.hits += 1
+            return self.keys[kid]
+
+        async with self._lock:
+            # Another request may have refreshed the keys while this one was waiting for the lock
+            if not self.is_expired() and kid in self.keys:
+                self.hits += 1
+                return self.keys[kid]
+            self.misses += 1
+            if self.is_expired() or self.can_force_refresh():
+                await self.refresh()
+        return self.keys.get(kid)
+
+    async def refresh(self):
+        jwks = await self.fetch_jwks()
+        keys: dict[str, RSAPublicKey] = {}
+        for key in jwks["keys"]:
+            if key.get("kty", "RSA") != "RSA" or "kid" not in key:
+                continue
+            try:
+                keys[key["kid"]] = rsa_public_key_from_jwk(key)
+            except (KeyError, ValueError):
+                logging.warning("Skipping malformed signing key %s from %s", key.get("kid"), self.key_url)
+        self.keys = keys
+        self.fetched_at = time.monotonic()
+        self.refreshes += 1
+
+    async def fetch_jwks(self) -> dict[str, Any]:
+        jwks = None
+        async for attempt in AsyncRetrying(
+            retry=retry_if_exception_type(AuthError),
+            wait=wait_random_exponential(min=15, max=60),
+            stop=stop_after_attempt(5),
+        ):
+            with attempt:
+                async with aiohttp.ClientSession() as session:
+                    async with session.get(url=self.key_url) as resp:
+                        resp_status = resp.status
+                        if resp_status in [500, 502, 503, 504]:
+                            raise AuthError(
+                                error=f"Failed to get keys info: {await resp.text()}", status_code=resp_status
+                            )
+                        jwks = await resp.json()
+
+        if not jwks or "keys" not in jwks:
+            raise AuthError("Unable to get keys to validate auth token.", 401)
+        return jwks
+
+
+class GroupMembershipCache:
+    """
+    Caches the groups each user belongs to, keyed by oid, so that users with a groups overage claim
+    don't trigger a full Microsoft Graph crawl on every request.
+    Concurrent lookups for the same user share a single crawl, and crawl latency and page counts are recorded.
+    """
+
+    DEFAULT_TTL_SECONDS = 5 * 60
+    DEFAULT_MAX_SIZE = 4096
+
+    def __init__(self, ttl_seconds: float = DEFAULT_TTL_SECONDS, max_size: int = DEFAULT_MAX_SIZE):
+        self.groups: LRUCache[str, list[str]] = LRUCache(max_size=max_size, ttl_seconds=ttl_seconds)
+        self.inflight: SingleFlight[str, list[str]] = SingleFlight()
+        self.crawl_count = 0
+        self.crawl_pages = 0
+        self.crawl_seconds = 0.0
+
+    async def get_groups(self, oid: str, crawl: Callable[[], Awaitable[tuple[list[str], int]]]) -> list[str]:
+        groups = self.groups.get(oid)
+        if groups is None:
+
+            async def crawl_and_store() -> list[str]:
+                start = time.monotonic()
+                groups, pages = await crawl()
+                elapsed = time.monotonic() - start
+                self.crawl_count += 1
+                self.crawl_pages += pages
+                self.crawl_seconds += elapsed
+                logging.info("Listed %d groups in %d pages from Microsoft Graph in %.2fs", len(groups), pages, elapsed)
+                self.groups.set(oid, groups)
+                return groups
+
+            groups = await self.inflight.do(oid, crawl_and_store)
+        return list(groups)
+
+
 class AuthenticationHelper:
     scope: str = "https://graph.microsoft.com/.default"
+    # Maximum number of distinct access tokens whose claims are kept in memory
+    AUTH_CLAIMS_CACHE_SIZE = 1024
+    # Stop serving cached claims slightly before the token itself expires, to allow for clock skew
+    AUTH_CLAIMS_EXPIRY_MARGIN_SECONDS = 30
+    # Maximum number of distinct users and groups whose security filters are kept in memory
+    SECURITY_FILTER_CACHE_SIZE = 1024
+    # How long a path authorization decision is reused, kept short so that permission changes apply quickly.
+    # Denials expire sooner, so that a newly uploaded or shared document becomes available soon after indexing
+    PATH_AUTH_CACHE_SIZE = 4096
+    PATH_AUTH_ALLOW_TTL_SECONDS = 60
+    PATH_AUTH_DENY_TTL_SECONDS = 10
 
     def __init__(
         self,
@@ -45,6 +192,8 @@ class AuthenticationHelper:
         require_access_control: bool = False,
         enable_global_documents: bool = False,
         enable_unauthenticated_access: bool = False,
+        auth_claims_cache_size: int = AUTH_CLAIMS_CACHE_SIZE,
+        groups_cache_ttl_seconds: float = GroupMembershipCache.DEFAULT_TTL_SECONDS,
     ):
         self.use_authentication = use_authentication
         self.server_app_id = server_app_id
@@ -61,6 +210,16 @@ class AuthenticationHelper:
         self.valid_audiences = [f"api://{server_app_id}", str(server_app_id)]
         # See https://learn.microsoft.com/entra/identity-platform/access-tokens#validate-the-issuer for more information on token validation
         self.key_url = f"{self.authority}/discovery/v2.0/keys"
+        # The signing keys are shared by every token the tenant issues, so they are fetched once and reused
+        self.jwks_cache = JwksCache(self.key_url)
+        # Claims computed for a validated token, keyed by a hash of the token, until the token expires
+        self.auth_claims_cache: LRUCache[str, dict[str, Any]] = LRUCache(max_size=auth_claims_cache_size)
+        # Group memberships read from Microsoft Graph, shared by all of a user's tokens
+        self.groups_cache = GroupMembershipCache(ttl_seconds=groups_cache_ttl_seconds)
+        # OData security filters, keyed by the user, their groups and which filters are in use
+        self.security_filter_cache: LRUCache[tuple, str] = LRUCache(max_size=self.SECURITY_FILTER_CACHE_SIZE)
+        # Whether a security filter matches a path, so repeat citation and image fetches don't each query the index
+        self.path_auth_cache: LRUCache[tuple[str, str], bool] = LRUCache(max_size=self.PATH_AUTH_CACHE_SIZE)
 
         if self.use_authentication:
             field_names = [field.name for field in search_index.fields] if search_index else []
@@ -150,6 +309,16 @@ class AuthenticationHelper:
                 error="oids and groups must be defined in the search index to use authentication", status_code=400
             )
 
+        fingerprint = (
+            auth_claims.get("oid", ""),
+            tuple(auth_claims.get("groups", [])),
+            bool(use_oid_security_filter),
+            bool(use_groups_security_filter),
+        )
+        cached_filter = self.security_filter_cache.get(fingerprint)
+        if cached_filter is not None:
+            return cached_filter
+
         oid_security_filter = (
             "oids/any(g:search.in(g, '{}'))".format(auth_claims.get("oid", "")) if use_oid_security_filter else None
         )
@@ -176,12 +345,23 @@ class AuthenticationHelper:
             if security_filter:
                 security_filter = f"({security_filter} or {global_documents_filter})"
 
+        if security_filter:
+            self.security_filter_cache.set(fingerprint, security_filter)
         return security_filter
 
     @staticmethod
     async def list_groups(graph_resource_access_token: dict) -> list[str]:
+        groups, _ = await AuthenticationHelper.crawl_groups(graph_resource_access_token)
+        return groups
+
+    @staticmethod
+    async def crawl_groups(graph_resource_access_token: dict) -> tuple[list[str], int]:
+        """
+        Pages through the groups the user is a transitive member of, returning the group ids and the number of pages read
+        """
         headers = {"Authorization": "Bearer " + graph_resource_access_token["access_token"]}
         groups = []
+        pages = 0
         async with aiohttp.ClientSession(headers=headers) as session:
             resp_json = None
             resp_status = None
@@ -192,6 +372,7 @@ class AuthenticationHelper:
                     raise AuthError(error=json.dumps(resp_json), status_code=resp_status)
 
             while resp_status == 200:
+                pages += 1
                 value = resp_json["value"]
                 for group in value:
                     groups.append(group["id"])
@@ -205,7 +386,12 @@ class AuthenticationHelper:
             if resp_status != 200:
                 raise AuthError(error=json.dumps(resp_json), status_code=resp_status)
 
-        return groups
+        return groups, pages
+
+    async def get_user_groups(self, oid: str, graph_resource_access_token: dict) -> list[str]:
+        return await self.groups_cache.get_groups(
+            oid, lambda: AuthenticationHelper.crawl_groups(graph_resource_access_token)
+        )
 
     async def get_auth_claims_if_enabled(self, headers: dict) -> dict[str, Any]:
         if not self.use_authentication:
@@ -215,13 +401,23 @@ class AuthenticationHelper:
             # The scope is set to the Microsoft Graph API, which may need to be called for more authorization information
             # https://learn.microsoft.com/entra/identity-platform/v2-oauth2-on-behalf-of-flow
             auth_token = AuthenticationHelper.get_token_auth_header(headers)
+            # A client sends the same token with every request until it expires,
+            # so the claims only need to be computed once per token
+            token_hash = hashlib.sha256(auth_token.encode("utf-8")).hexdigest()
+            cached_auth_claims = self.auth_claims_cache.get(token_hash)
+            if cached_auth_claims is not None:
+                return {**cached_auth_claims, "groups": list(cached_auth_claims["groups"])}
+
             # Validate the token before use
-            await self.validate_access_token(auth_token)
+            token_claims = await self.validate_access_token(auth_token)
 
             # Use the on-behalf-of-flow to acquire another token for use with Microsoft Graph
             # See https://learn.microsoft.com/entra/identity-platform/v2-oauth2-on-behalf-of-flow for more information
-            graph_resource_access_token = self.confidential_client.acquire_token_on_behalf_of(
-                user_assertion=auth_token, scopes=["https://graph.microsoft.com/.default"]
+            # MSAL is synchronous and may make a network call, so run it in a thread to avoid blocking the event loop
+            graph_resource_access_token = await asyncio.to_thread(
+                self.confidential_client.acquire_token_on_behalf_of,
+                user_assertion=auth_token,
+                scopes=["https://graph.microsoft.com/.default"],
             )
             if "error" in graph_resource_access_token:
                 raise AuthError(error=str(graph_resource_access_token), status_code=401)
@@ -242,7 +438,14 @@ class AuthenticationHelper:
             )
             if missing_groups_claim or has_group_overage_claim:
                 # Read the user's groups from Microsoft Graph
-                auth_claims["groups"] = await AuthenticationHelper.list_groups(graph_resource_access_token)
+                auth_claims["groups"] = await self.get_user_groups(auth_claims["oid"], graph_resource_access_token)
+
+            if token_claims and "exp" in token_claims:
+                self.auth_claims_cache.set(
+                    token_hash,
+                    {**auth_claims, "groups": list(auth_claims["groups"])},
+                    ttl_seconds=token_claims["exp"] - time.time() - self.AUTH_CLAIMS_EXPIRY_MARGIN_SECONDS,
+                )
             return auth_claims
         except AuthError as e:
             logging.exception("Exception getting authorization information - " + json.dumps(e.error))
@@ -271,6 +474,12 @@ class AuthenticationHelper:
         # Sourcepage is used for GPT-4V
         # Replace ' with '' to escape the single quote for the filter
         # https://learn.microsoft.com/azure/search/query-odata-filter-orderby-syntax#escaping-special-characters-in-string-constants
+        # The security filter already identifies the user and their groups, so it is used as the cache key
+        cache_key = (security_filter, path)
+        cached_decision = self.path_auth_cache.get(cache_key)
+        if cached_decision is not None:
+            return cached_decision
+
         path_for_filter = path.replace("'", "''")
         filter = f"{security_filter} and ((sourcefile eq '{path_for_filter}') or (sourcepage eq '{path_for_filter}'))"
 
@@ -282,50 +491,18 @@ class AuthenticationHelper:
             allowed = True
             break
 
+        self.path_auth_cache.set(
+            cache_key,
+            allowed,
+            ttl_seconds=self.PATH_AUTH_ALLOW_TTL_SECONDS if allowed else self.PATH_AUTH_DENY_TTL_SECONDS,
+        )
         return allowed
 
-    async def create_pem_format(self, jwks, token):
-        unverified_header = jwt.get_unverified_header(token)
-        for key in jwks["keys"]:
-            if key["kid"] == unverified_header["kid"]:
-                # Construct the RSA public key
-                public_numbers = rsa.RSAPublicNumbers(
-                    e=int.from_bytes(base64.urlsafe_b64decode(key["e"] + "=="), byteorder="big"),
-                    n=int.from_bytes(base64.urlsafe_b64decode(key["n"] + "=="), byteorder="big"),
-                )
-                public_key = public_numbers.public_key()
-
-                # Convert to PEM format
-                pem_key = public_key.public_bytes(
-                    encoding=serialization.Encoding.PEM, format=serialization.PublicFormat.SubjectPublicKeyInfo
-                )
-                rsa_key = pem_key
-                return rsa_key
-
     # See https://github.com/Azure-Samples/ms-identity-python-on-behalf-of/blob/939be02b11f1604814532fdacc2c2eccd198b755/FlaskAPI/helpers/authorization.py#L44
-    async def validate_access_token(self, token: str):
+    async def validate_access_token(self, token: str) -> dict[str, Any]:
         """
-        Validate an access token is issued by Entra
+        Validate an access token is issued by Entra, and return its verified claims
         """
-        jwks = None
-        async for attempt in AsyncRetrying(
-            retry=retry_if_exception_type(AuthError),
-            wait=wait_random_exponential(min=15, max=60),
-            stop=stop_after_attempt(5),
-        ):
-            with attempt:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url=self.key_url) as resp:
-                        resp_status = resp.status
-                        if resp_status in [500, 502, 503, 504]:
-                            raise AuthError(
-                                error=f"Failed to get keys info: {await resp.text()}", status_code=resp_status
-                            )
-                        jwks = await resp.json()
-
-        if not jwks or "keys" not in jwks:
-            raise AuthError("Unable to get keys to validate auth token.", 401)
-
         rsa_key = None
         issuer = None
         audience = None
@@ -333,8 +510,9 @@ class AuthenticationHelper:
             unverified_claims = jwt.decode(token, options={"verify_signature": False})
             issuer = unverified_claims.get("iss")
             audience = unverified_claims.get("aud")
-            rsa_key = await self.create_pem_format(jwks, token)
-        except jwt.PyJWTError as exc:
+            unverified_header = jwt.get_unverified_header(token)
+            rsa_key = await self.jwks_cache.get_signing_key(unverified_header["kid"])
+        except (jwt.PyJWTError, KeyError) as exc:
             raise AuthError("Unable to parse authorization token.", 401) from exc
         if not rsa_key:
             raise AuthError("Unable to find appropriate key", 401)
@@ -349,7 +527,7 @@ class AuthenticationHelper:
             )
 
         try:
-            jwt.decode(token, rsa_key, algorithms=["RS256"], audience=audience, issuer=issuer)
+            return jwt.decode(token, rsa_key, algorithms=["RS256"], audience=audience, issuer=issuer)
         except jwt.ExpiredSignatureError as jwt_expired_exc:
             raise AuthError("Token is expired", 401) from jwt_expired_exc
         except (jwt.InvalidAudienceError, jwt.InvalidIssuerError) as jwt_claims_exc:
@@ -0,0 +1,209 @@
+import asyncio
+import time
+from collections import OrderedDict
+from collections.abc import AsyncGenerator, AsyncIterator, Awaitable
+from typing import Callable, Generic, Optional, TypeVar
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """
+    A bounded, in-process least-recently-used cache whose entries can optionally expire.
+    It lives for the lifetime of the worker process and is not shared between workers.
+    It is safe to use from coroutines on a single event loop, as none of its operations await.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: Optional[float] = None):
+        if max_size <= 0:
+            raise ValueError("max_size must be greater than 0")
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[K, tuple[V, Optional[float]]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: K) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and not self._is_expired(entry[1])
+
+    @staticmethod
+    def _is_expired(expires_at: Optional[float]) -> bool:
+        return expires_at is not None and time.monotonic() >= expires_at
+
+    def get(self, key: K) -> Optional[V]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires_at = entry
+        if self._is_expired(expires_at):
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: K, value: V, ttl_seconds: Optional[float] = None):
+        """
+        Stores a value, evicting the least recently used entry if the cache is full.
+        ttl_seconds overrides the cache-wide TTL for this entry, and a non-positive TTL means the value is not stored.
+        """
+        ttl = ttl_seconds if ttl_seconds is not None else self.ttl_seconds
+        if ttl is not None and ttl <= 0:
+            self._entries.pop(key, None)
+            return
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: K) -> Optional[V]:
+        entry = self._entries.pop(key, None)
+        return entry[0] if entry is not None else None
+
+    def clear(self):
+        self._entries.clear()
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class SingleFlight(Generic[K, V]):
+    """
+    Deduplicates concurrent calls for the same key: the first caller starts the work,
+    and callers that arrive while it is still running await the same result instead of repeating it.
+    The work is shielded, so a cancelled caller doesn't cancel it for the others.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.shared_calls = 0
+        self._inflight: dict[K, asyncio.Future[V]] = {}
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    async def do(self, key: K, fn: Callable[[], Awaitable[V]]) -> V:
+        task = self._inflight.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+
+            def forget(done: asyncio.Future[V]):
+                if self._inflight.get(key) is done:
+                    del self._inflight[key]
+
+            task.add_done_callback(forget)
+        else:
+            self.shared_calls += 1
+        return await asyncio.shield(task)
+
+
+class SharedStream(Generic[V]):
+    """
+    A stream that is read once and replayed to every subscriber, each from its first item,
+    including subscribers that arrive after some of the items have been read.
+    The next item is only read once a subscriber asks for it, so the stream is read at the pace of its fastest subscriber.
+    """
+
+    def __init__(self, source: AsyncIterator[V]):
+        self.source = source
+        self.items: list[V] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self._reading: Optional[asyncio.Future[None]] = None
+
+    async def read_item(self):
+        try:
+            self.items.append(await self.source.__anext__())
+        except StopAsyncIteration:
+            self.done = True
+        except asyncio.CancelledError:
+            self.error = RuntimeError("The stream was no longer read once it had no subscribers")
+            self.done = True
+            await self.close_source()
+            raise
+        except Exception as error:
+            self.error = error
+            self.done = True
+        finally:
+            self._reading = None
+
+    async def close_source(self):
+        aclose = getattr(self.source, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+    async def subscribe(self) -> AsyncGenerator[V, None]:
+        self.subscribers += 1
+        index = 0
+        try:
+            while True:
+                if index < len(self.items):
+                    yield self.items[index]
+                    index += 1
+                elif self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                else:
+                    if self._reading is None:
+                        self._reading = asyncio.ensure_future(self.read_item())
+                    # The read is shielded, so a cancelled subscriber doesn't cancel it for the others
+                    await asyncio.shield(self._reading)
+        finally:
+            self.subscribers -= 1
+            # Once nobody is listening, the stream is no longer read
+            if self.subscribers == 0 and not self.done:
+                self.error = RuntimeError("The stream was no longer read once it had no subscribers")
+                self.done = True
+                if self._reading is not None:
+                    # The cancelled read closes the source once it stops
+                    self._reading.cancel()
+                else:
+                    await self.close_source()
+
+
+class SingleFlightStream(Generic[K, V]):
+    """
+    Deduplicates concurrent streams for the same key: the first caller starts reading the stream,
+    and callers that arrive while it is still being read get the items already read followed by the rest of it.
+    The stream is read until it ends or until every caller has stopped listening.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.shared_calls = 0
+        self._inflight: dict[K, SharedStream[V]] = {}
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    async def stream(self, key: K, fn: Callable[[], AsyncIterator[V]]) -> AsyncGenerator[V, None]:
+        shared_stream = self._inflight.get(key)
+        if shared_stream is None or shared_stream.done:
+            self.calls += 1
+            shared_stream = SharedStream(fn())
+            self._inflight[key] = shared_stream
+        else:
+            self.shared_calls += 1
+        subscription = shared_stream.subscribe()
+        try:
+            async for item in subscription:
+                yield item
+        finally:
+            # Closing the subscription right away, rather than when it's garbage collected, lets the stream stop
+            await subscription.aclose()
+            if shared_stream.done and self._inflight.get(key) is shared_stream:
+                del self._inflight[key]
@@ -0,0 +1,191 @@
+import asyncio
+import contextlib
+import inspect
+import logging
+import time
+from collections import defaultdict, deque
+from collections.abc import Awaitable, Iterator
+from contextvars import ContextVar
+from typing import Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+# When the current request must be answered by, as a time.monotonic() value
+current_deadline: ContextVar[Optional[float]] = ContextVar("current_deadline", default=None)
+
+
+class DependencyTimeoutError(TimeoutError):
+    """
+    Raised when a call to a dependency, such as Azure AI Search or Azure OpenAI, doesn't finish before the deadline.
+    """
+
+    def __init__(self, dependency: str):
+        super().__init__(f"The call to {dependency} didn't finish before the request deadline")
+        self.dependency = dependency
+
+
+@contextlib.contextmanager
+def deadline_scope(timeout_seconds: Optional[float]) -> Iterator[None]:
+    """
+    Sets the deadline for the calls made within the scope, unless an earlier deadline is already set.
+    """
+    previous_deadline = current_deadline.get()
+    if timeout_seconds is not None:
+        deadline = time.monotonic() + timeout_seconds
+        if previous_deadline is None or deadline < previous_deadline:
+            current_deadline.set(deadline)
+    try:
+        yield
+    finally:
+        # Restore the previous value rather than resetting a token,
+        # as a streamed response may be finished from a different context than it was started in
+        current_deadline.set(previous_deadline)
+
+
+def get_remaining_seconds() -> Optional[float]:
+    deadline = current_deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+class LatencyTracker:
+    """
+    Keeps the latencies of the most recent calls to a dependency, to estimate its percentiles.
+    """
+
+    def __init__(self, window_size: int):
+        self.latencies: deque[float] = deque(maxlen=window_size)
+
+    def __len__(self) -> int:
+        return len(self.latencies)
+
+    def record(self, seconds: float):
+        self.latencies.append(seconds)
+
+    def percentile(self, percentile: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(len(ordered) * percentile), len(ordered) - 1)]
+
+
+class DependencyCaller:
+    """
+    Calls dependencies within the deadline of the request being answered, counting the calls that time out.
+    With hedging enabled, a call still running after the dependency's recent p95 latency is raced against a backup
+    call, such as the same search sent again (likely to another replica) or a completion from a backup deployment.
+    Whichever finishes first is used and the other is cancelled.
+    """
+
+    DEFAULT_HEDGE_PERCENTILE = 0.95
+    # Latencies of this many recent calls are kept for each dependency
+    LATENCY_WINDOW_SIZE = 200
+    # Calls are only hedged once enough latencies are known to estimate the percentile
+    MIN_HEDGE_SAMPLES = 20
+    MIN_HEDGE_DELAY_SECONDS = 0.05
+
+    def __init__(
+        self,
+        request_timeout_seconds: Optional[float] = None,
+        hedge: bool = False,
+        hedge_percentile: float = DEFAULT_HEDGE_PERCENTILE,
+    ):
+        self.request_timeout_seconds = request_timeout_seconds
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.latencies: defaultdict[str, LatencyTracker] = defaultdict(lambda: LatencyTracker(self.LATENCY_WINDOW_SIZE))
+        self.timeouts: defaultdict[str, int] = defaultdict(int)
+        self.hedged_calls: defaultdict[str, int] = defaultdict(int)
+        self.backup_wins: defaultdict[str, int] = defaultdict(int)
+
+    def request_deadline(self) -> contextlib.AbstractContextManager[None]:
+        """
+        Sets the deadline for answering a request, which every dependency call made while answering it shares.
+        """
+        return deadline_scope(self.request_timeout_seconds)
+
+    def get_hedge_delay(self, dependency: str) -> Optional[float]:
+        latencies = self.latencies[dependency]
+        if len(latencies) < self.MIN_HEDGE_SAMPLES:
+            return None
+        delay = latencies.percentile(self.hedge_percentile)
+        return max(delay, self.MIN_HEDGE_DELAY_SECONDS) if delay is not None else None
+
+    async def call(
+        self,
+        dependency: str,
+        create_call: Callable[[], Awaitable[T]],
+        create_backup_call: Optional[Callable[[], Awaitable[T]]] = None,
+    ) -> T:
+        remaining_seconds = get_remaining_seconds()
+        if remaining_seconds is not None and remaining_seconds <= 0:
+            self.timeouts[dependency] += 1
+            raise DependencyTimeoutError(dependency)
+
+        start = time.monotonic()
+        try:
+            if self.hedge and create_backup_call is not None:
+                result = await asyncio.wait_for(
+                    self.call_hedged(dependency, create_call, create_backup_call), remaining_seconds
+                )
+            else:
+                result = await asyncio.wait_for(create_call(), remaining_seconds)
+        except asyncio.TimeoutError as error:
+            self.timeouts[dependency] += 1
+            raise DependencyTimeoutError(dependency) from error
+        self.latencies[dependency].record(time.monotonic() - start)
+        return result
+
+    async def call_hedged(
+        self,
+        dependency: str,
+        create_call: Callable[[], Awaitable[T]],
+        create_backup_call: Callable[[], Awaitable[T]],
+    ) -> T:
+        primary = asyncio.ensure_future(create_call())
+        hedge_delay = self.get_hedge_delay(dependency)
+        if hedge_delay is None:
+            return await primary
+
+        backup: Optional[asyncio.Future[T]] = None
+        winner: Optional[asyncio.Future[T]] = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=hedge_delay)
+            if done:
+                winner = primary
+                return primary.result()
+
+            self.hedged_calls[dependency] += 1
+            backup = asyncio.ensure_future(create_backup_call())
+            pending = {primary, backup}
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # A failed call only fails the hedged call if the other one fails too
+                succeeded = [call for call in done if call.exception() is None]
+                if succeeded or not pending:
+                    winner = succeeded[0] if succeeded else next(iter(done))
+                    if winner is backup and succeeded:
+                        self.backup_wins[dependency] += 1
+                    return winner.result()
+        finally:
+            for losing_call in (primary, backup):
+                if losing_call is None or losing_call is winner:
+                    continue
+                if not losing_call.done():
+                    losing_call.cancel()
+                else:
+                    # Both calls can finish in the same wait, so the loser's result, such as an open stream, is closed
+                    await self.discard_result(losing_call)
+
+    async def discard_result(self, call: "asyncio.Future[T]"):
+        if call.cancelled() or call.exception() is not None:
+            return
+        result = call.result()
+        close = getattr(result, "aclose", None) or getattr(result, "close", None)
+        if close is None:
+            return
+        try:
+            closed = close()
+            if inspect.isawaitable(closed):
+                await closed
+        except Exception:
+            logging.warning("Failed to close the result of a hedged call that lost the race", exc_info=True)
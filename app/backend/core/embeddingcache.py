@@ -0,0 +1,89 @@
+import hashlib
+import logging
+import time
+from array import array
+from collections.abc import Awaitable
+from typing import Callable, Optional
+
+from core.cache import LRUCache
+
+
+class EmbeddingCacheBackend:
+    """
+    A cache shared between workers or replicas, such as Redis, consulted when a vector isn't in the local cache.
+    Vectors are exchanged as the raw bytes of float32 arrays.
+    """
+
+    async def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: bytes) -> None:
+        raise NotImplementedError
+
+
+class EmbeddingCache:
+    """
+    Caches query embeddings, keyed by the embedding model, its dimensions and the whitespace-normalized text,
+    so that repeated questions don't each call the embeddings API.
+    Vectors are kept as float32 arrays in a local LRU cache, optionally backed by a shared backend.
+    """
+
+    DEFAULT_MAX_SIZE = 4096
+
+    def __init__(self, max_size: int = DEFAULT_MAX_SIZE, backend: Optional[EmbeddingCacheBackend] = None):
+        self.vectors: LRUCache[str, array] = LRUCache(max_size=max_size)
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.embedding_seconds = 0.0
+        self.latency_saved_seconds = 0.0
+
+    @staticmethod
+    def get_key(model: str, dimensions: Optional[int], text: str) -> str:
+        normalized_text = " ".join(text.split())
+        text_hash = hashlib.sha256(normalized_text.encode("utf-8")).hexdigest()
+        return f"{model}:{dimensions}:{text_hash}"
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    async def get_or_create(
+        self,
+        model: str,
+        dimensions: Optional[int],
+        text: str,
+        create_embedding: Callable[[], Awaitable[list[float]]],
+    ) -> list[float]:
+        key = self.get_key(model, dimensions, text)
+        vector = self.vectors.get(key)
+        if vector is None and self.backend:
+            try:
+                value = await self.backend.get(key)
+            except Exception as error:
+                logging.warning("Failed to read embedding from the shared cache: %s", error)
+                value = None
+            if value is not None:
+                vector = array("f")
+                vector.frombytes(value)
+                self.vectors.set(key, vector)
+
+        if vector is not None:
+            self.hits += 1
+            # Each hit saves roughly what an embeddings call has been taking on average
+            self.latency_saved_seconds += self.embedding_seconds / self.misses if self.misses else 0.0
+            return vector.tolist()
+
+        self.misses += 1
+        start = time.monotonic()
+        embedding = await create_embedding()
+        self.embedding_seconds += time.monotonic() - start
+        vector = array("f", embedding)
+        self.vectors.set(key, vector)
+        if self.backend:
+            try:
+                await self.backend.set(key, vector.tobytes())
+            except Exception as error:
+                logging.warning("Failed to write embedding to the shared cache: %s", error)
+        return embedding
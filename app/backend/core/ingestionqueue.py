@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from collections.abc import Awaitable
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Optional
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+
+INTERRUPTED_JOB_ERROR = "The app stopped before the file was ingested"
+
+
+@dataclass
+class IngestionStage:
+    name: str
+    status: str = JOB_RUNNING
+    started_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+
+
+@dataclass
+class IngestionJob:
+    """
+    The ingestion of a file that a user uploaded, with the progress of each of its stages.
+    Jobs only hold what's needed to read the file back from the user's storage, so that a durable store can persist them.
+    """
+
+    id: str
+    user_oid: str
+    filename: str
+    file_url: str
+    status: str = JOB_QUEUED
+    stages: list[IngestionStage] = field(default_factory=list)
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in (JOB_SUCCEEDED, JOB_FAILED)
+
+    def start_stage(self, name: str):
+        self.finish_stage(JOB_SUCCEEDED)
+        self.stages.append(IngestionStage(name=name))
+
+    def finish_stage(self, status: str):
+        if self.stages and self.stages[-1].finished_at is None:
+            self.stages[-1].status = status
+            self.stages[-1].finished_at = time.time()
+
+    def finish(self, status: str, error: Optional[str] = None):
+        self.finish_stage(status)
+        self.status = status
+        self.error = error
+        self.finished_at = time.time()
+
+    def to_dict(self) -> dict[str, Any]:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "IngestionJob":
+        stages = [IngestionStage(**stage) for stage in data.get("stages", [])]
+        return cls(**{**data, "stages": stages})
+
+
+class IngestionJobStore:
+    """
+    Where ingestion jobs are queued and their progress is kept.
+    Subclass it to keep jobs in a durable backend, such as a storage queue and table,
+    so that queued jobs survive restarts and their progress can be read from any instance of the app.
+    """
+
+    async def enqueue(self, job: IngestionJob):
+        raise NotImplementedError
+
+    async def dequeue(self) -> IngestionJob:
+        """
+        Waits for the next queued job.
+        """
+        raise NotImplementedError
+
+    async def save(self, job: IngestionJob):
+        raise NotImplementedError
+
+    async def get(self, job_id: str) -> Optional[IngestionJob]:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class InMemoryIngestionJobStore(IngestionJobStore):
+    """
+    Keeps jobs in process, so every job, whether queued, running or finished, is lost when the process stops
+    or restarts, including when Gunicorn restarts a worker after max_requests.
+    Only the most recent finished jobs are kept for their status to be read.
+    Jobs can only be read by the process that queued them, so the app must run a single worker process with this store.
+    """
+
+    def __init__(self, max_finished_jobs: int = 1000):
+        self.max_finished_jobs = max_finished_jobs
+        self.queue: asyncio.Queue[str] = asyncio.Queue()
+        self.jobs: dict[str, IngestionJob] = {}
+        self.finished_job_ids: OrderedDict[str, None] = OrderedDict()
+
+    async def enqueue(self, job: IngestionJob):
+        self.jobs[job.id] = job
+        self.queue.put_nowait(job.id)
+
+    async def dequeue(self) -> IngestionJob:
+        while True:
+            job_id = await self.queue.get()
+            if job := self.jobs.get(job_id):
+                return job
+
+    async def save(self, job: IngestionJob):
+        self.jobs[job.id] = job
+        if job.is_finished:
+            self.finished_job_ids[job.id] = None
+            while len(self.finished_job_ids) > self.max_finished_jobs:
+                finished_job_id, _ = self.finished_job_ids.popitem(last=False)
+                self.jobs.pop(finished_job_id, None)
+
+    async def get(self, job_id: str) -> Optional[IngestionJob]:
+        return self.jobs.get(job_id)
+
+    async def close(self):
+        # Queued jobs are lost with the process, so they're failed rather than left queued forever
+        for job in self.jobs.values():
+            if job.status == JOB_QUEUED:
+                job.finish(JOB_FAILED, INTERRUPTED_JOB_ERROR)
+
+
+# Processes a job, calling the given function as it starts each stage
+IngestionProcessor = Callable[[IngestionJob, Callable[[str], Awaitable[None]]], Awaitable[None]]
+
+
+class IngestionQueue:
+    """
+    Ingests uploaded files in the background, so that the upload request returns as soon as the file is stored
+    rather than waiting for parsing, embedding and indexing.
+    A fixed number of workers process the queued jobs, which bounds the load that ingestion puts on the app
+    and on the services it calls.
+    """
+
+    # How long a worker waits after an unexpected failure, so that a store that keeps failing isn't called in a loop
+    WORKER_RETRY_DELAY_SECONDS = 1.0
+
+    def __init__(
+        self,
+        process: IngestionProcessor,
+        store: Optional[IngestionJobStore] = None,
+        concurrency: int = 2,
+        on_job_finished: Optional[Callable[[IngestionJob], None]] = None,
+    ):
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        self.process = process
+        self.store = store or InMemoryIngestionJobStore()
+        self.concurrency = concurrency
+        self.on_job_finished = on_job_finished
+        self.workers: list[asyncio.Task] = []
+        self.jobs_succeeded = 0
+        self.jobs_failed = 0
+
+    def start(self):
+        if not self.workers:
+            self.workers = [asyncio.create_task(self.run_worker()) for _ in range(self.concurrency)]
+
+    async def close(self):
+        # Running jobs are failed as their workers are cancelled
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        await self.store.close()
+
+    async def submit(self, user_oid: str, filename: str, file_url: str) -> IngestionJob:
+        job = IngestionJob(id=str(uuid.uuid4()), user_oid=user_oid, filename=filename, file_url=file_url)
+        await self.store.enqueue(job)
+        return job
+
+    async def get_job(self, job_id: str, user_oid: str) -> Optional[IngestionJob]:
+        """
+        Returns the job if it belongs to the user.
+        """
+        job = await self.store.get(job_id)
+        if job is None or job.user_oid != user_oid:
+            return None
+        return job
+
+    async def run_worker(self):
+        while True:
+            try:
+                job = await self.store.dequeue()
+                await self.run_job(job)
+            except Exception:
+                # A failure of the store or of the callback mustn't stop the worker for good
+                logging.exception("Ingestion worker failed, continuing with the next job")
+                await asyncio.sleep(self.WORKER_RETRY_DELAY_SECONDS)
+
+    async def run_job(self, job: IngestionJob):
+        async def start_stage(name: str):
+            job.start_stage(name)
+            await self.store.save(job)
+
+        try:
+            job.status = JOB_RUNNING
+            await self.store.save(job)
+            await self.process(job, start_stage)
+        except asyncio.CancelledError:
+            # The queue was closed, such as when the app is stopping, so the job won't finish
+            job.finish(JOB_FAILED, INTERRUPTED_JOB_ERROR)
+            self.jobs_failed += 1
+            try:
+                await self.store.save(job)
+            except Exception:
+                # The worker must still stop, rather than go on to the next job
+                logging.exception("Failed to save interrupted ingestion job %s", job.id)
+            raise
+        except Exception as error:
+            logging.exception("Failed to ingest %s", job.filename)
+            job.finish(JOB_FAILED, str(error))
+            self.jobs_failed += 1
+        else:
+            job.finish(JOB_SUCCEEDED)
+            self.jobs_succeeded += 1
+        await self.store.save(job)
+        if self.on_job_finished:
+            self.on_job_finished(job)
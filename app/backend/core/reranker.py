@@ -0,0 +1,63 @@
+import math
+import re
+from collections import Counter
+from collections.abc import Sequence
+
+
+class BM25Reranker:
+    """
+    Reranks search results in process, for when the semantic ranker isn't used:
+    more results than needed are fetched, each is scored by BM25 of the query against its content,
+    and the best are kept. Results that score the same, such as those only found by vector search,
+    stay in the order of the search.
+    """
+
+    # BM25 parameters, with the defaults used by Azure AI Search
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, candidates_factor: int = 3):
+        if candidates_factor < 1:
+            raise ValueError("candidates_factor must be at least 1")
+        self.candidates_factor = candidates_factor
+
+    @staticmethod
+    def tokenize(text: str) -> list[str]:
+        return re.findall(r"\w+", text.casefold())
+
+    def get_candidate_count(self, top: int) -> int:
+        return top * self.candidates_factor
+
+    def score(self, query: str, texts: Sequence[str]) -> list[float]:
+        """
+        Scores each text by BM25, with term frequencies taken from the texts themselves.
+        """
+        query_terms = set(self.tokenize(query))
+        term_counts = [Counter(self.tokenize(text)) for text in texts]
+        if not query_terms or not term_counts:
+            return [0.0] * len(texts)
+        lengths = [sum(counts.values()) for counts in term_counts]
+        average_length = sum(lengths) / len(lengths) or 1.0
+        idf = {}
+        for term in query_terms:
+            document_frequency = sum(1 for counts in term_counts if term in counts)
+            idf[term] = math.log(1 + (len(texts) - document_frequency + 0.5) / (document_frequency + 0.5))
+        scores = []
+        for counts, length in zip(term_counts, lengths):
+            length_norm = self.K1 * (1 - self.B + self.B * length / average_length)
+            scores.append(
+                sum(
+                    idf[term] * counts[term] * (self.K1 + 1) / (counts[term] + length_norm)
+                    for term in query_terms
+                    if term in counts
+                )
+            )
+        return scores
+
+    def rank(self, query: str, texts: Sequence[str]) -> list[int]:
+        """
+        Returns the indexes of the texts, which are in the order the search returned them, from best to worst.
+        """
+        scores = self.score(query, texts)
+        # Sorting is stable, so ties keep the order of the search
+        return sorted(range(len(texts)), key=lambda index: -scores[index])
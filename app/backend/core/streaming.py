@@ -0,0 +1,104 @@
+import asyncio
+from collections.abc import AsyncGenerator, AsyncIterator
+from json.encoder import encode_basestring
+from typing import Any, Optional
+
+# Delta events are by far the most frequent events in a stream, so they are written from templates
+# instead of going through json.dumps, producing the same output: {"delta": {"content": "...", "role": "..."}}
+DELTA_EVENT_PREFIX = '{"delta": {"content": '
+DELTA_EVENT_SUFFIXES = {
+    "assistant": ', "role": "assistant"}}\n',
+    None: ', "role": null}}\n',
+}
+
+
+def get_delta(event: dict[str, Any]) -> Optional[dict[str, Any]]:
+    """
+    Returns the delta of an event that only carries a delta's content and role, which can be written from a template.
+    """
+    if len(event) != 1:
+        return None
+    delta = event.get("delta")
+    if type(delta) is not dict or tuple(delta) != ("content", "role") or delta["role"] not in DELTA_EVENT_SUFFIXES:
+        return None
+    content = delta["content"]
+    if content is not None and type(content) is not str:
+        return None
+    return delta
+
+
+def encode_delta_event(event: dict[str, Any]) -> Optional[str]:
+    """
+    Encodes a delta event as a line of NDJSON, or returns None if the event needs the regular JSON encoder.
+    """
+    delta = get_delta(event)
+    if delta is None:
+        return None
+    content = delta["content"]
+    encoded_content = "null" if content is None else encode_basestring(content)
+    return DELTA_EVENT_PREFIX + encoded_content + DELTA_EVENT_SUFFIXES[delta["role"]]
+
+
+async def coalesce_delta_events(
+    events: AsyncIterator[dict[str, Any]], max_delay_seconds: float, max_chars: int
+) -> AsyncGenerator[dict[str, Any], None]:
+    """
+    Merges consecutive delta events with the same role into a single event, which is sent once its content
+    reaches max_chars or max_delay_seconds after its first delta arrived, whichever comes first.
+    Any other event sends the merged delta before it, so the order of the content is unchanged.
+    """
+    loop = asyncio.get_running_loop()
+    iterator = events.__aiter__()
+    contents: list[str] = []
+    content_size = 0
+    role: Optional[str] = None
+    deadline = 0.0
+    next_event: Optional[asyncio.Future[dict[str, Any]]] = None
+
+    def flush() -> dict[str, Any]:
+        nonlocal content_size
+        merged = {"delta": {"content": "".join(contents), "role": role}}
+        contents.clear()
+        content_size = 0
+        return merged
+
+    try:
+        while True:
+            if contents:
+                # Wait for the next event only until the merged delta is due
+                if next_event is None:
+                    next_event = asyncio.ensure_future(iterator.__anext__())
+                done, _ = await asyncio.wait({next_event}, timeout=max(deadline - loop.time(), 0))
+                if not done:
+                    yield flush()
+                    continue
+            try:
+                if next_event is not None:
+                    event = await next_event
+                else:
+                    event = await iterator.__anext__()
+            except StopAsyncIteration:
+                break
+            finally:
+                next_event = None
+
+            delta = get_delta(event)
+            if delta is None or delta["content"] is None:
+                if contents:
+                    yield flush()
+                yield event
+                continue
+            if contents and delta["role"] != role:
+                yield flush()
+            if not contents:
+                role = delta["role"]
+                deadline = loop.time() + max_delay_seconds
+            contents.append(delta["content"])
+            content_size += len(delta["content"])
+            if content_size >= max_chars:
+                yield flush()
+        if contents:
+            yield flush()
+    finally:
+        if next_event is not None:
+            next_event.cancel()
@@ -1,3 +1,5 @@
+import os
+
 from uvicorn.workers import UvicornWorker
 
 logconfig_dict = {
@@ -45,3 +47,8 @@ class CustomUvicornWorker(UvicornWorker):
     CONFIG_KWARGS = {
         "log_config": logconfig_dict,
     }
+
+    def init_process(self):
+        # Lets the app reject settings that only work with a single worker process
+        os.environ["GUNICORN_WORKERS"] = str(self.cfg.workers)
+        super().init_process()
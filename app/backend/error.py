@@ -3,6 +3,8 @@ import logging
 from openai import APIError
 from quart import jsonify
 
+from core.deadlines import DependencyTimeoutError
+
 ERROR_MESSAGE = """The app encountered an error processing your request.
 If you are an administrator of the app, check the application logs for a full traceback.
 Error type: {error_type}
@@ -11,12 +13,16 @@ ERROR_MESSAGE_FILTER = """Your message contains content that was flagged by the
 
 ERROR_MESSAGE_LENGTH = """Your message exceeded the context length limit for this OpenAI model. Please shorten your message or change your settings to retrieve fewer search results."""
 
+ERROR_MESSAGE_TIMEOUT = """The app took too long to answer your request. Please try again."""
+
 
 def error_dict(error: Exception) -> dict:
     if isinstance(error, APIError) and error.code == "content_filter":
         return {"error": ERROR_MESSAGE_FILTER}
     if isinstance(error, APIError) and error.code == "context_length_exceeded":
         return {"error": ERROR_MESSAGE_LENGTH}
+    if isinstance(error, DependencyTimeoutError):
+        return {"error": ERROR_MESSAGE_TIMEOUT}
     return {"error": ERROR_MESSAGE.format(error_type=type(error))}
 
 
@@ -24,4 +30,6 @@ def error_response(error: Exception, route: str, status_code: int = 500):
     logging.exception("Exception in %s: %s", route, error)
     if isinstance(error, APIError) and error.code == "content_filter":
         status_code = 400
+    elif isinstance(error, DependencyTimeoutError):
+        status_code = 504
     return jsonify(error_dict(error)), status_code
@@ -6,10 +6,11 @@ from enum import Enum
 from typing import Optional, Union
 
 import aiohttp
+import httpx
 from azure.core.credentials import AzureKeyCredential
 from azure.core.credentials_async import AsyncTokenCredential
 from azure.identity.aio import AzureDeveloperCliCredential, get_bearer_token_provider
-from openai import AsyncAzureOpenAI, AsyncOpenAI
+from openai import AsyncAzureOpenAI, AsyncOpenAI, DefaultAsyncHttpxClient
 from rich.logging import RichHandler
 
 from load_azd_env import load_azd_env
@@ -32,12 +33,18 @@ from prepdocslib.listfilestrategy import (
     ListFileStrategy,
     LocalListFileStrategy,
 )
+from prepdocslib.openailoadbalancer import (
+    LoadBalancingTransport,
+    OpenAIBackend,
+    parse_openai_backends,
+)
 from prepdocslib.parser import Parser
 from prepdocslib.pdfparser import (
     DocumentAnalysisParser,
     LocalPdfParser,
     MediaDescriptionStrategy,
 )
+from prepdocslib.ratelimiter import RateLimitingTransport, TokenBucketRateLimiter
 from prepdocslib.strategy import DocumentAction, SearchInfo, Strategy
 from prepdocslib.textparser import TextParser
 from prepdocslib.textsplitter import SentenceTextSplitter, SimpleTextSplitter
@@ -169,6 +176,8 @@ def setup_embeddings_service(
     openai_org: Union[str, None],
     disable_vectors: bool = False,
     disable_batch_vectors: bool = False,
+    azure_openai_backends: Optional[list[OpenAIBackend]] = None,
+    openai_rate_limiters: Optional[dict[str, TokenBucketRateLimiter]] = None,
 ):
     if disable_vectors:
         logger.info("Not setting up embeddings service")
@@ -187,6 +196,8 @@ def setup_embeddings_service(
             open_ai_api_version=azure_openai_api_version,
             credential=azure_open_ai_credential,
             disable_batch=disable_batch_vectors,
+            open_ai_backends=azure_openai_backends,
+            rate_limiters=openai_rate_limiters,
         )
     else:
         if openai_key is None:
@@ -197,6 +208,7 @@ def setup_embeddings_service(
             credential=openai_key,
             organization=openai_org,
             disable_batch=disable_batch_vectors,
+            rate_limiters=openai_rate_limiters,
         )
 
 
@@ -209,6 +221,8 @@ def setup_openai_client(
     azure_openai_custom_url: Union[str, None] = None,
     openai_api_key: Union[str, None] = None,
     openai_organization: Union[str, None] = None,
+    azure_openai_backends: Optional[list[OpenAIBackend]] = None,
+    openai_rate_limiters: Optional[dict[str, TokenBucketRateLimiter]] = None,
 ):
     if openai_host not in OpenAIHost:
         raise ValueError(f"Invalid OPENAI_HOST value: {openai_host}. Must be one of {[h.value for h in OpenAIHost]}.")
@@ -226,10 +240,20 @@ def setup_openai_client(
             if not azure_openai_service:
                 raise ValueError("AZURE_OPENAI_SERVICE must be set when OPENAI_HOST is azure")
             endpoint = f"https://{azure_openai_service}.openai.azure.com"
+        transport: Optional[httpx.AsyncBaseTransport] = None
+        if azure_openai_backends:
+            logger.info("AZURE_OPENAI_BACKENDS found, spreading Azure OpenAI calls across backends")
+            transport = LoadBalancingTransport.for_endpoint(endpoint, azure_openai_backends, openai_rate_limiters)
+        elif openai_rate_limiters:
+            transport = RateLimitingTransport(openai_rate_limiters)
+        http_client = DefaultAsyncHttpxClient(transport=transport) if transport else None
         if azure_openai_api_key:
             logger.info("AZURE_OPENAI_API_KEY_OVERRIDE found, using as api_key for Azure OpenAI client")
             openai_client = AsyncAzureOpenAI(
-                api_version=azure_openai_api_version, azure_endpoint=endpoint, api_key=azure_openai_api_key
+                api_version=azure_openai_api_version,
+                azure_endpoint=endpoint,
+                api_key=azure_openai_api_key,
+                http_client=http_client,
             )
         else:
             logger.info("Using Azure credential (passwordless authentication) for Azure OpenAI client")
@@ -238,6 +262,7 @@ def setup_openai_client(
                 api_version=azure_openai_api_version,
                 azure_endpoint=endpoint,
                 azure_ad_token_provider=token_provider,
+                http_client=http_client,
             )
     elif openai_host == OpenAIHost.LOCAL:
         logger.info("OPENAI_HOST is local, setting up local OpenAI client for OPENAI_BASE_URL with no key")
@@ -254,10 +279,39 @@ def setup_openai_client(
         openai_client = AsyncOpenAI(
             api_key=openai_api_key,
             organization=openai_organization,
+            http_client=(
+                DefaultAsyncHttpxClient(transport=RateLimitingTransport(openai_rate_limiters))
+                if openai_rate_limiters
+                else None
+            ),
         )
     return openai_client
 
 
+def setup_openai_rate_limiters(
+    chatgpt_deployment: Union[str, None],
+    chatgpt_deployment_capacity: int,
+    emb_deployment: Union[str, None],
+    emb_deployment_capacity: int,
+    processes: int = 1,
+) -> dict[str, TokenBucketRateLimiter]:
+    """
+    Sets up rate limiters for the chat and embedding deployments (or for OpenAI.com, models),
+    given their capacity in thousands of tokens per minute, as for the deployments in main.bicep.
+    The capacity is split evenly between the given number of processes that call the deployments.
+    """
+    rate_limiters = {}
+    if chatgpt_deployment:
+        rate_limiters[chatgpt_deployment] = TokenBucketRateLimiter(
+            tokens_per_minute=max(chatgpt_deployment_capacity * 1000 // processes, 1)
+        )
+    if emb_deployment and emb_deployment not in rate_limiters:
+        rate_limiters[emb_deployment] = TokenBucketRateLimiter(
+            tokens_per_minute=max(emb_deployment_capacity * 1000 // processes, 1)
+        )
+    return rate_limiters
+
+
 def setup_file_processors(
     azure_credential: AsyncTokenCredential,
     document_intelligence_service: Union[str, None],
@@ -511,6 +565,25 @@ if __name__ == "__main__":
 
     # https://learn.microsoft.com/azure/ai-services/openai/api-version-deprecation#latest-ga-api-release
     azure_openai_api_version = os.getenv("AZURE_OPENAI_API_VERSION") or "2024-06-01"
+    # Other Azure OpenAI endpoints that calls are spread across, as a JSON list
+    azure_openai_backends = parse_openai_backends(os.getenv("AZURE_OPENAI_BACKENDS"))
+    openai_rate_limiters = None
+    if os.getenv("USE_OPENAI_RATE_LIMITER", "").lower() == "true":
+        is_azure_openai = OPENAI_HOST in [OpenAIHost.AZURE, OpenAIHost.AZURE_CUSTOM]
+        openai_rate_limiters = setup_openai_rate_limiters(
+            chatgpt_deployment=(
+                os.getenv("AZURE_OPENAI_CHATGPT_DEPLOYMENT")
+                if is_azure_openai
+                else os.getenv("AZURE_OPENAI_CHATGPT_MODEL")
+            ),
+            chatgpt_deployment_capacity=int(os.getenv("AZURE_OPENAI_CHATGPT_DEPLOYMENT_CAPACITY") or 30),
+            emb_deployment=(
+                os.getenv("AZURE_OPENAI_EMB_DEPLOYMENT")
+                if is_azure_openai
+                else os.environ["AZURE_OPENAI_EMB_MODEL_NAME"]
+            ),
+            emb_deployment_capacity=int(os.getenv("AZURE_OPENAI_EMB_DEPLOYMENT_CAPACITY") or 30),
+        )
     emb_model_dimensions = 1536
     if os.getenv("AZURE_OPENAI_EMB_DIMENSIONS"):
         emb_model_dimensions = int(os.environ["AZURE_OPENAI_EMB_DIMENSIONS"])
@@ -528,6 +601,8 @@ if __name__ == "__main__":
         openai_org=os.getenv("OPENAI_ORGANIZATION"),
         disable_vectors=dont_use_vectors,
         disable_batch_vectors=args.disablebatchvectors,
+        azure_openai_backends=azure_openai_backends,
+        openai_rate_limiters=openai_rate_limiters,
     )
     openai_client = setup_openai_client(
         openai_host=OPENAI_HOST,
@@ -538,6 +613,8 @@ if __name__ == "__main__":
         azure_openai_api_key=os.getenv("AZURE_OPENAI_API_KEY_OVERRIDE"),
         openai_api_key=clean_key_if_exists(os.getenv("OPENAI_API_KEY")),
         openai_organization=os.getenv("OPENAI_ORGANIZATION"),
+        azure_openai_backends=azure_openai_backends,
+        openai_rate_limiters=openai_rate_limiters,
     )
 
     ingestion_strategy: Strategy
@@ -0,0 +1,226 @@
+import asyncio
+import hashlib
+import logging
+import mmap
+import os
+import tempfile
+import time
+from collections.abc import AsyncIterator
+from typing import Callable, Optional
+
+logger = logging.getLogger("scripts")
+
+
+class BlobContentCache:
+    """
+    A size-bounded cache of blob contents on local disk, so that the documents and images that are cited
+    over and over are downloaded from Azure Storage once per version rather than once per request.
+    Files are named by a hash of the blob's location and ETag, so a blob that changed is never served
+    from an older copy, and the least recently used files are removed once the cache grows past its maximum size.
+    Several processes can share the directory: they serve each other's files and keep it under the maximum size together.
+    A blob that isn't cached is downloaded to the cache in the background, so the request that found it missing
+    doesn't wait for the whole blob.
+    Cached files are read through mmap, so serving a range of a file only reads the pages of that range from disk.
+
+    The cache doesn't check access: a blob must only be read from it after getting the blob's properties,
+    which applies the same access checks as downloading it and gives the ETag to look it up with.
+    """
+
+    # Blobs larger than this fraction of the cache are streamed from storage instead,
+    # so that a single large file doesn't evict everything else
+    MAX_ENTRY_FRACTION = 0.25
+    TEMP_FILE_SUFFIX = ".tmp"
+    # Temporary files that haven't been written to for this long are left over from downloads that didn't finish
+    STALE_TEMP_FILE_SECONDS = 60 * 60
+    # Other processes sharing the directory add files that the running total doesn't count,
+    # so the directory is scanned again after this long even if the total stays under the maximum size
+    RESCAN_INTERVAL_SECONDS = 60.0
+
+    def __init__(self, directory: str, max_size_bytes: int):
+        if max_size_bytes <= 0:
+            raise ValueError("max_size_bytes must be greater than 0")
+        self.directory = directory
+        self.max_size_bytes = max_size_bytes
+        # The worker processes of the app can share the directory, so what's cached is always read from the directory
+        # rather than tracked in process. The size of the cache is the total found by the last scan,
+        # plus the files this process has cached since.
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._fills: dict[str, asyncio.Task[None]] = {}
+        self._evicting = False
+        # Temporary files are named after the process writing them
+        self.temp_file_prefix = f"{os.getpid()}-"
+        self.started_at = time.time()
+        os.makedirs(self.directory, exist_ok=True)
+        self.scanned_at = time.monotonic()
+        self.size_bytes = self.evict()
+
+    @staticmethod
+    def get_key(location: str, etag: str) -> str:
+        return hashlib.sha256(f"{location}\n{etag}".encode()).hexdigest()
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def can_store(self, size: int) -> bool:
+        return 0 < size <= self.max_size_bytes * self.MAX_ENTRY_FRACTION
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def mark_used(self, path: str):
+        # The modification time orders the files from least to most recently used, for every process
+        now = time.time_ns()
+        try:
+            os.utime(path, ns=(now, now))
+        except OSError:
+            pass
+
+    def open(self, key: str) -> Optional[mmap.mmap]:
+        path = self.get_path(key)
+        try:
+            with open(path, "rb") as file:
+                mapped_file = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # The file isn't cached, was evicted by another process, or was emptied outside of the cache
+            return None
+        self.mark_used(path)
+        return mapped_file
+
+    async def get(self, location: str, etag: str) -> Optional[mmap.mmap]:
+        """
+        Opens the cached copy of a blob, returning a mapping of it that stays readable
+        even if another process evicts the file right away, or None if it isn't cached.
+        """
+        mapped_file = await asyncio.to_thread(self.open, self.get_key(location, etag))
+        if mapped_file is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return mapped_file
+
+    def fill(self, location: str, etag: str, size: int, download: Callable[[], AsyncIterator[bytes]]):
+        """
+        Starts downloading a blob into the cache in the background with the given function,
+        unless this process is already downloading it.
+        """
+        key = self.get_key(location, etag)
+        if key in self._fills:
+            return
+        task = asyncio.create_task(self.fill_in_background(location, key, size, download))
+        self._fills[key] = task
+        task.add_done_callback(lambda _: self._fills.pop(key, None))
+
+    async def fill_in_background(
+        self, location: str, key: str, size: int, download: Callable[[], AsyncIterator[bytes]]
+    ):
+        try:
+            await self.store(key, size, download())
+        except Exception as error:
+            # The blob is downloaded again the next time it's requested
+            logger.warning("Couldn't cache the content of %s: %s", location, error)
+
+    async def close(self):
+        """
+        Stops the downloads in progress, which use the storage clients that are closed next.
+        """
+        fills = list(self._fills.values())
+        for task in fills:
+            task.cancel()
+        await asyncio.gather(*fills, return_exceptions=True)
+
+    async def store(self, key: str, size: int, chunks: AsyncIterator[bytes]):
+        """
+        Downloads the content into the cache, then removes the least recently used files if the cache is full.
+        """
+        # The content is written to a temporary file first, so that a partial download is never served
+        file_descriptor, temp_path = await asyncio.to_thread(
+            tempfile.mkstemp, dir=self.directory, prefix=self.temp_file_prefix, suffix=self.TEMP_FILE_SUFFIX
+        )
+        file = os.fdopen(file_descriptor, "wb")
+        try:
+            try:
+                async for chunk in chunks:
+                    await asyncio.to_thread(file.write, chunk)
+            finally:
+                # Closing the file writes what's left in its buffer
+                await asyncio.to_thread(file.close)
+            await asyncio.to_thread(self.commit, temp_path, key, size)
+        except BaseException:
+            await asyncio.to_thread(self.remove_file, temp_path)
+            raise
+        self.size_bytes += size
+        if self._evicting:
+            return
+        if self.size_bytes > self.max_size_bytes or time.monotonic() - self.scanned_at > self.RESCAN_INTERVAL_SECONDS:
+            self._evicting = True
+            try:
+                self.scanned_at = time.monotonic()
+                self.size_bytes = await asyncio.to_thread(self.evict)
+            finally:
+                self._evicting = False
+
+    def commit(self, temp_path: str, key: str, size: int):
+        written = os.path.getsize(temp_path)
+        if written != size:
+            raise ValueError(f"Expected {size} bytes but downloaded {written} bytes")
+        self.mark_used(temp_path)
+        os.replace(temp_path, self.get_path(key))
+
+    def is_abandoned(self, name: str, modified_at: float) -> bool:
+        """
+        Whether a temporary file is left over from a download that didn't finish, rather than being written
+        by a download in progress in this or another process.
+        """
+        if modified_at < time.time() - self.STALE_TEMP_FILE_SECONDS:
+            return True
+        # A previous process with the same ID can only have left its files before this one started
+        return name.startswith(self.temp_file_prefix) and modified_at < self.started_at
+
+    def scan(self) -> list[tuple[int, str, int]]:
+        """
+        Lists the modification times, names and sizes of the cached files, from the least to the most recently used,
+        removing abandoned temporary files along the way.
+        """
+        files = []
+        for entry in os.scandir(self.directory):
+            try:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+            except FileNotFoundError:
+                # Removed by another process during the scan
+                continue
+            if entry.name.endswith(self.TEMP_FILE_SUFFIX):
+                if self.is_abandoned(entry.name, stat.st_mtime):
+                    self.remove_file(entry.path)
+                continue
+            files.append((stat.st_mtime_ns, entry.name, stat.st_size))
+        return sorted(files)
+
+    def evict(self) -> int:
+        """
+        Removes the least recently used files until the files in the directory, including those
+        cached by other processes, fit in the maximum size, and returns the size of the files that are left.
+        """
+        files = self.scan()
+        size_bytes = sum(size for _, _, size in files)
+        for _, key, size in files:
+            if size_bytes <= self.max_size_bytes:
+                break
+            # Files that are being served stay readable through their open mappings
+            self.remove_file(self.get_path(key))
+            size_bytes -= size
+        return size_bytes
+
+    def remove_file(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # Already removed by another process sharing the directory
+            pass
+        except OSError as error:
+            logger.warning("Couldn't remove cached file %s: %s", path, error)
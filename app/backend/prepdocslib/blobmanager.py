@@ -1,20 +1,34 @@
+import asyncio
 import io
 import logging
 import os
 import re
+import time
+from collections import OrderedDict
+from collections.abc import AsyncGenerator
+from contextvars import ContextVar
 from pathlib import Path
 from typing import IO, Any, Optional, TypedDict, Union
 from urllib.parse import unquote
 
+from azure.core import MatchConditions
 from azure.core.credentials_async import AsyncTokenCredential
-from azure.core.exceptions import ResourceNotFoundError
-from azure.storage.blob.aio import BlobServiceClient
+from azure.core.exceptions import (
+    HttpResponseError,
+    ResourceExistsError,
+    ResourceNotFoundError,
+)
+from azure.core.pipeline import PipelineRequest
+from azure.storage.blob import StorageErrorCode
+from azure.storage.blob.aio import BlobClient, BlobServiceClient, ContainerClient
 from azure.storage.filedatalake.aio import (
     DataLakeDirectoryClient,
+    DataLakeFileClient,
     FileSystemClient,
 )
 from PIL import Image, ImageDraw, ImageFont
 
+from .blobcache import BlobContentCache
 from .listfilestrategy import File
 
 logger = logging.getLogger("scripts")
@@ -24,6 +38,24 @@ class BlobProperties(TypedDict, total=False):
     """Properties of a blob, with optional fields for content settings"""
 
     content_settings: dict[str, Any]
+    etag: Optional[str]
+    size: int
+
+
+class StorageCallCounter:
+    """Counts the calls made to Azure Storage, including retries"""
+
+    def __init__(self):
+        self.calls = 0
+
+
+# The counter for the calls to Azure Storage made within the current context, such as a request to the app
+current_storage_calls: ContextVar[Optional[StorageCallCounter]] = ContextVar("current_storage_calls", default=None)
+
+
+def record_storage_call(request: PipelineRequest):
+    if (storage_calls := current_storage_calls.get()) is not None:
+        storage_calls.calls += 1
 
 
 class BaseBlobManager:
@@ -31,6 +63,10 @@ class BaseBlobManager:
     Base class for Azure Storage operations, providing common file naming and path utilities
     """
 
+    # Blobs are streamed in ranges of this size, so that large files are never held in memory as a whole
+    STREAM_CHUNK_SIZE = 4 * 1024 * 1024
+    content_cache: Optional[BlobContentCache] = None
+
     @classmethod
     def sourcepage_from_file_page(cls, filename, page=0) -> str:
         if os.path.splitext(filename)[1].lower() == ".pdf":
@@ -118,6 +154,114 @@ class BaseBlobManager:
         """
         raise NotImplementedError("Subclasses must implement this method")
 
+    async def get_blob_etag(self, blob_path: str, user_oid: Optional[str] = None) -> Optional[str]:
+        """
+        Gets the ETag of a blob without downloading its content, so that a cached copy can be revalidated.
+        It applies the same access checks as download_blob.
+
+        Args:
+            blob_path: The path to the blob in the storage
+            user_oid: The user's object ID (optional)
+
+        Returns:
+            Optional[str]: The ETag of the blob, or None if the blob is not found or access is denied
+        """
+        raise NotImplementedError("Subclasses must implement this method")
+
+    async def get_blob_properties(self, blob_path: str, user_oid: Optional[str] = None) -> Optional[BlobProperties]:
+        """
+        Gets the content type, ETag and size of a blob without downloading its content.
+        It applies the same access checks as download_blob.
+
+        Args:
+            blob_path: The path to the blob in the storage
+            user_oid: The user's object ID (optional)
+
+        Returns:
+            Optional[BlobProperties]: The properties of the blob, or None if the blob is not found or access is denied
+        """
+        raise NotImplementedError("Subclasses must implement this method")
+
+    async def download_blob_range(
+        self, blob_path: str, offset: int, length: int, etag: Optional[str] = None, user_oid: Optional[str] = None
+    ) -> bytes:
+        """
+        Downloads a range of a blob whose properties were already checked with get_blob_properties.
+
+        Args:
+            blob_path: The path to the blob in the storage
+            offset: The position of the first byte to download
+            length: The number of bytes to download
+            etag: If provided, the download fails with ResourceModifiedError if the blob has changed since
+            user_oid: The user's object ID (optional)
+
+        Returns:
+            bytes: The content of the range
+        """
+        raise NotImplementedError("Subclasses must implement this method")
+
+    async def stream_blob(
+        self,
+        blob_path: str,
+        offset: int,
+        length: int,
+        etag: Optional[str] = None,
+        user_oid: Optional[str] = None,
+        size: Optional[int] = None,
+    ) -> AsyncGenerator[bytes, None]:
+        """
+        Streams a range of a blob in chunks of at most STREAM_CHUNK_SIZE bytes.
+        Passing the ETag and size from get_blob_properties makes sure every chunk comes from the same version
+        of the blob, and with a content cache, lets that version be downloaded to disk once and served from there.
+        A range of a blob that isn't cached yet is streamed from storage while the blob is cached in the background.
+        """
+        if self.content_cache is not None and etag and size is not None and self.content_cache.can_store(size):
+            location = self.get_blob_location(blob_path, user_oid)
+            mapped_file = await self.content_cache.get(location, etag)
+            if mapped_file is not None:
+                with mapped_file:
+                    end = offset + length
+                    for position in range(offset, end, self.STREAM_CHUNK_SIZE):
+                        # Only the pages of the range are read from disk, into a copy that outlives the mapping
+                        yield await asyncio.to_thread(
+                            mapped_file.__getitem__, slice(position, min(position + self.STREAM_CHUNK_SIZE, end))
+                        )
+                return
+            self.content_cache.fill(
+                location,
+                etag,
+                size,
+                lambda: self.download_blob_chunks(blob_path, 0, size, etag=etag, user_oid=user_oid),
+            )
+        async for chunk in self.download_blob_chunks(blob_path, offset, length, etag=etag, user_oid=user_oid):
+            yield chunk
+
+    async def download_blob_chunks(
+        self, blob_path: str, offset: int, length: int, etag: Optional[str] = None, user_oid: Optional[str] = None
+    ) -> AsyncGenerator[bytes, None]:
+        """
+        Downloads a range of a blob in chunks of at most STREAM_CHUNK_SIZE bytes, each downloaded when it's needed.
+        """
+        end = offset + length
+        while offset < end:
+            chunk = await self.download_blob_range(
+                blob_path, offset, min(self.STREAM_CHUNK_SIZE, end - offset), etag=etag, user_oid=user_oid
+            )
+            if not chunk:
+                break
+            yield chunk
+            offset += len(chunk)
+
+    def get_blob_location(self, blob_path: str, user_oid: Optional[str] = None) -> str:
+        """
+        Identifies a blob across storage accounts and containers, for caching its content.
+        """
+        raise NotImplementedError("Subclasses must implement this method")
+
+    @staticmethod
+    def _get_match_conditions(etag: Optional[str]) -> dict[str, Any]:
+        return {"etag": etag, "match_condition": MatchConditions.IfNotModified} if etag else {}
+
 
 class AdlsBlobManager(BaseBlobManager):
     """
@@ -126,7 +270,20 @@ class AdlsBlobManager(BaseBlobManager):
     Images are stored in a separate images subdirectory for better organization.
     """
 
-    def __init__(self, endpoint: str, container: str, credential: AsyncTokenCredential):
+    # Seconds that a directory's existence and owner are trusted after they were checked.
+    # Each worker process has its own cache, so a directory deleted by another worker is still trusted until then:
+    # writes that fail are retried after checking the directory again, but a write into a deleted directory
+    # recreates it without its owner, so this is kept short.
+    DIRECTORY_CACHE_TTL_SECONDS = 30.0
+    DIRECTORY_CACHE_MAX_SIZE = 10000
+
+    def __init__(
+        self,
+        endpoint: str,
+        container: str,
+        credential: AsyncTokenCredential,
+        content_cache: Optional[BlobContentCache] = None,
+    ):
         """
         Initializes the AdlsBlobManager with the necessary parameters.
 
@@ -134,41 +291,101 @@ class AdlsBlobManager(BaseBlobManager):
             endpoint: The ADLS endpoint URL
             container: The name of the container (file system)
             credential: The credential for accessing ADLS
+            content_cache: An optional cache on local disk for the content of the files that are streamed
         """
         self.endpoint = endpoint
         self.container = container
         self.credential = credential
+        self.content_cache = content_cache
         self.file_system_client = FileSystemClient(
             account_url=self.endpoint,
             file_system_name=self.container,
             credential=self.credential,
+            raw_request_hook=record_storage_call,
         )
+        # Whether each (directory path, user) was found to be owned by the user, and until when that's trusted
+        self.verified_directories: OrderedDict[tuple[str, str], tuple[bool, float]] = OrderedDict()
 
     async def close_clients(self):
+        if self.content_cache is not None:
+            await self.content_cache.close()
         await self.file_system_client.close()
 
     async def _ensure_directory(self, directory_path: str, user_oid: str) -> DataLakeDirectoryClient:
         """
         Ensures that a directory path exists and has proper permissions.
         Creates the entire path in a single operation if it doesn't exist.
+        The result, including a denied permission, is cached for DIRECTORY_CACHE_TTL_SECONDS.
 
         Args:
             directory_path: Full path of directory to create (e.g., 'user123/images/mydoc')
             user_oid: The owner to set for all created directories
         """
         directory_client = self.file_system_client.get_directory_client(directory_path)
+        key = (directory_path, user_oid)
+        if (verified := self.verified_directories.get(key)) is not None:
+            is_owner, expires_at = verified
+            if time.monotonic() < expires_at:
+                if not is_owner:
+                    raise PermissionError(f"User {user_oid} does not have permission to access {directory_path}")
+                return directory_client
+            del self.verified_directories[key]
         try:
             await directory_client.get_directory_properties()
             # Check directory properties to ensure it has the correct owner
             props = await directory_client.get_access_control()
             if props.get("owner") != user_oid:
+                self._set_directory_verified(key, is_owner=False)
                 raise PermissionError(f"User {user_oid} does not have permission to access {directory_path}")
         except ResourceNotFoundError:
             logger.info("Creating directory path %s", directory_path)
             await directory_client.create_directory()
             await directory_client.set_access_control(owner=user_oid)
+        self._set_directory_verified(key, is_owner=True)
         return directory_client
 
+    def _set_directory_verified(self, key: tuple[str, str], is_owner: bool):
+        self.verified_directories[key] = (is_owner, time.monotonic() + self.DIRECTORY_CACHE_TTL_SECONDS)
+        self.verified_directories.move_to_end(key)
+        while len(self.verified_directories) > self.DIRECTORY_CACHE_MAX_SIZE:
+            self.verified_directories.popitem(last=False)
+
+    def _forget_directory(self, directory_path: str):
+        """
+        Removes a deleted directory and its subdirectories from the cache of verified directories.
+        """
+        for key in list(self.verified_directories):
+            path = key[0]
+            if path == directory_path or path.startswith(f"{directory_path}/"):
+                del self.verified_directories[key]
+
+    async def _upload_file(
+        self, directory_path: str, user_oid: str, filename: str, data: Union[bytes, IO], **kwargs: Any
+    ) -> DataLakeFileClient:
+        """
+        Uploads a file to one of the user's directories. If the upload is denied or its directory isn't found,
+        which happens when the directory was deleted or changed since it was checked, such as by another worker,
+        the directory is checked again and the upload retried once.
+        """
+
+        async def upload() -> DataLakeFileClient:
+            directory_client = await self._ensure_directory(directory_path=directory_path, user_oid=user_oid)
+            file_client = directory_client.get_file_client(filename)
+            if not isinstance(data, bytes):
+                # Ensure the file is at the beginning
+                data.seek(0)
+            await file_client.upload_data(data, overwrite=True, **kwargs)
+            return file_client
+
+        try:
+            return await upload()
+        except HttpResponseError as error:
+            if error.status_code not in (403, 404):
+                raise
+            logger.info("Checking directory %s again after a failed upload: %s", directory_path, error)
+            self._forget_directory(directory_path)
+        return await upload()
+
     async def upload_blob(self, file: Union[File, IO], filename: str, user_oid: str) -> str:
         """
         Uploads a file directly to the user's directory in ADLS (no subdirectory).
@@ -181,22 +398,14 @@ class AdlsBlobManager(BaseBlobManager):
         Returns:
             str: The URL of the uploaded file, with forward slashes (not URL-encoded)
         """
-        # Ensure user directory exists but don't create a subdirectory
-        user_directory_client = await self._ensure_directory(directory_path=user_oid, user_oid=user_oid)
-
-        # Create file directly in user directory
-        file_client = user_directory_client.get_file_client(filename)
-
         # Handle both File and IO objects
         if isinstance(file, File):
             file_io = file.content
         else:
             file_io = file
 
-        # Ensure the file is at the beginning
-        file_io.seek(0)
-
-        await file_client.upload_data(file_io, overwrite=True)
+        # Create file directly in user directory, ensuring that it exists but without creating a subdirectory
+        file_client = await self._upload_file(user_oid, user_oid, filename, file_io)
 
         # Reset the file position for any subsequent reads
         file_io.seek(0)
@@ -247,11 +456,11 @@ class AdlsBlobManager(BaseBlobManager):
             raise ValueError("user_oid must be provided for user-specific operations.")
         await self._ensure_directory(directory_path=user_oid, user_oid=user_oid)
         image_directory_path = self._get_image_directory_path(document_filename, user_oid, image_page_num)
-        image_directory_client = await self._ensure_directory(directory_path=image_directory_path, user_oid=user_oid)
-        file_client = image_directory_client.get_file_client(image_filename)
         image_bytes = BaseBlobManager.add_image_citation(image_bytes, document_filename, image_filename, image_page_num)
         logger.info("Uploading document image '%s' to '%s'", image_filename, image_directory_path)
-        await file_client.upload_data(image_bytes, overwrite=True, metadata={"UploadedBy": user_oid})
+        file_client = await self._upload_file(
+            image_directory_path, user_oid, image_filename, image_bytes, metadata={"UploadedBy": user_oid}
+        )
         return unquote(file_client.url)
 
     async def download_blob(
@@ -272,23 +481,10 @@ class AdlsBlobManager(BaseBlobManager):
         if user_oid is None:
             logger.warning("user_oid must be provided for Data Lake Storage operations.")
             return None
-
-        # Get the directory path and file name from the blob path
-        path_parts = blob_path.split("/")
-        if len(path_parts) < 2:
-            # If no slashes in path, we assume it's a file in the user's root directory
-            filename = blob_path
-            directory_path = user_oid
-        else:
-            # First verify that the root directory matches the user_oid
-            root_dir = path_parts[0]
-            if root_dir != user_oid:
-                logger.warning(f"User {user_oid} does not have permission to access {blob_path}")
-                return None
-
-            # Get the directory client for the full path except the filename
-            directory_path = "/".join(path_parts[:-1])
-            filename = path_parts[-1]
+        user_path = self._get_user_path(blob_path, user_oid)
+        if user_path is None:
+            return None
+        directory_path, filename = user_path
 
         try:
             user_directory_client = await self._ensure_directory(directory_path=directory_path, user_oid=user_oid)
@@ -300,17 +496,104 @@ class AdlsBlobManager(BaseBlobManager):
             properties: BlobProperties = {
                 "content_settings": {
                     "content_type": download_response.properties.get("content_type", "application/octet-stream")
-                }
+                },
+                "etag": download_response.properties.get("etag"),
             }
 
             return content, properties
         except ResourceNotFoundError:
             logger.warning(f"Directory or file not found: {directory_path}/{filename}")
+            # The directory may have been deleted by another worker, so it's checked again before it's written to
+            self._forget_directory(directory_path)
             return None
         except Exception as e:
             logging.error(f"Error accessing directory {directory_path}: {str(e)}")
             return None
 
+    async def get_blob_etag(self, blob_path: str, user_oid: Optional[str] = None) -> Optional[str]:
+        # The properties are read through the user's directory, so that its owner is checked
+        properties = await self.get_blob_properties(blob_path, user_oid)
+        return properties.get("etag") if properties else None
+
+    async def get_blob_properties(self, blob_path: str, user_oid: Optional[str] = None) -> Optional[BlobProperties]:
+        if user_oid is None:
+            logger.warning("user_oid must be provided for Data Lake Storage operations.")
+            return None
+        user_path = self._get_user_path(blob_path, user_oid)
+        if user_path is None:
+            return None
+        directory_path, filename = user_path
+
+        try:
+            user_directory_client = await self._ensure_directory(directory_path=directory_path, user_oid=user_oid)
+            file_properties = await user_directory_client.get_file_client(filename).get_file_properties()
+        except ResourceNotFoundError:
+            logger.warning(f"Directory or file not found: {directory_path}/{filename}")
+            # The directory may have been deleted by another worker, so it's checked again before it's written to
+            self._forget_directory(directory_path)
+            return None
+        except Exception as e:
+            logging.error(f"Error accessing directory {directory_path}: {str(e)}")
+            return None
+        content_settings = file_properties.content_settings
+        return {
+            "content_settings": {
+                "content_type": (
+                    content_settings.content_type
+                    if content_settings and content_settings.content_type
+                    else "application/octet-stream"
+                )
+            },
+            "etag": file_properties.etag,
+            "size": file_properties.size or 0,
+        }
+
+    async def download_blob_range(
+        self, blob_path: str, offset: int, length: int, etag: Optional[str] = None, user_oid: Optional[str] = None
+    ) -> bytes:
+        if user_oid is None:
+            raise ValueError("user_oid must be provided for Data Lake Storage operations.")
+        user_path = self._get_user_path(blob_path, user_oid)
+        if user_path is None:
+            raise PermissionError(f"User {user_oid} does not have permission to access {blob_path}")
+        directory_path, filename = user_path
+        file_client = self.file_system_client.get_directory_client(directory_path).get_file_client(filename)
+        download_response = await file_client.download_file(
+            offset=offset, length=length, **self._get_match_conditions(etag)
+        )
+        return await download_response.readall()
+
+    def get_blob_location(self, blob_path: str, user_oid: Optional[str] = None) -> str:
+        if user_oid is None:
+            raise ValueError("user_oid must be provided for Data Lake Storage operations.")
+        user_path = self._get_user_path(blob_path, user_oid)
+        if user_path is None:
+            raise PermissionError(f"User {user_oid} does not have permission to access {blob_path}")
+        directory_path, filename = user_path
+        return f"{self.endpoint}/{self.container}/{directory_path}/{filename}"
+
+    def _get_user_path(self, blob_path: str, user_oid: str) -> Optional[tuple[str, str]]:
+        """
+        Splits a blob path into the directory path and file name, checking that the path belongs to the user.
+
+        Returns:
+            Optional[tuple[str, str]]: The directory path and file name, or None if the user can't access the path
+        """
+        # Get the directory path and file name from the blob path
+        path_parts = blob_path.split("/")
+        if len(path_parts) < 2:
+            # If no slashes in path, we assume it's a file in the user's root directory
+            return user_oid, blob_path
+
+        # First verify that the root directory matches the user_oid
+        root_dir = path_parts[0]
+        if root_dir != user_oid:
+            logger.warning(f"User {user_oid} does not have permission to access {blob_path}")
+            return None
+
+        # The directory is the full path except the filename
+        return "/".join(path_parts[:-1]), path_parts[-1]
+
     async def remove_blob(self, filename: str, user_oid: str) -> None:
         """
         Deletes a file from the user's directory in ADLS and any associated image directories.
@@ -338,6 +621,7 @@ class AdlsBlobManager(BaseBlobManager):
                 directory_path=image_directory_path, user_oid=user_oid
             )
             await image_directory_client.delete_directory()
+            self._forget_directory(image_directory_path)
             logger.info(f"Deleted associated image directory: {image_directory_path}")
         except ResourceNotFoundError:
             # It's okay if there was no image directory
@@ -398,6 +682,7 @@ class BlobManager(BaseBlobManager):
         account: Optional[str] = None,
         resource_group: Optional[str] = None,
         subscription_id: Optional[str] = None,
+        content_cache: Optional[BlobContentCache] = None,
     ):
         self.endpoint = endpoint
         self.credential = credential
@@ -406,11 +691,20 @@ class BlobManager(BaseBlobManager):
         self.resource_group = resource_group
         self.subscription_id = subscription_id
         self.image_container = image_container
+        self.content_cache = content_cache
         self.blob_service_client = BlobServiceClient(
-            account_url=self.endpoint, credential=self.credential, max_single_put_size=4 * 1024 * 1024
+            account_url=self.endpoint,
+            credential=self.credential,
+            max_single_put_size=4 * 1024 * 1024,
+            raw_request_hook=record_storage_call,
         )
+        self.container_clients: dict[str, ContainerClient] = {}
+        # Containers that are known to exist, so that they're only checked once per process
+        self.verified_containers: set[str] = set()
 
     async def close_clients(self):
+        if self.content_cache is not None:
+            await self.content_cache.close()
         await self.blob_service_client.close()
 
     def get_managedidentity_connectionstring(self):
@@ -418,17 +712,54 @@ class BlobManager(BaseBlobManager):
             raise ValueError("Account, resource group, and subscription ID must be set to generate connection string.")
         return f"ResourceId=/subscriptions/{self.subscription_id}/resourceGroups/{self.resource_group}/providers/Microsoft.Storage/storageAccounts/{self.account};"
 
-    async def upload_blob(self, file: File) -> str:
-        container_client = self.blob_service_client.get_container_client(self.container)
-        if not await container_client.exists():
+    def get_container_client(self, container: str) -> ContainerClient:
+        if (container_client := self.container_clients.get(container)) is None:
+            container_client = self.blob_service_client.get_container_client(container)
+            self.container_clients[container] = container_client
+        return container_client
+
+    async def ensure_container(self, container: str) -> ContainerClient:
+        """
+        Creates the container if it doesn't exist, checking only the first time the container is used.
+        """
+        container_client = self.get_container_client(container)
+        if container not in self.verified_containers:
+            if not await container_client.exists():
+                await self.create_container(container_client)
+            self.verified_containers.add(container)
+        return container_client
+
+    async def create_container(self, container_client: ContainerClient):
+        try:
             await container_client.create_container()
+        except ResourceExistsError:
+            # Created by a concurrent upload
+            pass
+        self.verified_containers.add(container_client.container_name)
+
+    async def upload_to_container(self, container: str, blob_name: str, data: Union[bytes, IO]) -> BlobClient:
+        container_client = await self.ensure_container(container)
+        try:
+            return await container_client.upload_blob(blob_name, data, overwrite=True)
+        except ResourceNotFoundError as error:
+            # The Storage SDK sets the error code from the response
+            if getattr(error, "error_code", None) != StorageErrorCode.CONTAINER_NOT_FOUND:
+                raise
+        # The container was deleted after it was checked
+        logger.info("Container '%s' not found, creating it", container)
+        self.verified_containers.discard(container)
+        await self.create_container(container_client)
+        if not isinstance(data, bytes):
+            data.seek(0)
+        return await container_client.upload_blob(blob_name, data, overwrite=True)
 
+    async def upload_blob(self, file: File) -> str:
         # Re-open and upload the original file
         if file.url is None:
             with open(file.content.name, "rb") as reopened_file:
                 blob_name = self.blob_name_from_file_name(file.content.name)
                 logger.info("Uploading blob for document '%s'", blob_name)
-                blob_client = await container_client.upload_blob(blob_name, reopened_file, overwrite=True)
+                blob_client = await self.upload_to_container(self.container, blob_name, reopened_file)
                 file.url = blob_client.url
 
         return unquote(file.url)
@@ -449,13 +780,10 @@ class BlobManager(BaseBlobManager):
             raise ValueError(
                 "user_oid is not supported for BlobManager. Use AdlsBlobManager for user-specific operations."
             )
-        container_client = self.blob_service_client.get_container_client(self.container)
-        if not await container_client.exists():
-            await container_client.create_container()
         image_bytes = self.add_image_citation(image_bytes, document_filename, image_filename, image_page_num)
         blob_name = f"{self.blob_name_from_file_name(document_filename)}/page{image_page_num}/{image_filename}"
         logger.info("Uploading blob for document image '%s'", blob_name)
-        blob_client = await container_client.upload_blob(blob_name, image_bytes, overwrite=True)
+        blob_client = await self.upload_to_container(self.container, blob_name, image_bytes)
         return blob_client.url
 
     async def download_blob(
@@ -480,14 +808,12 @@ class BlobManager(BaseBlobManager):
             raise ValueError(
                 "user_oid is not supported for BlobManager. Use AdlsBlobManager for user-specific operations."
             )
-        container_client = self.blob_service_client.get_container_client(self.container)
-        if not await container_client.exists():
-            return None
         if len(blob_path) == 0:
             logger.warning("Blob path is empty")
             return None
 
-        blob_client = container_client.get_blob_client(blob_path)
+        # A missing container is reported as a missing blob, so it isn't checked separately
+        blob_client = self.get_container_client(self.container).get_blob_client(blob_path)
         try:
             download_response = await blob_client.download_blob()
             if not download_response.properties:
@@ -509,7 +835,8 @@ class BlobManager(BaseBlobManager):
                         )
                         else "application/octet-stream"
                     )
-                }
+                },
+                "etag": getattr(download_response.properties, "etag", None),
             }
 
             return content, properties
@@ -517,10 +844,73 @@ class BlobManager(BaseBlobManager):
             logger.warning("Blob not found: %s", blob_path)
             return None
 
+    async def get_blob_etag(self, blob_path: str, user_oid: Optional[str] = None) -> Optional[str]:
+        if user_oid is not None:
+            raise ValueError(
+                "user_oid is not supported for BlobManager. Use AdlsBlobManager for user-specific operations."
+            )
+        if len(blob_path) == 0:
+            logger.warning("Blob path is empty")
+            return None
+
+        blob_client = self.blob_service_client.get_blob_client(container=self.container, blob=blob_path)
+        try:
+            blob_properties = await blob_client.get_blob_properties()
+            return blob_properties.etag
+        except ResourceNotFoundError:
+            logger.warning("Blob not found: %s", blob_path)
+            return None
+
+    async def get_blob_properties(self, blob_path: str, user_oid: Optional[str] = None) -> Optional[BlobProperties]:
+        if user_oid is not None:
+            raise ValueError(
+                "user_oid is not supported for BlobManager. Use AdlsBlobManager for user-specific operations."
+            )
+        if len(blob_path) == 0:
+            logger.warning("Blob path is empty")
+            return None
+
+        blob_client = self.blob_service_client.get_blob_client(container=self.container, blob=blob_path)
+        try:
+            blob_properties = await blob_client.get_blob_properties()
+        except ResourceNotFoundError:
+            logger.warning("Blob not found: %s", blob_path)
+            return None
+        content_settings = blob_properties.content_settings
+        return {
+            "content_settings": {
+                "content_type": (
+                    content_settings.content_type
+                    if content_settings and content_settings.content_type
+                    else "application/octet-stream"
+                )
+            },
+            "etag": blob_properties.etag,
+            "size": blob_properties.size,
+        }
+
+    async def download_blob_range(
+        self, blob_path: str, offset: int, length: int, etag: Optional[str] = None, user_oid: Optional[str] = None
+    ) -> bytes:
+        if user_oid is not None:
+            raise ValueError(
+                "user_oid is not supported for BlobManager. Use AdlsBlobManager for user-specific operations."
+            )
+        blob_client = self.blob_service_client.get_blob_client(container=self.container, blob=blob_path)
+        download_response = await blob_client.download_blob(
+            offset=offset, length=length, **self._get_match_conditions(etag)
+        )
+        return await download_response.readall()
+
+    def get_blob_location(self, blob_path: str, user_oid: Optional[str] = None) -> str:
+        return f"{self.endpoint}/{self.container}/{blob_path}"
+
     async def remove_blob(self, path: Optional[str] = None):
-        container_client = self.blob_service_client.get_container_client(self.container)
-        if not await container_client.exists():
-            return
+        container_client = self.get_container_client(self.container)
+        if self.container not in self.verified_containers:
+            if not await container_client.exists():
+                return
+            self.verified_containers.add(self.container)
         if path is None:
             prefix = None
             blobs = container_client.list_blob_names()
@@ -5,11 +5,17 @@ from typing import Callable, Optional, Union
 from urllib.parse import urljoin
 
 import aiohttp
+import httpx
 import tiktoken
 from azure.core.credentials import AzureKeyCredential
 from azure.core.credentials_async import AsyncTokenCredential
 from azure.identity.aio import get_bearer_token_provider
-from openai import AsyncAzureOpenAI, AsyncOpenAI, RateLimitError
+from openai import (
+    AsyncAzureOpenAI,
+    AsyncOpenAI,
+    DefaultAsyncHttpxClient,
+    RateLimitError,
+)
 from tenacity import (
     AsyncRetrying,
     retry_if_exception_type,
@@ -18,6 +24,9 @@ from tenacity import (
 )
 from typing_extensions import TypedDict
 
+from .openailoadbalancer import LoadBalancingTransport, OpenAIBackend
+from .ratelimiter import RateLimitingTransport, TokenBucketRateLimiter
+
 logger = logging.getLogger("scripts")
 
 
@@ -168,6 +177,8 @@ class AzureOpenAIEmbeddingService(OpenAIEmbeddings):
         credential: Union[AsyncTokenCredential, AzureKeyCredential],
         open_ai_custom_url: Union[str, None] = None,
         disable_batch: bool = False,
+        open_ai_backends: Optional[list[OpenAIBackend]] = None,
+        rate_limiters: Optional[dict[str, TokenBucketRateLimiter]] = None,
     ):
         super().__init__(open_ai_model_name, open_ai_dimensions, disable_batch)
         self.open_ai_service = open_ai_service
@@ -180,6 +191,12 @@ class AzureOpenAIEmbeddingService(OpenAIEmbeddings):
         self.open_ai_deployment = open_ai_deployment
         self.open_ai_api_version = open_ai_api_version
         self.credential = credential
+        # Shared by the clients this service creates, so that they all know which backends are throttling
+        self.transport: Optional[httpx.AsyncBaseTransport] = None
+        if open_ai_backends:
+            self.transport = LoadBalancingTransport.for_endpoint(self.open_ai_endpoint, open_ai_backends, rate_limiters)
+        elif rate_limiters:
+            self.transport = RateLimitingTransport(rate_limiters)
 
     async def create_client(self) -> AsyncOpenAI:
         class AuthArgs(TypedDict, total=False):
@@ -200,6 +217,7 @@ class AzureOpenAIEmbeddingService(OpenAIEmbeddings):
             azure_endpoint=self.open_ai_endpoint,
             azure_deployment=self.open_ai_deployment,
             api_version=self.open_ai_api_version,
+            http_client=DefaultAsyncHttpxClient(transport=self.transport) if self.transport else None,
             **auth_args,
         )
 
@@ -217,13 +235,19 @@ class OpenAIEmbeddingService(OpenAIEmbeddings):
         credential: str,
         organization: Optional[str] = None,
         disable_batch: bool = False,
+        rate_limiters: Optional[dict[str, TokenBucketRateLimiter]] = None,
     ):
         super().__init__(open_ai_model_name, open_ai_dimensions, disable_batch)
         self.credential = credential
         self.organization = organization
+        self.transport = RateLimitingTransport(rate_limiters) if rate_limiters else None
 
     async def create_client(self) -> AsyncOpenAI:
-        return AsyncOpenAI(api_key=self.credential, organization=self.organization)
+        return AsyncOpenAI(
+            api_key=self.credential,
+            organization=self.organization,
+            http_client=DefaultAsyncHttpxClient(transport=self.transport) if self.transport else None,
+        )
 
 
 class ImageEmbeddings:
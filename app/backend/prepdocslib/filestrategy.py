@@ -1,5 +1,7 @@
+import io
 import logging
-from typing import Optional
+from collections.abc import Awaitable
+from typing import Callable, Optional
 
 from azure.core.credentials import AzureKeyCredential
 
@@ -164,13 +166,39 @@ class UploadUserFileStrategy:
         )
         self.search_field_name_embedding = search_field_name_embedding
 
-    async def add_file(self, file: File, user_oid: str):
+    async def add_file(self, file: File, user_oid: str, start_stage: Optional[Callable[[str], Awaitable[None]]] = None):
+        """
+        Parses the file and indexes its sections, calling start_stage, if given, as each of those stages starts.
+        """
+        if start_stage:
+            await start_stage("parsing")
         sections = await parse_file(
             file, self.file_processors, None, self.blob_manager, self.image_embeddings, user_oid=user_oid
         )
         if sections:
+            if start_stage:
+                await start_stage("indexing")
             await self.search_manager.update_content(sections, url=file.url)
 
+    async def add_uploaded_file(
+        self,
+        filename: str,
+        url: str,
+        user_oid: str,
+        start_stage: Optional[Callable[[str], Awaitable[None]]] = None,
+    ):
+        """
+        Ingests a file that was uploaded to the user's directory earlier, reading it back from storage.
+        """
+        if start_stage:
+            await start_stage("downloading")
+        result = await self.blob_manager.download_blob(filename, user_oid)
+        if result is None:
+            raise FileNotFoundError(f"Uploaded file {filename} not found for user {user_oid}")
+        content = io.BytesIO(result[0])
+        content.name = filename
+        await self.add_file(File(content=content, url=url, acls={"oids": [user_oid]}), user_oid, start_stage)
+
     async def remove_file(self, filename: str, oid: str):
         if filename is None or filename == "":
             logging.warning("Filename is required to remove a file")
@@ -0,0 +1,247 @@
+import json
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+import httpx
+
+from .ratelimiter import RateLimitingTransport, TokenBucketRateLimiter
+
+logger = logging.getLogger("scripts")
+
+
+@dataclass
+class OpenAIBackend:
+    """
+    An Azure OpenAI endpoint that calls can be sent to, along with its share of the calls
+    and the names of its deployments, where they differ from the deployment names the calls are made with
+    """
+
+    endpoint: str
+    weight: int = 1
+    api_key: Optional[str] = None
+    deployments: dict[str, str] = field(default_factory=dict)
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "OpenAIBackend":
+        if data.get("service"):
+            endpoint = f"https://{data['service']}.openai.azure.com"
+        elif data.get("endpoint"):
+            endpoint = data["endpoint"]
+        else:
+            raise ValueError("Each Azure OpenAI backend must have a service or an endpoint")
+        weight = int(data.get("weight", 1))
+        if weight < 1:
+            raise ValueError(f"The weight of the Azure OpenAI backend {endpoint} must be at least 1")
+        return cls(
+            endpoint=endpoint.rstrip("/"),
+            weight=weight,
+            api_key=data.get("api_key"),
+            deployments=dict(data.get("deployments", {})),
+        )
+
+
+def parse_openai_backends(value: Optional[str]) -> list[OpenAIBackend]:
+    """
+    Parses a JSON list of backends, such as [{"service": "my-openai-eastus2", "weight": 2}, {"endpoint": "https://..."}]
+    """
+    if not value:
+        return []
+    return [OpenAIBackend.from_dict(data) for data in json.loads(value)]
+
+
+class BackendState:
+    """
+    What is known about a backend from the responses to the calls sent to it
+    """
+
+    def __init__(self, backend: OpenAIBackend, transport: httpx.AsyncBaseTransport):
+        self.backend = backend
+        # Sends the calls routed to this backend, through its own rate limiters if there are any
+        self.transport = transport
+        # Used by smooth weighted round robin, which spreads each backend's calls evenly instead of in bursts
+        self.current_weight = 0
+        self.remaining_tokens: Optional[int] = None
+        self.remaining_requests: Optional[int] = None
+        self.rate_limits_updated_at = 0.0
+        # When the backend can be sent calls again, after it asked to be retried later or its circuit opened
+        self.unavailable_until = 0.0
+        self.consecutive_failures = 0
+
+
+class LoadBalancingTransport(httpx.AsyncBaseTransport):
+    """
+    Spreads the calls made by an OpenAI client across Azure OpenAI backends by weighted round robin.
+    Backends that are throttling (a 429 with Retry-After), failing repeatedly (an open circuit) or reporting
+    that they are almost out of tokens per minute are skipped, and a call that fails with a retryable status
+    is sent again to the next backend. The OpenAI client's own retries still apply once every backend has failed.
+    Given rate limiters, each backend gets its own, with the same limits, since each has its own quota.
+    """
+
+    RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+    # Consecutive failures after which no calls are sent to a backend for CIRCUIT_OPEN_SECONDS
+    CIRCUIT_FAILURE_THRESHOLD = 3
+    CIRCUIT_OPEN_SECONDS = 30.0
+    # How long a throttled backend is skipped for when its response doesn't say when to retry
+    DEFAULT_RETRY_AFTER_SECONDS = 10.0
+    # Backends reporting fewer remaining tokens than this are only used when no other backend is available
+    LOW_REMAINING_TOKENS = 1000
+    # Rate limits are tracked per minute, so older rate limit headers no longer say anything about the backend
+    RATE_LIMIT_WINDOW_SECONDS = 60.0
+
+    def __init__(
+        self,
+        backends: list[OpenAIBackend],
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        rate_limiters: Optional[dict[str, TokenBucketRateLimiter]] = None,
+    ):
+        if not backends:
+            raise ValueError("At least one Azure OpenAI backend is required")
+        self.transport = transport or httpx.AsyncHTTPTransport()
+        self.backends = [
+            BackendState(backend, self.create_backend_transport(backend, rate_limiters)) for backend in backends
+        ]
+
+    @classmethod
+    def for_endpoint(
+        cls,
+        endpoint: str,
+        backends: list[OpenAIBackend],
+        rate_limiters: Optional[dict[str, TokenBucketRateLimiter]] = None,
+    ) -> "LoadBalancingTransport":
+        """
+        Creates a transport for a client of the given endpoint, which gets a weight of 1 unless it's one of the backends.
+        """
+        endpoint = endpoint.rstrip("/")
+        if any(backend.endpoint == endpoint for backend in backends):
+            return cls(backends, rate_limiters=rate_limiters)
+        return cls([OpenAIBackend(endpoint=endpoint), *backends], rate_limiters=rate_limiters)
+
+    def create_backend_transport(
+        self, backend: OpenAIBackend, rate_limiters: Optional[dict[str, TokenBucketRateLimiter]]
+    ) -> httpx.AsyncBaseTransport:
+        if not rate_limiters:
+            return self.transport
+        # Calls reach the backend with its own deployment names
+        backend_rate_limiters = {
+            backend.deployments.get(deployment, deployment): rate_limiter.for_backend(backend.endpoint)
+            for deployment, rate_limiter in rate_limiters.items()
+        }
+        return RateLimitingTransport(backend_rate_limiters, self.transport)
+
+    def is_low_on_tokens(self, state: BackendState, now: float) -> bool:
+        if now - state.rate_limits_updated_at > self.RATE_LIMIT_WINDOW_SECONDS:
+            return False
+        return (state.remaining_tokens is not None and state.remaining_tokens < self.LOW_REMAINING_TOKENS) or (
+            state.remaining_requests is not None and state.remaining_requests <= 0
+        )
+
+    def select_backend(self, tried: list[BackendState]) -> Optional[BackendState]:
+        now = time.monotonic()
+        untried = [state for state in self.backends if state not in tried]
+        if not untried:
+            return None
+        candidates = [state for state in untried if state.unavailable_until <= now]
+        if not candidates:
+            # Every backend is unavailable, so the call goes to whichever becomes available first
+            return min(untried, key=lambda state: state.unavailable_until)
+        candidates = [state for state in candidates if not self.is_low_on_tokens(state, now)] or candidates
+
+        total_weight = 0
+        selected = candidates[0]
+        for state in candidates:
+            state.current_weight += state.backend.weight
+            total_weight += state.backend.weight
+            if state.current_weight > selected.current_weight:
+                selected = state
+        selected.current_weight -= total_weight
+        return selected
+
+    def route(self, request: httpx.Request, backend: OpenAIBackend) -> httpx.Request:
+        path = request.url.raw_path.decode("ascii")
+        # Azure OpenAI paths start with /openai/, after any path of the endpoint itself
+        path = path[path.find("/openai/") :] if "/openai/" in path else path
+        if backend.deployments and path.startswith("/openai/deployments/"):
+            deployment, _, rest = path[len("/openai/deployments/") :].partition("/")
+            if deployment in backend.deployments:
+                path = f"/openai/deployments/{backend.deployments[deployment]}/{rest}"
+        headers = request.headers.copy()
+        del headers["host"]
+        if backend.api_key:
+            headers["api-key"] = backend.api_key
+        return httpx.Request(
+            request.method,
+            backend.endpoint + path,
+            headers=headers,
+            content=request.content,
+            extensions=request.extensions,
+        )
+
+    def get_retry_after_seconds(self, headers: httpx.Headers) -> float:
+        try:
+            if retry_after_ms := headers.get("retry-after-ms"):
+                return float(retry_after_ms) / 1000
+            if retry_after := headers.get("retry-after"):
+                return float(retry_after)
+        except ValueError:
+            pass
+        return self.DEFAULT_RETRY_AFTER_SECONDS
+
+    def record_response(self, state: BackendState, response: httpx.Response):
+        now = time.monotonic()
+        remaining_tokens = response.headers.get("x-ratelimit-remaining-tokens")
+        remaining_requests = response.headers.get("x-ratelimit-remaining-requests")
+        if remaining_tokens is not None or remaining_requests is not None:
+            state.remaining_tokens = int(remaining_tokens) if remaining_tokens is not None else None
+            state.remaining_requests = int(remaining_requests) if remaining_requests is not None else None
+            state.rate_limits_updated_at = now
+        if response.status_code == 429:
+            # Throttling means the backend is busy rather than broken, so it doesn't count towards opening the circuit
+            state.unavailable_until = now + self.get_retry_after_seconds(response.headers)
+            logger.info("Azure OpenAI backend %s is throttling, skipping it", state.backend.endpoint)
+        elif response.status_code in self.RETRYABLE_STATUS_CODES:
+            self.record_failure(state)
+            if "retry-after" in response.headers or "retry-after-ms" in response.headers:
+                state.unavailable_until = max(
+                    state.unavailable_until, now + self.get_retry_after_seconds(response.headers)
+                )
+        else:
+            state.consecutive_failures = 0
+
+    def record_failure(self, state: BackendState):
+        state.consecutive_failures += 1
+        if state.consecutive_failures >= self.CIRCUIT_FAILURE_THRESHOLD:
+            # After CIRCUIT_OPEN_SECONDS, a single call is sent to the backend again, and another failure reopens it
+            state.unavailable_until = time.monotonic() + self.CIRCUIT_OPEN_SECONDS
+            logger.warning(
+                "Azure OpenAI backend %s failed %d times in a row, skipping it for %d seconds",
+                state.backend.endpoint,
+                state.consecutive_failures,
+                self.CIRCUIT_OPEN_SECONDS,
+            )
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        # The body is read once, so that it can be sent again to another backend
+        await request.aread()
+        tried: list[BackendState] = []
+        while True:
+            state = self.select_backend(tried)
+            if state is None:
+                raise RuntimeError("No Azure OpenAI backend to send the request to")
+            tried.append(state)
+            is_last_backend = len(tried) == len(self.backends)
+            try:
+                response = await state.transport.handle_async_request(self.route(request, state.backend))
+            except httpx.TransportError:
+                self.record_failure(state)
+                if is_last_backend:
+                    raise
+                continue
+            self.record_response(state, response)
+            if response.status_code not in self.RETRYABLE_STATUS_CODES or is_last_backend:
+                return response
+            await response.aclose()
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
@@ -0,0 +1,248 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Optional
+
+import httpx
+import tiktoken
+
+logger = logging.getLogger("scripts")
+
+
+class TokenBucketRateLimiter:
+    """
+    Admits calls to Azure OpenAI at the deployment's tokens per minute and requests per minute,
+    so that bursts wait in line here instead of being answered with 429s and retried after long sleeps.
+    Callers are admitted in the order they arrived. The rate is lowered whenever the service throttles anyway,
+    which happens when the deployment is shared with other clients, and recovers as calls succeed.
+    """
+
+    # The rate is multiplied by this whenever a call is throttled
+    THROTTLED_RATE_FACTOR = 0.75
+    # The rate is never lowered below this fraction of the configured rate
+    MIN_RATE_FRACTION = 0.1
+    # Fraction of the configured rate that each successful call restores
+    RATE_RECOVERY_FRACTION = 0.05
+    DEFAULT_RETRY_AFTER_SECONDS = 10.0
+
+    def __init__(self, tokens_per_minute: int, requests_per_minute: Optional[int] = None):
+        if tokens_per_minute <= 0:
+            raise ValueError("tokens_per_minute must be positive")
+        self.tokens_per_minute = tokens_per_minute
+        # Azure OpenAI allows 6 requests per minute for every 1000 tokens per minute
+        self.requests_per_minute = requests_per_minute or max(tokens_per_minute * 6 // 1000, 1)
+        self.rate_fraction = 1.0
+        # Buckets start full, so that the first calls are admitted right away
+        self.available_tokens = float(self.tokens_per_minute)
+        self.available_requests = float(self.requests_per_minute)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+        self.queue_depth = 0
+        self.calls_admitted = 0
+        self.calls_throttled = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.backend_rate_limiters: dict[str, TokenBucketRateLimiter] = {}
+
+    def for_backend(self, endpoint: str) -> "TokenBucketRateLimiter":
+        """
+        Returns the rate limiter for the same deployment on another Azure OpenAI backend, which has its own quota.
+        It has the same limits, and is shared by every client that shares this rate limiter.
+        """
+        if endpoint not in self.backend_rate_limiters:
+            self.backend_rate_limiters[endpoint] = TokenBucketRateLimiter(
+                self.tokens_per_minute, self.requests_per_minute
+            )
+        return self.backend_rate_limiters[endpoint]
+
+    @property
+    def average_wait_seconds(self) -> float:
+        return self.total_wait_seconds / self.calls_admitted if self.calls_admitted else 0.0
+
+    def refill(self, now: float):
+        elapsed_minutes = (now - self.updated_at) / 60
+        self.updated_at = now
+        self.available_tokens = min(
+            self.available_tokens + elapsed_minutes * self.tokens_per_minute * self.rate_fraction,
+            self.tokens_per_minute,
+        )
+        self.available_requests = min(
+            self.available_requests + elapsed_minutes * self.requests_per_minute * self.rate_fraction,
+            self.requests_per_minute,
+        )
+
+    def get_wait_seconds(self, tokens: int, now: float) -> float:
+        tokens_per_second = self.tokens_per_minute * self.rate_fraction / 60
+        requests_per_second = self.requests_per_minute * self.rate_fraction / 60
+        return max(
+            (tokens - self.available_tokens) / tokens_per_second,
+            (1 - self.available_requests) / requests_per_second,
+            self.paused_until - now,
+            0.0,
+        )
+
+    async def acquire(self, tokens: int):
+        """
+        Waits until a call estimated to use the given number of tokens can be sent.
+        """
+        # A call larger than the bucket is admitted once the bucket is full
+        tokens = min(tokens, self.tokens_per_minute)
+        start = time.monotonic()
+        self.queue_depth += 1
+        try:
+            # Only the caller at the front of the line waits for the buckets to refill
+            async with self.lock:
+                while True:
+                    now = time.monotonic()
+                    self.refill(now)
+                    wait_seconds = self.get_wait_seconds(tokens, now)
+                    if wait_seconds <= 0:
+                        break
+                    await asyncio.sleep(wait_seconds)
+                self.available_tokens -= tokens
+                self.available_requests -= 1
+        finally:
+            self.queue_depth -= 1
+        wait_seconds = time.monotonic() - start
+        self.calls_admitted += 1
+        self.total_wait_seconds += wait_seconds
+        self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+
+    def record_response(self, status_code: int, headers: httpx.Headers):
+        """
+        Adapts to the rate limits the service reported in its response.
+        """
+        now = time.monotonic()
+        self.refill(now)
+        if status_code == 429:
+            self.calls_throttled += 1
+            self.rate_fraction = max(self.rate_fraction * self.THROTTLED_RATE_FACTOR, self.MIN_RATE_FRACTION)
+            self.available_tokens = min(self.available_tokens, 0)
+            self.paused_until = max(self.paused_until, now + self.get_retry_after_seconds(headers))
+            logger.info("Azure OpenAI is throttling, lowering the rate to %d%%", self.rate_fraction * 100)
+            return
+        if status_code < 400:
+            self.rate_fraction = min(self.rate_fraction + self.RATE_RECOVERY_FRACTION, 1.0)
+        try:
+            # The service knows about calls from other clients, so its remaining limits can be lower than ours
+            if remaining_tokens := headers.get("x-ratelimit-remaining-tokens"):
+                self.available_tokens = min(self.available_tokens, float(remaining_tokens))
+            if remaining_requests := headers.get("x-ratelimit-remaining-requests"):
+                self.available_requests = min(self.available_requests, float(remaining_requests))
+        except ValueError:
+            pass
+
+    def get_retry_after_seconds(self, headers: httpx.Headers) -> float:
+        try:
+            if retry_after_ms := headers.get("retry-after-ms"):
+                return float(retry_after_ms) / 1000
+            if retry_after := headers.get("retry-after"):
+                return float(retry_after)
+        except ValueError:
+            pass
+        return self.DEFAULT_RETRY_AFTER_SECONDS
+
+
+class RequestTokenEstimator:
+    """
+    Estimates the tokens that Azure OpenAI counts against the rate limit for a chat completion or embeddings call:
+    the tokens of the prompt or input, plus the maximum number of tokens the completion may use.
+    """
+
+    ENCODING_NAME = "o200k_base"
+    TOKENS_PER_MESSAGE = 3
+    # A high detail image takes up to this many tokens, depending on its size
+    TOKENS_PER_IMAGE = 765
+    # Used when a completion has no token limit
+    DEFAULT_COMPLETION_TOKENS = 1024
+
+    def __init__(self):
+        self.encoding = tiktoken.get_encoding(self.ENCODING_NAME)
+
+    def count_text_tokens(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def count_content_tokens(self, content: Any) -> int:
+        if isinstance(content, str):
+            return self.count_text_tokens(content)
+        tokens = 0
+        if isinstance(content, list):
+            for part in content:
+                if not isinstance(part, dict):
+                    continue
+                if part.get("type") == "text":
+                    tokens += self.count_text_tokens(part.get("text", ""))
+                elif part.get("type") == "image_url":
+                    tokens += self.TOKENS_PER_IMAGE
+        return tokens
+
+    def estimate(self, body: dict[str, Any]) -> int:
+        tokens = 0
+        for message in body.get("messages", []):
+            tokens += self.TOKENS_PER_MESSAGE + self.count_content_tokens(message.get("content"))
+        if tools := body.get("tools"):
+            tokens += self.count_text_tokens(json.dumps(tools))
+        if "messages" in body:
+            completion_tokens = (
+                body.get("max_completion_tokens") or body.get("max_tokens") or self.DEFAULT_COMPLETION_TOKENS
+            )
+            tokens += completion_tokens * (body.get("n") or 1)
+        inputs = body.get("input")
+        if isinstance(inputs, str):
+            tokens += self.count_text_tokens(inputs)
+        elif isinstance(inputs, list):
+            for input in inputs:
+                # Inputs may already be lists of token IDs
+                tokens += self.count_text_tokens(input) if isinstance(input, str) else len(input)
+        return max(tokens, 1)
+
+
+class RateLimitingTransport(httpx.AsyncBaseTransport):
+    """
+    An httpx transport for OpenAI clients that admits each call through the rate limiter of the deployment
+    (or for OpenAI.com, the model) it's for, before handing it to the underlying transport.
+    Calls to deployments without a rate limiter are sent right away.
+    """
+
+    def __init__(
+        self,
+        rate_limiters: dict[str, TokenBucketRateLimiter],
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        token_estimator: Optional[RequestTokenEstimator] = None,
+    ):
+        self.rate_limiters = rate_limiters
+        self.transport = transport or httpx.AsyncHTTPTransport()
+        self.token_estimator = token_estimator or RequestTokenEstimator()
+
+    def get_request_body(self, request: httpx.Request) -> dict[str, Any]:
+        if not request.headers.get("content-type", "").startswith("application/json"):
+            return {}
+        try:
+            body = json.loads(request.content)
+        except ValueError:
+            return {}
+        return body if isinstance(body, dict) else {}
+
+    def get_rate_limiter(self, request: httpx.Request, body: dict[str, Any]) -> Optional[TokenBucketRateLimiter]:
+        # Azure OpenAI has the deployment in the path, while OpenAI.com has the model in the body
+        _, has_deployment, deployment_path = request.url.path.partition("/openai/deployments/")
+        if has_deployment:
+            return self.rate_limiters.get(deployment_path.split("/", 1)[0])
+        model = body.get("model")
+        return self.rate_limiters.get(model) if isinstance(model, str) else None
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        body = self.get_request_body(request)
+        rate_limiter = self.get_rate_limiter(request, body)
+        if rate_limiter is None:
+            return await self.transport.handle_async_request(request)
+        await rate_limiter.acquire(self.token_estimator.estimate(body))
+        response = await self.transport.handle_async_request(request)
+        rate_limiter.record_response(response.status_code, response.headers)
+        return response
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
@@ -24,6 +24,11 @@ export type ChatAppRequestOverrides = {
     suggest_followup_questions?: boolean;
     use_oid_security_filter?: boolean;
     use_groups_security_filter?: boolean;
+    speculative_query_embedding?: boolean;
+    include_stage_timings?: boolean;
+    skip_single_turn_query_rewrite?: boolean;
+    use_local_reranker?: boolean;
+    incremental_context?: boolean;
     send_text_sources: boolean;
     send_image_sources: boolean;
     search_text_embeddings: boolean;
@@ -55,6 +60,13 @@ export type ResponseContext = {
     thoughts: Thoughts[];
 };
 
+// Sent while streaming with incremental_context, instead of resending the whole context
+export type ResponseContextPatch = {
+    // Props to merge into the thought at each index
+    thought_props?: { [index: string]: { [key: string]: any } };
+    followup_questions?: string[];
+};
+
 export type ChatAppResponseOrError = {
     message: ResponseMessage;
     delta: ResponseMessage;
@@ -104,6 +116,8 @@ export type Config = {
 
 export type SimpleAPIResponse = {
     message?: string;
+    // Set by /upload when uploaded files are ingested in the background
+    job_id?: string;
 };
 
 export interface SpeechConfig {
@@ -7,7 +7,18 @@ import readNDJSONStream from "ndjson-readablestream";
 import styles from "./Chat.module.css";
 import { useChatContext } from "../../contexts/ChatContext";
 
-import { chatApi, configApi, RetrievalMode, ChatAppResponse, ChatAppResponseOrError, ChatAppRequest, ResponseMessage, SpeechConfig } from "../../api";
+import {
+    chatApi,
+    configApi,
+    RetrievalMode,
+    ChatAppResponse,
+    ChatAppResponseOrError,
+    ChatAppRequest,
+    ResponseContext,
+    ResponseContextPatch,
+    ResponseMessage,
+    SpeechConfig
+} from "../../api";
 import { Answer, AnswerError, AnswerLoading } from "../../components/Answer";
 import { QuestionInput } from "../../components/QuestionInput";
 import { ExampleList } from "../../components/Example";
@@ -26,6 +37,14 @@ import { LoginContext } from "../../loginContext";
 import { LanguagePicker } from "../../i18n/LanguagePicker";
 import { Settings } from "../../components/Settings/Settings";
 
+const applyContextPatch = (context: ResponseContext, patch: ResponseContextPatch): ResponseContext => {
+    const { thought_props, ...rest } = patch;
+    const thoughts = context.thoughts.map((thought, index) =>
+        thought_props && thought_props[index] ? { ...thought, props: { ...thought.props, ...thought_props[index] } } : thought
+    );
+    return { ...context, ...rest, thoughts };
+};
+
 const Chat = () => {
     const [isConfigPanelOpen, setIsConfigPanelOpen] = useState(false);
     const [isHistoryPanelOpen, setIsHistoryPanelOpen] = useState(false);
@@ -161,6 +180,8 @@ const Chat = () => {
                 } else if (event["delta"] && event["delta"]["content"]) {
                     setIsLoading(false);
                     await updateState(event["delta"]["content"]);
+                } else if (event["context_patch"]) {
+                    askResponse.context = applyContextPatch(askResponse.context, event["context_patch"]);
                 } else if (event["context"]) {
                     // Update context with new keys from latest event
                     askResponse.context = { ...askResponse.context, ...event["context"] };
@@ -231,6 +252,7 @@ const Chat = () => {
                         send_image_sources: sendImageSources,
                         language: i18n.language,
                         use_agentic_retrieval: useAgenticRetrieval,
+                        incremental_context: shouldStream,
                         ...(seed !== null ? { seed: seed } : {})
                     }
                 },
@@ -0,0 +1,85 @@
+import time
+
+import pytest
+
+from core.answercache import AnswerCacheKey, SemanticAnswerCache
+
+
+def cache_answer(cache: SemanticAnswerCache, partition_key: str, vector: list[float], response):
+    cache.set(AnswerCacheKey(partition_key, vector, cache.generation), response)
+
+
+@pytest.mark.asyncio
+async def test_answercache_similar_question_hit():
+    cache = SemanticAnswerCache(similarity_threshold=0.95)
+    cache_answer(cache, "partition", [1.0, 0.0, 0.0], "whistleblower answer")
+    cache_answer(cache, "partition", [0.0, 1.0, 0.0], "holiday answer")
+
+    # Vectors are compared by direction, not magnitude
+    assert await cache.get("partition", [2.0, 0.1, 0.0]) == "whistleblower answer"
+    assert await cache.get("partition", [0.0, 0.5, 0.0]) == "holiday answer"
+    assert await cache.get("partition", [1.0, 1.0, 0.0]) is None
+    assert cache.hits == 2
+    assert cache.misses == 1
+
+
+@pytest.mark.asyncio
+async def test_answercache_partitioned():
+    cache = SemanticAnswerCache()
+    cache_answer(cache, "partition_a", [1.0, 0.0], "answer")
+
+    assert await cache.get("partition_b", [1.0, 0.0]) is None
+    assert SemanticAnswerCache.get_partition_key(
+        "ChatReadRetrieveReadApproach", "oids/any(g:search.in(g, 'OID_X'))", {"top": 3}, stream=False
+    ) != SemanticAnswerCache.get_partition_key(
+        "ChatReadRetrieveReadApproach", "oids/any(g:search.in(g, 'OID_Y'))", {"top": 3}, stream=False
+    )
+
+
+@pytest.mark.asyncio
+async def test_answercache_expires(monkeypatch):
+    cache = SemanticAnswerCache(ttl_seconds=60)
+    cache_answer(cache, "partition", [1.0, 0.0], "answer")
+
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 61)
+    assert await cache.get("partition", [1.0, 0.0]) is None
+
+
+@pytest.mark.asyncio
+async def test_answercache_invalidate():
+    cache = SemanticAnswerCache()
+    key = AnswerCacheKey("partition", [1.0, 0.0], cache.generation)
+    cache_answer(cache, "partition", [1.0, 0.0], "answer")
+
+    cache.invalidate()
+    assert await cache.get("partition", [1.0, 0.0]) is None
+
+    # Answers generated before the invalidation are not stored
+    cache.set(key, "stale answer")
+    assert await cache.get("partition", [1.0, 0.0]) is None
+
+
+@pytest.mark.asyncio
+async def test_answercache_evicts_oldest_in_partition():
+    cache = SemanticAnswerCache(max_answers_per_partition=2)
+    cache_answer(cache, "partition", [1.0, 0.0, 0.0], "first")
+    cache_answer(cache, "partition", [0.0, 1.0, 0.0], "second")
+    cache_answer(cache, "partition", [0.0, 0.0, 1.0], "third")
+
+    assert await cache.get("partition", [1.0, 0.0, 0.0]) is None
+    assert await cache.get("partition", [0.0, 1.0, 0.0]) == "second"
+    assert await cache.get("partition", [0.0, 0.0, 1.0]) == "third"
+
+
+@pytest.mark.asyncio
+async def test_answercache_skips_duplicate_answers():
+    cache = SemanticAnswerCache(max_answers_per_partition=2)
+    cache_answer(cache, "partition", [1.0, 0.0, 0.0], "first")
+    # Coalesced requests for the same question store the same answer
+    for _ in range(3):
+        cache_answer(cache, "partition", [0.0, 1.0, 0.0], "second")
+
+    assert len(cache.partitions.get("partition")) == 2
+    assert await cache.get("partition", [1.0, 0.0, 0.0]) == "first"
+    assert await cache.get("partition", [0.0, 1.0, 0.0]) == "second"
@@ -1,13 +1,16 @@
+import dataclasses
 import json
 import os
 from unittest import mock
 
 import pytest
+import quart
 import quart.testing.app
 from httpx import Request, Response
 from openai import BadRequestError
 
 import app
+from approaches.approach import DataPoints, ExtraInfo, ThoughtStep, TokenUsageProps
 
 
 def fake_response(http_code):
@@ -1065,6 +1068,36 @@ async def test_chat_stream_followup(client, snapshot):
     snapshot.assert_match(result, "result.jsonlines")
 
 
+@pytest.mark.asyncio
+async def test_chat_stream_incremental_context(client):
+    response = await client.post(
+        "/chat/stream",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {
+                "overrides": {
+                    "suggest_followup_questions": True,
+                    "incremental_context": True,
+                },
+            },
+        },
+    )
+    assert response.status_code == 200
+    events = [json.loads(line) for line in (await response.get_data()).decode().splitlines()]
+
+    # The full context is only sent in the first event
+    assert "data_points" in events[0]["context"]
+    assert all("context" not in event for event in events[1:])
+    patches = [event["context_patch"] for event in events if "context_patch" in event]
+    answer_thought_index = str(len(events[0]["context"]["thoughts"]) - 1)
+    # Follow-up questions are sent as soon as they are complete, before the usage at the end of the stream
+    assert patches == [
+        {"followup_questions": ["What is the capital of Spain?"]},
+        {"thought_props": {answer_thought_index: {"token_usage": mock.ANY}}},
+    ]
+    assert patches[1]["thought_props"][answer_thought_index]["token_usage"]["total_tokens"] == 919
+
+
 @pytest.mark.asyncio
 async def test_chat_vision(monkeypatch, vision_client, snapshot):
     response = await vision_client.post(
@@ -1119,3 +1152,34 @@ async def test_format_as_ndjson():
 
     result = [line async for line in app.format_as_ndjson(gen())]
     assert result == ['{"a": "I ❤️ 🐍"}\n', '{"b": "Newlines inside \\n strings are fine"}\n']
+
+
+@pytest.mark.asyncio
+async def test_format_as_ndjson_coalesced():
+    async def gen():
+        yield {"delta": {"content": "I ❤️ ", "role": "assistant"}}
+        yield {"delta": {"content": "🐍", "role": "assistant"}}
+        yield {"delta": {"role": "assistant"}, "context": {"followup_questions": []}}
+
+    result = [line async for line in app.format_as_ndjson(gen(), coalesce_seconds=60)]
+    assert result == [
+        '{"delta": {"content": "I ❤️ 🐍", "role": "assistant"}}\n',
+        '{"delta": {"role": "assistant"}, "context": {"followup_questions": []}}\n',
+    ]
+
+
+def test_json_encoder_response_models():
+    usage = TokenUsageProps(prompt_tokens=10, completion_tokens=5, reasoning_tokens=None, total_tokens=15)
+    extra_info = ExtraInfo(
+        DataPoints(
+            text=["Benefit_Options-2.pdf: There is a whistleblower policy."], citations=["Benefit_Options-2.pdf"]
+        ),
+        thoughts=[
+            ThoughtStep("Prompt to generate answer", [{"role": "user", "content": "Hi"}], {"token_usage": usage})
+        ],
+    )
+
+    # The models serialize the same way as dataclasses.asdict, without copying their fields
+    assert json.loads(json.dumps(extra_info, cls=app.JSONEncoder)) == dataclasses.asdict(extra_info)
+    assert json.loads(app.JSONProvider(quart.Quart(__name__)).dumps(extra_info)) == dataclasses.asdict(extra_info)
+    assert extra_info.to_json_dict()["thoughts"] is extra_info.thoughts
@@ -114,6 +114,21 @@ async def test_app_user_upload_processors_docint_localhtml(monkeypatch, minimal_
         assert ingester.file_processors[".html"] is not ingester.file_processors[".pptx"]
 
 
+@pytest.mark.asyncio
+async def test_app_openai_rate_limiters_split_between_processes(monkeypatch, minimal_env):
+    monkeypatch.setenv("AZURE_OPENAI_CHATGPT_DEPLOYMENT", "chat")
+    monkeypatch.setenv("AZURE_OPENAI_EMB_DEPLOYMENT", "embedding")
+    monkeypatch.setenv("USE_OPENAI_RATE_LIMITER", "true")
+    monkeypatch.setenv("AZURE_OPENAI_CHATGPT_DEPLOYMENT_CAPACITY", "30")
+    monkeypatch.setenv("OPENAI_RATE_LIMITER_PROCESSES", "4")
+
+    quart_app = app.create_app()
+    async with quart_app.test_app():
+        rate_limiters = quart_app.config[app.CONFIG_OPENAI_RATE_LIMITERS]
+        assert rate_limiters["chat"].tokens_per_minute == 7500
+        assert rate_limiters["embedding"].tokens_per_minute == 7500
+
+
 @pytest.mark.asyncio
 async def test_app_config_default(monkeypatch, minimal_env):
     quart_app = app.create_app()
@@ -202,6 +217,26 @@ async def test_app_config_user_upload(monkeypatch, minimal_env):
         assert result["showUserUpload"] is True
 
 
+@pytest.mark.asyncio
+async def test_app_config_user_upload_queue_requires_single_worker(monkeypatch, minimal_env):
+    monkeypatch.setenv("AZURE_USERSTORAGE_ACCOUNT", "test-user-storage-account")
+    monkeypatch.setenv("AZURE_USERSTORAGE_CONTAINER", "test-user-storage-container")
+    monkeypatch.setenv("USE_USER_UPLOAD", "true")
+    monkeypatch.setenv("USE_USER_UPLOAD_QUEUE", "true")
+    monkeypatch.setenv("GUNICORN_WORKERS", "3")
+    quart_app = app.create_app()
+    with pytest.raises(
+        quart.testing.app.LifespanError, match="USE_USER_UPLOAD_QUEUE requires a single Gunicorn worker"
+    ):
+        async with quart_app.test_app() as test_app:
+            test_app.test_client()
+
+    monkeypatch.setenv("GUNICORN_WORKERS", "1")
+    quart_app = app.create_app()
+    async with quart_app.test_app():
+        assert quart_app.config[app.CONFIG_INGESTION_QUEUE] is not None
+
+
 @pytest.mark.asyncio
 async def test_app_config_user_upload_novectors(monkeypatch, minimal_env):
     """Check that this combo works correctly with prepdocs.py embedding service."""
@@ -1,15 +1,16 @@
+import asyncio
 import base64
 import json
-import re
+import time
 from datetime import datetime, timedelta, timezone
 
 import aiohttp
 import jwt
+import msal
 import pytest
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.models import SearchField, SearchIndex
-from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 
 from core.authentication import AuthenticationHelper, AuthError
@@ -111,6 +112,138 @@ async def test_get_auth_claims_overage_unauthorized(
     assert len(auth_claims.keys()) == 0
 
 
+@pytest.fixture
+def mock_validate_token_with_expiry(monkeypatch):
+    def patch(exp: float):
+        async def mock_validate_access_token(self, token):
+            return {"oid": "OID_X", "exp": exp}
+
+        monkeypatch.setattr(AuthenticationHelper, "validate_access_token", mock_validate_access_token)
+
+    return patch
+
+
+def count_calls(monkeypatch, cls, name):
+    calls = []
+    original = getattr(cls, name)
+
+    def wrapper(*args, **kwargs):
+        calls.append(kwargs)
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(cls, name, wrapper)
+    return calls
+
+
+@pytest.mark.asyncio
+async def test_get_auth_claims_cached_per_token(
+    monkeypatch, mock_confidential_client_success, mock_validate_token_with_expiry
+):
+    mock_validate_token_with_expiry(time.time() + 3600)
+    obo_calls = count_calls(monkeypatch, msal.ConfidentialClientApplication, "acquire_token_on_behalf_of")
+    helper = create_authentication_helper()
+
+    for _ in range(20):
+        auth_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"})
+        assert auth_claims == {"oid": "OID_X", "groups": ["GROUP_Y", "GROUP_Z"]}
+    assert len(obo_calls) == 1
+    assert helper.auth_claims_cache.hits == 19
+
+    # Callers modifying the returned claims must not affect the cached copy
+    auth_claims["groups"].append("GROUP_INJECTED")
+    assert (await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"}))["groups"] == [
+        "GROUP_Y",
+        "GROUP_Z",
+    ]
+
+    # A different token is validated on its own
+    await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer OtherToken"})
+    assert len(obo_calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_get_auth_claims_overage_cached_per_token(
+    monkeypatch, mock_confidential_client_overage, mock_list_groups_success, mock_validate_token_with_expiry
+):
+    mock_validate_token_with_expiry(time.time() + 3600)
+    helper = create_authentication_helper()
+
+    # mock_list_groups_success raises if Graph is called more than once
+    for _ in range(5):
+        auth_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"})
+        assert auth_claims == {"oid": "OID_X", "groups": ["OVERAGE_GROUP_Y", "OVERAGE_GROUP_Z"]}
+
+
+@pytest.mark.asyncio
+async def test_get_auth_claims_not_cached_when_expiring(
+    monkeypatch, mock_confidential_client_success, mock_validate_token_with_expiry
+):
+    mock_validate_token_with_expiry(time.time() + 5)
+    obo_calls = count_calls(monkeypatch, msal.ConfidentialClientApplication, "acquire_token_on_behalf_of")
+    helper = create_authentication_helper()
+
+    await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"})
+    await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"})
+    assert len(obo_calls) == 2
+    assert len(helper.auth_claims_cache) == 0
+
+
+@pytest.mark.asyncio
+async def test_get_auth_claims_unauthorized_not_cached(
+    monkeypatch, mock_confidential_client_unauthorized, mock_validate_token_with_expiry
+):
+    mock_validate_token_with_expiry(time.time() + 3600)
+    helper = create_authentication_helper()
+
+    assert await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"}) == {}
+    assert len(helper.auth_claims_cache) == 0
+
+
+@pytest.mark.asyncio
+async def test_get_auth_claims_overage_groups_cached_per_user(
+    monkeypatch, mock_confidential_client_overage, mock_list_groups_success, mock_validate_token_with_expiry
+):
+    mock_validate_token_with_expiry(time.time() + 3600)
+    helper = create_authentication_helper()
+
+    # A refreshed token for the same user reuses the groups listed for the previous one
+    for token in ["Token", "RefreshedToken"]:
+        auth_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": f"Bearer {token}"})
+        assert auth_claims == {"oid": "OID_X", "groups": ["OVERAGE_GROUP_Y", "OVERAGE_GROUP_Z"]}
+    assert helper.groups_cache.crawl_count == 1
+    assert helper.groups_cache.crawl_pages == 2
+
+
+@pytest.mark.asyncio
+async def test_get_user_groups_concurrent_single_crawl(mock_confidential_client_success, mock_list_groups_success):
+    helper = create_authentication_helper()
+
+    # mock_list_groups_success raises if the groups are listed more than once
+    results = await asyncio.gather(*[helper.get_user_groups("OID_X", {"access_token": "MockToken"}) for _ in range(10)])
+    assert all(groups == ["OVERAGE_GROUP_Y", "OVERAGE_GROUP_Z"] for groups in results)
+    assert helper.groups_cache.crawl_count == 1
+    assert helper.groups_cache.inflight.shared_calls == 9
+
+    # Callers modifying the returned groups must not affect the cached copy
+    results[0].append("GROUP_INJECTED")
+    assert await helper.get_user_groups("OID_X", {"access_token": "MockToken"}) == [
+        "OVERAGE_GROUP_Y",
+        "OVERAGE_GROUP_Z",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_get_user_groups_cache_expires(monkeypatch, mock_confidential_client_success, mock_list_groups_success):
+    helper = create_authentication_helper()
+    await helper.get_user_groups("OID_X", {"access_token": "MockToken"})
+
+    # Once the memberships are stale they are listed again
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + helper.groups_cache.groups.ttl_seconds + 1)
+    with pytest.raises(Exception, match="too many runs"):
+        await helper.get_user_groups("OID_X", {"access_token": "MockToken"})
+
+
 @pytest.mark.asyncio
 async def test_list_groups_success(mock_list_groups_success, mock_validate_token_success):
     groups = await AuthenticationHelper.list_groups(graph_resource_access_token={"access_token": "MockToken"})
@@ -519,133 +652,206 @@ async def test_check_path_auth_allowed_public_without_access_control(
 
 
 @pytest.mark.asyncio
-async def test_create_pem_format(mock_confidential_client_success, mock_validate_token_success):
-    helper = create_authentication_helper()
-    mock_token, public_key, payload = create_mock_jwt(oid="OID_X")
-    _, other_public_key, _ = create_mock_jwt(oid="OID_Y")
-    mock_jwks = {
-        "keys": [
-            # Include a key with a different KID to ensure the correct key is selected
-            {
-                "kty": "RSA",
-                "kid": "other_mock_kid",
-                "use": "sig",
-                "n": base64.urlsafe_b64encode(
-                    other_public_key.public_numbers().n.to_bytes(
-                        (other_public_key.public_numbers().n.bit_length() + 7) // 8, byteorder="big"
-                    )
-                )
-                .decode("utf-8")
-                .rstrip("="),
-                "e": base64.urlsafe_b64encode(
-                    other_public_key.public_numbers().e.to_bytes(
-                        (other_public_key.public_numbers().e.bit_length() + 7) // 8, byteorder="big"
-                    )
-                )
-                .decode("utf-8")
-                .rstrip("="),
-            },
-            {
-                "kty": "RSA",
-                "kid": "mock_kid",
-                "use": "sig",
-                "n": base64.urlsafe_b64encode(
-                    public_key.public_numbers().n.to_bytes(
-                        (public_key.public_numbers().n.bit_length() + 7) // 8, byteorder="big"
-                    )
-                )
-                .decode("utf-8")
-                .rstrip("="),
-                "e": base64.urlsafe_b64encode(
-                    public_key.public_numbers().e.to_bytes(
-                        (public_key.public_numbers().e.bit_length() + 7) // 8, byteorder="big"
-                    )
-                )
-                .decode("utf-8")
-                .rstrip("="),
-            },
-        ]
-    }
+async def test_check_path_auth_cached(monkeypatch, mock_confidential_client_success, mock_validate_token_success):
+    auth_helper_require_access_control = create_authentication_helper(require_access_control=True)
+    filters = []
+
+    async def mock_search(self, *args, **kwargs):
+        filters.append(kwargs.get("filter"))
+        return MockAsyncPageIterator(data=[{"sourcepage": "Benefit_Options-2.pdf"}])
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    for path in ["Benefit_Options-2.pdf", "Benefit_Options-2.pdf#page=2", "Benefit_Options-2.pdf"]:
+        assert await auth_helper_require_access_control.check_path_auth(
+            path=path,
+            auth_claims={"oid": "OID_X", "groups": ["GROUP_Y", "GROUP_Z"]},
+            search_client=create_search_client(),
+        )
+    assert len(filters) == 1
+
+    # A different user is checked on their own
+    assert await auth_helper_require_access_control.check_path_auth(
+        path="Benefit_Options-2.pdf", auth_claims={"oid": "OID_Y"}, search_client=create_search_client()
+    )
+    assert len(filters) == 2
+    assert filters[1].startswith("(oids/any(g:search.in(g, 'OID_Y')) or groups/any(g:search.in(g, '')))")
+
+
+@pytest.mark.asyncio
+async def test_check_path_auth_denied_cached_briefly(
+    monkeypatch, mock_confidential_client_success, mock_validate_token_success
+):
+    auth_helper_require_access_control = create_authentication_helper(require_access_control=True)
+    search_calls = 0
+
+    async def mock_search(self, *args, **kwargs):
+        nonlocal search_calls
+        search_calls += 1
+        return MockAsyncPageIterator(data=[])
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    async def check_path_auth():
+        return await auth_helper_require_access_control.check_path_auth(
+            path="Benefit_Options-2.pdf", auth_claims={"oid": "OID_X"}, search_client=create_search_client()
+        )
 
-    pem_key = await helper.create_pem_format(mock_jwks, mock_token)
+    assert await check_path_auth() is False
+    assert await check_path_auth() is False
+    assert search_calls == 1
 
-    # Assert that the result is bytes
-    assert isinstance(pem_key, bytes), "create_pem_format should return bytes"
+    # Denials expire before allowed decisions would
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + AuthenticationHelper.PATH_AUTH_DENY_TTL_SECONDS + 1)
+    assert await check_path_auth() is False
+    assert search_calls == 2
 
-    # Convert bytes to string for regex matching
-    pem_str = pem_key.decode("utf-8")
 
-    # Assert that the key starts and ends with the correct markers
-    assert pem_str.startswith("-----BEGIN PUBLIC KEY-----"), "PEM key should start with the correct marker"
-    assert pem_str.endswith("-----END PUBLIC KEY-----\n"), "PEM key should end with the correct marker"
+def test_build_security_filters_cached(mock_confidential_client_success, mock_validate_token_success):
+    auth_helper = create_authentication_helper(require_access_control=True)
+    auth_claims = {"oid": "OID_X", "groups": ["GROUP_Y", "GROUP_Z"]}
 
-    # Assert that the format matches the structure of a PEM key
-    pem_regex = r"^-----BEGIN PUBLIC KEY-----\n([A-Za-z0-9+/\n]+={0,2})\n-----END PUBLIC KEY-----\n$"
-    assert re.match(pem_regex, pem_str), "PEM key format is incorrect"
+    security_filter = auth_helper.build_security_filters(overrides={}, auth_claims=auth_claims)
+    assert auth_helper.build_security_filters(overrides={}, auth_claims=auth_claims) is security_filter
+    assert auth_helper.security_filter_cache.hits == 1
 
-    # Verify that the key can be used to decode the token
-    try:
-        decoded = jwt.decode(
-            mock_token, key=pem_key, algorithms=["RS256"], audience=payload["aud"], issuer=payload["iss"]
+    # Different groups produce a different filter
+    assert (
+        auth_helper.build_security_filters(overrides={}, auth_claims={"oid": "OID_X", "groups": ["GROUP_Y"]})
+        == "(oids/any(g:search.in(g, 'OID_X')) or groups/any(g:search.in(g, 'GROUP_Y')))"
+    )
+
+
+def create_mock_jwk(public_key, kid="mock_kid"):
+    def encode_int(value: int) -> str:
+        return (
+            base64.urlsafe_b64encode(value.to_bytes((value.bit_length() + 7) // 8, byteorder="big"))
+            .decode("utf-8")
+            .rstrip("=")
         )
-        assert decoded["oid"] == payload["oid"], "Decoded token should contain correct OID"
-    except Exception as e:
-        pytest.fail(f"jwt.decode raised an unexpected exception: {str(e)}")
 
-    # Try to load the key using cryptography library to ensure it's a valid PEM format
-    try:
-        loaded_public_key = serialization.load_pem_public_key(pem_key)
-        assert isinstance(loaded_public_key, rsa.RSAPublicKey), "Loaded key should be an RSA public key"
-    except Exception as e:
-        pytest.fail(f"Failed to load PEM key: {str(e)}")
+    return {
+        "kty": "RSA",
+        "use": "sig",
+        "kid": kid,
+        "n": encode_int(public_key.public_numbers().n),
+        "e": encode_int(public_key.public_numbers().e),
+        "issuer": "https://login.microsoftonline.com/TENANT_ID/v2.0",
+    }
+
+
+def mock_jwks_endpoint(monkeypatch, *jwks_responses):
+    """Serves each JWKS document in turn (repeating the last one), and records every request made"""
+    calls = []
+
+    def mock_get(*args, **kwargs):
+        calls.append(kwargs.get("url"))
+        jwks = jwks_responses[min(len(calls), len(jwks_responses)) - 1]
+        return MockResponse(status=200, text=json.dumps(jwks))
+
+    monkeypatch.setattr(aiohttp.ClientSession, "get", mock_get)
+    return calls
 
 
 @pytest.mark.asyncio
 async def test_validate_access_token(monkeypatch, mock_confidential_client_success):
     mock_token, public_key, payload = create_mock_jwt(oid="OID_X")
+    _, other_public_key, _ = create_mock_jwt(oid="OID_Y")
+    calls = mock_jwks_endpoint(
+        monkeypatch, {"keys": [create_mock_jwk(other_public_key, kid="23nt"), create_mock_jwk(public_key)]}
+    )
 
-    def mock_get(*args, **kwargs):
-        return MockResponse(
-            status=200,
-            text=json.dumps(
-                {
-                    "keys": [
-                        {
-                            "kty": "RSA",
-                            "use": "sig",
-                            "kid": "23nt",
-                            "x5t": "23nt",
-                            "n": "hu2SJ",
-                            "e": "AQAB",
-                            "x5c": ["MIIC/jCC"],
-                            "issuer": "https://login.microsoftonline.com/TENANT_ID/v2.0",
-                        },
-                        {
-                            "kty": "RSA",
-                            "use": "sig",
-                            "kid": "MGLq",
-                            "x5t": "MGLq",
-                            "n": "yfNcG8",
-                            "e": "AQAB",
-                            "x5c": ["MIIC/jCC"],
-                            "issuer": "https://login.microsoftonline.com/TENANT_ID/v2.0",
-                        },
-                    ]
-                }
-            ),
-        )
+    helper = create_authentication_helper()
+    await helper.validate_access_token(mock_token)
+    assert calls == ["https://login.microsoftonline.com/TENANT_ID/discovery/v2.0/keys"]
 
-    monkeypatch.setattr(aiohttp.ClientSession, "get", mock_get)
 
-    def mock_decode(*args, **kwargs):
-        return payload
+@pytest.mark.asyncio
+async def test_validate_access_token_invalid_signature(monkeypatch, mock_confidential_client_success):
+    mock_token, _, _ = create_mock_jwt(oid="OID_X")
+    _, other_public_key, _ = create_mock_jwt(oid="OID_Y")
+    mock_jwks_endpoint(monkeypatch, {"keys": [create_mock_jwk(other_public_key)]})
+
+    helper = create_authentication_helper()
+    with pytest.raises(AuthError) as exc_info:
+        await helper.validate_access_token(mock_token)
+    assert exc_info.value.error == "Unable to parse authorization token."
+
+
+@pytest.mark.asyncio
+async def test_validate_access_token_uses_cached_keys(monkeypatch, mock_confidential_client_success):
+    mock_token, public_key, _ = create_mock_jwt(oid="OID_X")
+    calls = mock_jwks_endpoint(monkeypatch, {"keys": [create_mock_jwk(public_key)]})
+
+    helper = create_authentication_helper()
+    for _ in range(3):
+        await helper.validate_access_token(mock_token)
+
+    assert len(calls) == 1
+    assert helper.jwks_cache.misses == 1
+    assert helper.jwks_cache.hits == 2
+
+
+@pytest.mark.asyncio
+async def test_jwks_cache_concurrent_lookups_share_refresh(monkeypatch, mock_confidential_client_success):
+    mock_token, public_key, _ = create_mock_jwt(oid="OID_X")
+    calls = mock_jwks_endpoint(monkeypatch, {"keys": [create_mock_jwk(public_key)]})
+
+    helper = create_authentication_helper()
+    await asyncio.gather(*(helper.validate_access_token(mock_token) for _ in range(3)))
+
+    # The lookups that waited for the refresh found the key it fetched
+    assert len(calls) == 1
+    assert helper.jwks_cache.misses == 1
+    assert helper.jwks_cache.hits == 2
+
+
+@pytest.mark.asyncio
+async def test_validate_access_token_refetches_unknown_kid(monkeypatch, mock_confidential_client_success):
+    old_token, old_public_key, _ = create_mock_jwt(kid="old_kid", oid="OID_X")
+    new_token, new_public_key, _ = create_mock_jwt(kid="new_kid", oid="OID_X")
+    calls = mock_jwks_endpoint(
+        monkeypatch,
+        {"keys": [create_mock_jwk(old_public_key, kid="old_kid")]},
+        {"keys": [create_mock_jwk(old_public_key, kid="old_kid"), create_mock_jwk(new_public_key, kid="new_kid")]},
+    )
+
+    helper = create_authentication_helper()
+    helper.jwks_cache.min_refresh_interval_seconds = 0
+    await helper.validate_access_token(old_token)
+    # The keys were rotated, so the first token signed with the new key triggers exactly one refresh
+    await helper.validate_access_token(new_token)
+    await helper.validate_access_token(new_token)
+    assert len(calls) == 2
+    assert helper.jwks_cache.refreshes == 2
+    assert helper.jwks_cache.hits == 1
+
+
+@pytest.mark.asyncio
+async def test_validate_access_token_unknown_kid_refresh_rate_limited(monkeypatch, mock_confidential_client_success):
+    mock_token, public_key, _ = create_mock_jwt(oid="OID_X")
+    bogus_token, _, _ = create_mock_jwt(kid="bogus_kid", oid="OID_X")
+    calls = mock_jwks_endpoint(monkeypatch, {"keys": [create_mock_jwk(public_key)]})
 
-    monkeypatch.setattr(jwt, "decode", mock_decode)
+    helper = create_authentication_helper()
+    await helper.validate_access_token(mock_token)
+    for _ in range(3):
+        with pytest.raises(AuthError) as exc_info:
+            await helper.validate_access_token(bogus_token)
+        assert exc_info.value.error == "Unable to find appropriate key"
+    assert len(calls) == 1
 
-    async def mock_create_pem_format(*args, **kwargs):
-        return public_key
 
-    monkeypatch.setattr(AuthenticationHelper, "create_pem_format", mock_create_pem_format)
+@pytest.mark.asyncio
+async def test_jwks_cache_expires(monkeypatch, mock_confidential_client_success):
+    mock_token, public_key, _ = create_mock_jwt(oid="OID_X")
+    calls = mock_jwks_endpoint(monkeypatch, {"keys": [create_mock_jwk(public_key)]})
 
     helper = create_authentication_helper()
     await helper.validate_access_token(mock_token)
+    helper.jwks_cache.fetched_at -= helper.jwks_cache.ttl_seconds
+    assert helper.jwks_cache.is_expired()
+    await helper.validate_access_token(mock_token)
+    assert len(calls) == 2
+    assert not helper.jwks_cache.is_expired()
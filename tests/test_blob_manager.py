@@ -1,14 +1,27 @@
+import asyncio
+import io
 import os
 import sys
 from tempfile import NamedTemporaryFile
 from unittest.mock import MagicMock
 
+import azure.storage.blob
 import azure.storage.blob.aio
 import azure.storage.filedatalake.aio
 import pytest
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from azure.storage.blob import StorageErrorCode
 
 # The pythonpath is configured in pyproject.toml to include app/backend
-from prepdocslib.blobmanager import AdlsBlobManager, BlobManager
+from prepdocslib.blobcache import BlobContentCache
+from prepdocslib.blobmanager import (
+    AdlsBlobManager,
+    BlobManager,
+    StorageCallCounter,
+    current_storage_calls,
+    record_storage_call,
+)
 from prepdocslib.listfilestrategy import File
 
 from .mocks import MockAzureCredential
@@ -344,14 +357,263 @@ async def test_download_blob_not_found(monkeypatch, mock_env, mock_blob_containe
 
 
 @pytest.mark.asyncio
-async def test_download_blob_container_not_exist(
-    monkeypatch, mock_env, mock_blob_container_client_does_not_exist, blob_manager
-):
+async def test_download_blob_container_not_exist(monkeypatch, mock_env, blob_manager):
+    async def mock_exists(*args, **kwargs):
+        assert False, "exists() shouldn't be called on downloads"  # pragma: no cover
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.exists", mock_exists)
+
+    async def mock_download_blob(*args, **kwargs):
+        error = ResourceNotFoundError("Container not found")
+        error.error_code = StorageErrorCode.CONTAINER_NOT_FOUND
+        raise error
+
+    monkeypatch.setattr("azure.storage.blob.aio.BlobClient.download_blob", mock_download_blob)
+
     result = await blob_manager.download_blob("test_document.pdf")
 
     assert result is None
 
 
+@pytest.mark.asyncio
+async def test_upload_checks_container_once(monkeypatch, mock_env, blob_manager):
+    exists_calls = []
+
+    async def mock_exists(*args, **kwargs):
+        exists_calls.append(True)
+        return True
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.exists", mock_exists)
+
+    async def mock_upload_blob(self, name, *args, **kwargs):
+        return azure.storage.blob.aio.BlobClient.from_blob_url(
+            f"https://test.blob.core.windows.net/test/{name}", credential=MockAzureCredential()
+        )
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.upload_blob", mock_upload_blob)
+
+    for image_page_num in range(3):
+        await blob_manager.upload_to_container(blob_manager.container, f"page{image_page_num}.png", b"image")
+
+    assert len(exists_calls) == 1
+    assert blob_manager.get_container_client(blob_manager.container) is blob_manager.get_container_client(
+        blob_manager.container
+    )
+
+
+@pytest.mark.asyncio
+async def test_upload_creates_deleted_container(monkeypatch, mock_env, blob_manager):
+    # The container existed when it was first checked, but was deleted since
+    blob_manager.verified_containers.add(blob_manager.container)
+    created_containers = []
+
+    async def mock_create_container(self, *args, **kwargs):
+        created_containers.append(self.container_name)
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.create_container", mock_create_container)
+
+    async def mock_upload_blob(self, name, data, *args, **kwargs):
+        if not created_containers:
+            error = ResourceNotFoundError("Container not found")
+            error.error_code = StorageErrorCode.CONTAINER_NOT_FOUND
+            raise error
+        assert data.read() == b"content"
+        return azure.storage.blob.aio.BlobClient.from_blob_url(
+            "https://test.blob.core.windows.net/test/test.pdf", credential=MockAzureCredential()
+        )
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.upload_blob", mock_upload_blob)
+
+    data = io.BytesIO(b"content")
+    data.read()
+    blob_client = await blob_manager.upload_to_container(blob_manager.container, "test.pdf", data)
+
+    assert blob_client.url == "https://test.blob.core.windows.net/test/test.pdf"
+    assert created_containers == [blob_manager.container]
+    assert blob_manager.container in blob_manager.verified_containers
+
+
+@pytest.mark.asyncio
+async def test_upload_reraises_blob_not_found(monkeypatch, mock_env, blob_manager):
+    blob_manager.verified_containers.add(blob_manager.container)
+
+    async def mock_upload_blob(*args, **kwargs):
+        raise ResourceNotFoundError("Not found")
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.upload_blob", mock_upload_blob)
+
+    with pytest.raises(ResourceNotFoundError):
+        await blob_manager.upload_to_container(blob_manager.container, "test.pdf", b"content")
+
+
+def test_count_storage_calls():
+    storage_calls = StorageCallCounter()
+    token = current_storage_calls.set(storage_calls)
+    try:
+        record_storage_call(MagicMock())
+        record_storage_call(MagicMock())
+    finally:
+        current_storage_calls.reset(token)
+    # Calls made outside of a counted context aren't counted
+    record_storage_call(MagicMock())
+
+    assert storage_calls.calls == 2
+
+
+@pytest.mark.asyncio
+async def test_get_blob_etag(monkeypatch, mock_env, blob_manager):
+    class MockBlobProperties:
+        etag = '"0x8DC1"'
+
+    async def mock_get_blob_properties(self, *args, **kwargs):
+        assert self.blob_name == "test_document.pdf"
+        return MockBlobProperties()
+
+    monkeypatch.setattr("azure.storage.blob.aio.BlobClient.get_blob_properties", mock_get_blob_properties)
+
+    assert await blob_manager.get_blob_etag("test_document.pdf") == '"0x8DC1"'
+
+
+@pytest.mark.asyncio
+async def test_get_blob_etag_not_found(monkeypatch, mock_env, blob_manager):
+    async def mock_get_blob_properties(*args, **kwargs):
+        from azure.core.exceptions import ResourceNotFoundError
+
+        raise ResourceNotFoundError("Blob not found")
+
+    monkeypatch.setattr("azure.storage.blob.aio.BlobClient.get_blob_properties", mock_get_blob_properties)
+
+    assert await blob_manager.get_blob_etag("test_document.pdf") is None
+
+
+@pytest.mark.asyncio
+async def test_get_blob_properties(monkeypatch, mock_env, blob_manager):
+    class MockBlobProperties:
+        etag = '"0x8DC1"'
+        size = 12
+        content_settings = azure.storage.blob.ContentSettings(content_type="application/pdf")
+
+    async def mock_get_blob_properties(self, *args, **kwargs):
+        assert self.blob_name == "test_document.pdf"
+        return MockBlobProperties()
+
+    monkeypatch.setattr("azure.storage.blob.aio.BlobClient.get_blob_properties", mock_get_blob_properties)
+
+    assert await blob_manager.get_blob_properties("test_document.pdf") == {
+        "content_settings": {"content_type": "application/pdf"},
+        "etag": '"0x8DC1"',
+        "size": 12,
+    }
+    assert await blob_manager.get_blob_properties("") is None
+
+
+@pytest.mark.asyncio
+async def test_stream_blob(monkeypatch, mock_env, blob_manager):
+    content = b"test content"
+    downloads = []
+
+    class MockDownloader:
+        def __init__(self, offset, length):
+            self.offset = offset
+            self.length = length
+
+        async def readall(self):
+            return content[self.offset : self.offset + self.length]
+
+    async def mock_download_blob(self, offset=None, length=None, **kwargs):
+        downloads.append((offset, length, kwargs.get("etag"), kwargs.get("match_condition")))
+        return MockDownloader(offset, length)
+
+    monkeypatch.setattr("azure.storage.blob.aio.BlobClient.download_blob", mock_download_blob)
+    monkeypatch.setattr(blob_manager, "STREAM_CHUNK_SIZE", 4)
+
+    chunks = [chunk async for chunk in blob_manager.stream_blob("test_document.pdf", 2, 9, etag='"0x8DC1"')]
+    assert chunks == [b"st c", b"onte", b"n"]
+    # Every range is downloaded from the version of the blob that was streamed first
+    assert downloads == [
+        (2, 4, '"0x8DC1"', MatchConditions.IfNotModified),
+        (6, 4, '"0x8DC1"', MatchConditions.IfNotModified),
+        (10, 1, '"0x8DC1"', MatchConditions.IfNotModified),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_stream_blob_content_cache(monkeypatch, mock_env, blob_manager, tmp_path):
+    content = b"test content"
+    downloads = []
+
+    async def mock_download_blob_range(blob_path, offset, length, etag=None, user_oid=None):
+        downloads.append((offset, length))
+        return content[offset : offset + length]
+
+    monkeypatch.setattr(blob_manager, "download_blob_range", mock_download_blob_range)
+    monkeypatch.setattr(blob_manager, "STREAM_CHUNK_SIZE", 4)
+    blob_manager.content_cache = BlobContentCache(str(tmp_path), max_size_bytes=1024)
+
+    async def stream(offset, length, etag='"0x8DC1"'):
+        chunks = blob_manager.stream_blob("test_document.pdf", offset, length, etag=etag, size=len(content))
+        return b"".join([chunk async for chunk in chunks])
+
+    # A range that isn't cached is streamed from storage, while the whole blob is cached in the background
+    assert await stream(5, 7) == b"content"
+    cached_path = blob_manager.content_cache.get_path(
+        blob_manager.content_cache.get_key(blob_manager.get_blob_location("test_document.pdf"), '"0x8DC1"')
+    )
+    while not os.path.exists(cached_path):
+        await asyncio.sleep(0.01)
+    assert sorted(downloads) == [(0, 4), (4, 4), (5, 4), (8, 4), (9, 3)]
+    # Each range is then served from the cache
+    assert await stream(0, 12) == b"test content"
+    assert await stream(2, 3) == b"st "
+    assert len(downloads) == 5
+    # Without an ETag, the version of the blob isn't known, so it's downloaded again
+    assert await stream(0, 4, etag=None) == b"test"
+    assert len(downloads) == 6
+
+    await blob_manager.close_clients()
+
+
+@pytest.mark.asyncio
+async def test_adls_get_blob_etag(monkeypatch, adls_blob_manager):
+    class MockFileProperties:
+        etag = '"0x8DC2"'
+        size = 10
+        content_settings = None
+
+    requested_paths = []
+    directory_owners = {"OID_X/images/doc.pdf": "OID_X", "OID_Z/images/doc.pdf": "OID_Y"}
+
+    async def mock_get_directory_properties(self, *args, **kwargs):
+        return azure.storage.filedatalake.DirectoryProperties()
+
+    async def mock_get_access_control(self, *args, **kwargs):
+        return {"owner": directory_owners[self.path_name]}
+
+    async def mock_get_file_properties(self, *args, **kwargs):
+        requested_paths.append(self.path_name)
+        return MockFileProperties()
+
+    monkeypatch.setattr(
+        azure.storage.filedatalake.aio.DataLakeDirectoryClient,
+        "get_directory_properties",
+        mock_get_directory_properties,
+    )
+    monkeypatch.setattr(
+        azure.storage.filedatalake.aio.DataLakeDirectoryClient, "get_access_control", mock_get_access_control
+    )
+    monkeypatch.setattr(
+        azure.storage.filedatalake.aio.DataLakeFileClient, "get_file_properties", mock_get_file_properties
+    )
+
+    assert await adls_blob_manager.get_blob_etag("OID_X/images/doc.pdf/figure1.png", user_oid="OID_X") == '"0x8DC2"'
+    # Another user's files are never looked up
+    assert await adls_blob_manager.get_blob_etag("OID_Y/images/doc.pdf/figure1.png", user_oid="OID_X") is None
+    assert await adls_blob_manager.get_blob_etag("OID_X/images/doc.pdf/figure1.png") is None
+    # Nor are files in a directory that the user doesn't own
+    assert await adls_blob_manager.get_blob_etag("OID_Z/images/doc.pdf/figure1.png", user_oid="OID_Z") is None
+    assert requested_paths == ["OID_X/images/doc.pdf/figure1.png"]
+
+
 @pytest.mark.asyncio
 async def test_download_blob_empty_path(monkeypatch, mock_env, mock_blob_container_client_exists, blob_manager):
     result = await blob_manager.download_blob("")
@@ -419,3 +681,129 @@ async def test_adls_download_blob_with_permission(
 
     assert content.startswith(b"\x89PNG\r\n\x1a\n")
     assert properties["content_settings"]["content_type"] == "application/octet-stream"
+
+
+@pytest.mark.asyncio
+async def test_adls_ensure_directory_cache(monkeypatch, adls_blob_manager):
+    checked_directories = []
+
+    async def mock_get_directory_properties(self, *args, **kwargs):
+        checked_directories.append(self.path_name)
+        return azure.storage.filedatalake.DirectoryProperties()
+
+    async def mock_get_access_control(self, *args, **kwargs):
+        return {"owner": "OID_X"}
+
+    monkeypatch.setattr(
+        azure.storage.filedatalake.aio.DataLakeDirectoryClient,
+        "get_directory_properties",
+        mock_get_directory_properties,
+    )
+    monkeypatch.setattr(
+        azure.storage.filedatalake.aio.DataLakeDirectoryClient, "get_access_control", mock_get_access_control
+    )
+
+    for _ in range(3):
+        directory_client = await adls_blob_manager._ensure_directory("OID_X", "OID_X")
+        assert directory_client.path_name == "OID_X"
+    assert checked_directories == ["OID_X"]
+
+    # A denied permission is cached as well
+    for _ in range(2):
+        with pytest.raises(PermissionError):
+            await adls_blob_manager._ensure_directory("OID_X", "OID_Y")
+    assert checked_directories == ["OID_X", "OID_X"]
+
+    # Entries are checked again once they expire
+    monkeypatch.setattr(AdlsBlobManager, "DIRECTORY_CACHE_TTL_SECONDS", 0)
+    await adls_blob_manager._ensure_directory("OID_X/images/a.pdf", "OID_X")
+    await adls_blob_manager._ensure_directory("OID_X/images/a.pdf", "OID_X")
+    assert checked_directories == ["OID_X", "OID_X", "OID_X/images/a.pdf", "OID_X/images/a.pdf"]
+
+
+@pytest.mark.asyncio
+async def test_adls_remove_blob_forgets_image_directory(monkeypatch, adls_blob_manager):
+    created_directories = []
+
+    async def mock_get_directory_properties(self, *args, **kwargs):
+        if self.path_name not in created_directories:
+            raise ResourceNotFoundError("Directory not found")
+        return azure.storage.filedatalake.DirectoryProperties()
+
+    async def mock_get_access_control(self, *args, **kwargs):
+        return {"owner": "OID_X"}
+
+    async def mock_create_directory(self, *args, **kwargs):
+        created_directories.append(self.path_name)
+
+    async def mock_set_access_control(self, *args, **kwargs):
+        pass
+
+    async def mock_delete_directory(self, *args, **kwargs):
+        created_directories.remove(self.path_name)
+
+    async def mock_delete_file(self, *args, **kwargs):
+        pass
+
+    directory_client_class = azure.storage.filedatalake.aio.DataLakeDirectoryClient
+    monkeypatch.setattr(directory_client_class, "get_directory_properties", mock_get_directory_properties)
+    monkeypatch.setattr(directory_client_class, "get_access_control", mock_get_access_control)
+    monkeypatch.setattr(directory_client_class, "create_directory", mock_create_directory)
+    monkeypatch.setattr(directory_client_class, "set_access_control", mock_set_access_control)
+    monkeypatch.setattr(directory_client_class, "delete_directory", mock_delete_directory)
+    monkeypatch.setattr(azure.storage.filedatalake.aio.DataLakeFileClient, "delete_file", mock_delete_file)
+
+    image_directory_path = adls_blob_manager._get_image_directory_path("a.pdf", "OID_X")
+    await adls_blob_manager._ensure_directory(image_directory_path, "OID_X")
+    assert (image_directory_path, "OID_X") in adls_blob_manager.verified_directories
+
+    await adls_blob_manager.remove_blob("a.pdf", "OID_X")
+
+    assert (image_directory_path, "OID_X") not in adls_blob_manager.verified_directories
+    assert ("OID_X", "OID_X") in adls_blob_manager.verified_directories
+    # The deleted directory is created again when it's next used
+    await adls_blob_manager._ensure_directory(image_directory_path, "OID_X")
+    assert created_directories == ["OID_X", image_directory_path]
+
+
+@pytest.mark.asyncio
+async def test_adls_upload_blob_checks_directory_again(monkeypatch, adls_blob_manager):
+    checked_directories = []
+    uploads = []
+
+    async def mock_get_directory_properties(self, *args, **kwargs):
+        checked_directories.append(self.path_name)
+        return azure.storage.filedatalake.DirectoryProperties()
+
+    async def mock_get_access_control(self, *args, **kwargs):
+        return {"owner": "OID_X"}
+
+    async def mock_upload_data(self, data, *args, **kwargs):
+        uploads.append(data.read())
+        if len(uploads) == 1:
+            # The directory was deleted by another worker since it was checked
+            raise ResourceNotFoundError("The specified path does not exist.", response=MagicMock(status_code=404))
+
+    directory_client_class = azure.storage.filedatalake.aio.DataLakeDirectoryClient
+    monkeypatch.setattr(directory_client_class, "get_directory_properties", mock_get_directory_properties)
+    monkeypatch.setattr(directory_client_class, "get_access_control", mock_get_access_control)
+    monkeypatch.setattr(azure.storage.filedatalake.aio.DataLakeFileClient, "upload_data", mock_upload_data)
+
+    await adls_blob_manager._ensure_directory("OID_X", "OID_X")
+    url = await adls_blob_manager.upload_blob(io.BytesIO(b"content"), "a.pdf", "OID_X")
+
+    # The directory is checked again, and the whole file uploaded again
+    assert url.endswith("/OID_X/a.pdf")
+    assert checked_directories == ["OID_X", "OID_X"]
+    assert uploads == [b"content", b"content"]
+
+    # An upload that fails again isn't retried any further
+    async def mock_upload_data_denied(self, data, *args, **kwargs):
+        uploads.append(data.read())
+        raise HttpResponseError("This request is not authorized.", response=MagicMock(status_code=403))
+
+    monkeypatch.setattr(azure.storage.filedatalake.aio.DataLakeFileClient, "upload_data", mock_upload_data_denied)
+    uploads.clear()
+    with pytest.raises(HttpResponseError):
+        await adls_blob_manager.upload_blob(io.BytesIO(b"content"), "a.pdf", "OID_X")
+    assert uploads == [b"content", b"content"]
@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import os
+import time
+
+import pytest
+
+from prepdocslib.blobcache import BlobContentCache
+
+
+def download(content: bytes, downloads: list):
+    async def chunks():
+        downloads.append(content)
+        for position in range(0, len(content), 4):
+            yield content[position : position + 4]
+
+    return chunks
+
+
+async def cache_blob(cache: BlobContentCache, location: str, etag: str, content: bytes, downloads: list):
+    await cache.store(cache.get_key(location, etag), len(content), download(content, downloads)())
+
+
+@pytest.mark.asyncio
+async def test_get_and_store(tmp_path):
+    cache = BlobContentCache(str(tmp_path), max_size_bytes=100)
+    downloads: list[bytes] = []
+
+    assert await cache.get("container/a.pdf", '"1"') is None
+    await cache_blob(cache, "container/a.pdf", '"1"', b"0123456789", downloads)
+    mapped_file = await cache.get("container/a.pdf", '"1"')
+    assert mapped_file is not None
+    with mapped_file:
+        assert mapped_file[2:5] == b"234"
+    assert cache.hits == 1
+    assert cache.misses == 1
+
+    # A new version of the blob isn't served from the copy of the older one
+    assert await cache.get("container/a.pdf", '"2"') is None
+    await cache_blob(cache, "container/a.pdf", '"2"', b"abcdefghij", downloads)
+    mapped_file = await cache.get("container/a.pdf", '"2"')
+    assert mapped_file is not None
+    with mapped_file:
+        assert mapped_file[:] == b"abcdefghij"
+    assert cache.size_bytes == 20
+
+
+@pytest.mark.asyncio
+async def test_fill(tmp_path, caplog):
+    cache = BlobContentCache(str(tmp_path), max_size_bytes=100)
+    downloads: list[bytes] = []
+    started = asyncio.Event()
+    release = asyncio.Event()
+
+    async def slow_chunks():
+        downloads.append(b"0123456789")
+        started.set()
+        await release.wait()
+        yield b"0123456789"
+
+    # A blob requested again while it's being cached is only downloaded once
+    cache.fill("a.pdf", '"1"', 10, slow_chunks)
+    cache.fill("a.pdf", '"1"', 10, slow_chunks)
+    await started.wait()
+    assert await cache.get("a.pdf", '"1"') is None
+    release.set()
+    while await cache.get("a.pdf", '"1"') is None:
+        await asyncio.sleep(0.01)
+    assert downloads == [b"0123456789"]
+
+    # A failed download is logged and leaves nothing behind
+    with caplog.at_level(logging.WARNING):
+        cache.fill("b.pdf", '"1"', 20, download(b"0123456789", downloads))
+        await asyncio.sleep(0.05)
+    assert "Couldn't cache the content of b.pdf" in caplog.text
+    assert len(os.listdir(tmp_path)) == 1
+
+    # Closing the cache stops the downloads in progress
+    release.clear()
+    started.clear()
+    cache.fill("c.pdf", '"1"', 10, slow_chunks)
+    await started.wait()
+    await cache.close()
+    assert await cache.get("c.pdf", '"1"') is None
+    assert len(os.listdir(tmp_path)) == 1
+
+
+@pytest.mark.asyncio
+async def test_store_evicts_least_recently_used(tmp_path):
+    cache = BlobContentCache(str(tmp_path), max_size_bytes=40)
+    downloads: list[bytes] = []
+    for name in ["a", "b", "c", "d"]:
+        await cache_blob(cache, name, '"1"', name.encode() * 10, downloads)
+    # Reading "a" makes "b" the least recently used file
+    (await cache.get("a", '"1"')).close()
+    await cache_blob(cache, "e", '"1"', b"e" * 10, downloads)
+
+    assert not os.path.exists(cache.get_path(cache.get_key("b", '"1"')))
+    assert os.path.exists(cache.get_path(cache.get_key("a", '"1"')))
+    assert cache.size_bytes == 40
+    assert len(os.listdir(tmp_path)) == 4
+    assert not cache.can_store(11)
+    assert not cache.can_store(0)
+
+
+@pytest.mark.asyncio
+async def test_store_only_scans_when_full(tmp_path, monkeypatch):
+    cache = BlobContentCache(str(tmp_path), max_size_bytes=30)
+    scans = []
+    scan = cache.scan
+
+    def counting_scan():
+        scans.append(1)
+        return scan()
+
+    monkeypatch.setattr(cache, "scan", counting_scan)
+    for name in ["a", "b", "c"]:
+        await cache_blob(cache, name, '"1"', name.encode() * 10, [])
+    assert scans == []
+    assert cache.size_bytes == 30
+    await cache_blob(cache, "d", '"1"', b"d" * 10, [])
+    assert scans == [1]
+    assert cache.size_bytes == 30
+
+    # Files cached by other processes are counted once the directory is scanned again
+    (tmp_path / "other").write_bytes(b"o" * 5)
+    monkeypatch.setattr(cache, "scanned_at", time.monotonic() - BlobContentCache.RESCAN_INTERVAL_SECONDS - 1)
+    await cache_blob(cache, "a", '"2"', b"a", [])
+    assert scans == [1, 1]
+    assert cache.size_bytes == 26
+
+
+@pytest.mark.asyncio
+async def test_store_incomplete(tmp_path):
+    cache = BlobContentCache(str(tmp_path), max_size_bytes=100)
+    with pytest.raises(ValueError):
+        await cache.store(cache.get_key("a.pdf", '"1"'), 20, download(b"0123456789", [])())
+    # A partial download is never cached
+    assert os.listdir(tmp_path) == []
+    assert cache.size_bytes == 0
+
+
+@pytest.mark.asyncio
+async def test_load_files(tmp_path):
+    cache = BlobContentCache(str(tmp_path), max_size_bytes=100)
+    await cache_blob(cache, "a.pdf", '"1"', b"0123456789", [])
+    stale_time = time.time() - BlobContentCache.STALE_TEMP_FILE_SECONDS - 1
+    (tmp_path / "1-stale.tmp").write_bytes(b"012")
+    os.utime(tmp_path / "1-stale.tmp", (stale_time, stale_time))
+    (tmp_path / f"{os.getpid()}-unfinished.tmp").write_bytes(b"012")
+    (tmp_path / "1-downloading.tmp").write_bytes(b"012")
+
+    # Files cached by a previous process are served, and unfinished downloads are removed, that is those
+    # too old to still be written and those of a previous process with the same ID,
+    # while downloads still being written by other processes are left alone
+    reloaded_cache = BlobContentCache(str(tmp_path), max_size_bytes=100)
+    assert reloaded_cache.size_bytes == 10
+    assert not (tmp_path / "1-stale.tmp").exists()
+    assert not (tmp_path / f"{os.getpid()}-unfinished.tmp").exists()
+    assert (tmp_path / "1-downloading.tmp").exists()
+    mapped_file = await reloaded_cache.get("a.pdf", '"1"')
+    assert mapped_file is not None
+    mapped_file.close()
+
+    # A file removed from the directory is a miss
+    os.remove(reloaded_cache.get_path(reloaded_cache.get_key("a.pdf", '"1"')))
+    assert await reloaded_cache.get("a.pdf", '"1"') is None
+
+
+@pytest.mark.asyncio
+async def test_shared_directory(tmp_path, monkeypatch):
+    # Like the worker processes of the app, both caches use the same directory
+    cache = BlobContentCache(str(tmp_path), max_size_bytes=30)
+    other_cache = BlobContentCache(str(tmp_path), max_size_bytes=30)
+
+    # Files cached by one process are served by the other
+    for name in ["a", "b", "c"]:
+        await cache_blob(cache, name, '"1"', name.encode() * 10, [])
+    (await other_cache.get("a", '"1"')).close()
+    assert other_cache.hits == 1
+
+    # The maximum size applies to the files cached by both, once the other process scans the directory again
+    monkeypatch.setattr(other_cache, "scanned_at", time.monotonic() - BlobContentCache.RESCAN_INTERVAL_SECONDS - 1)
+    await cache_blob(other_cache, "d", '"1"', b"d" * 10, [])
+    mapped_file = await other_cache.get("d", '"1"')
+    with mapped_file:
+        # The file read most recently by the other process is kept
+        assert not os.path.exists(cache.get_path(cache.get_key("b", '"1"')))
+        assert os.path.exists(cache.get_path(cache.get_key("a", '"1"')))
+        assert other_cache.size_bytes == 30
+
+        # A file evicted by the other process is a miss, and a mapping that's open stays readable
+        os.remove(other_cache.get_path(other_cache.get_key("d", '"1"')))
+        assert mapped_file[:] == b"d" * 10
+    assert await cache.get("d", '"1"') is None
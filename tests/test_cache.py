@@ -0,0 +1,193 @@
+import asyncio
+import time
+
+import pytest
+
+from core.cache import LRUCache, SingleFlight, SingleFlightStream
+
+
+def test_lrucache_get_set():
+    cache: LRUCache[str, int] = LRUCache(max_size=2)
+    assert cache.get("a") is None
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    assert "a" in cache
+    assert len(cache) == 1
+    assert cache.hits == 1
+    assert cache.misses == 1
+    assert cache.hit_rate == 0.5
+
+
+def test_lrucache_evicts_least_recently_used():
+    cache: LRUCache[str, int] = LRUCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    # Reading "a" makes "b" the least recently used entry
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_lrucache_expiry(monkeypatch):
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    cache: LRUCache[str, int] = LRUCache(max_size=10, ttl_seconds=60)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl_seconds=120)
+    cache.set("c", 3, ttl_seconds=0)
+    assert "c" not in cache
+
+    now += 90
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    assert len(cache) == 1
+
+
+def test_lrucache_pop_and_clear():
+    cache: LRUCache[str, int] = LRUCache(max_size=10)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.pop("a") == 1
+    assert cache.pop("a") is None
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_lrucache_invalid_size():
+    with pytest.raises(ValueError):
+        LRUCache(max_size=0)
+
+
+@pytest.mark.asyncio
+async def test_singleflight_shares_concurrent_calls():
+    single_flight: SingleFlight[str, int] = SingleFlight()
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 42
+
+    results = await asyncio.gather(*[single_flight.do("key", work) for _ in range(5)], single_flight.do("other", work))
+    assert results == [42] * 6
+    assert len(calls) == 2
+    assert single_flight.shared_calls == 4
+    assert len(single_flight) == 0
+
+    # Once the call has finished, the next one runs again
+    assert await single_flight.do("key", work) == 42
+    assert len(calls) == 3
+
+
+@pytest.mark.asyncio
+async def test_singleflight_shares_errors_and_survives_cancellation():
+    single_flight: SingleFlight[str, int] = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    leader = asyncio.create_task(single_flight.do("key", fail))
+    await asyncio.sleep(0)
+    follower = asyncio.create_task(single_flight.do("key", fail))
+    await asyncio.sleep(0)
+    # Cancelling the first caller doesn't cancel the shared call for the others
+    leader.cancel()
+    with pytest.raises(ValueError, match="boom"):
+        await follower
+    assert single_flight.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_singleflightstream_replays_to_late_subscribers():
+    single_flight: SingleFlightStream[str, int] = SingleFlightStream()
+    calls = []
+
+    async def numbers():
+        calls.append(1)
+        for number in range(3):
+            await asyncio.sleep(0.01)
+            yield number
+
+    async def collect():
+        return [number async for number in single_flight.stream("key", numbers)]
+
+    leader = asyncio.create_task(collect())
+    await asyncio.sleep(0.015)
+    # A subscriber that arrives after the first item was read still gets it
+    follower = asyncio.create_task(collect())
+    assert await asyncio.gather(leader, follower) == [[0, 1, 2], [0, 1, 2]]
+    assert len(calls) == 1
+    assert single_flight.shared_calls == 1
+    assert len(single_flight) == 0
+
+
+@pytest.mark.asyncio
+async def test_singleflightstream_errors_and_unsubscribing():
+    single_flight: SingleFlightStream[str, int] = SingleFlightStream()
+    read = []
+
+    async def failing():
+        yield 1
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError, match="boom"):
+        [number async for number in single_flight.stream("key", failing)]
+
+    async def endless():
+        while True:
+            read.append(1)
+            yield len(read)
+            await asyncio.sleep(0.01)
+
+    stream = single_flight.stream("endless", endless)
+    assert await stream.__anext__() == 1
+    await stream.aclose()
+    await asyncio.sleep(0.02)
+    # Once its only subscriber is gone, the stream is no longer read
+    assert len(read) == 1
+    assert len(single_flight) == 0
+
+
+@pytest.mark.asyncio
+async def test_singleflightstream_closes_unread_source():
+    single_flight: SingleFlightStream[str, int] = SingleFlightStream()
+
+    class Source:
+        def __init__(self, delay: float):
+            self.delay = delay
+            self.closed = False
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self) -> int:
+            await asyncio.sleep(self.delay)
+            return 1
+
+        async def aclose(self):
+            self.closed = True
+
+    # The only subscriber leaves between two reads
+    idle_source = Source(0)
+    stream = single_flight.stream("idle", lambda: idle_source)
+    assert await stream.__anext__() == 1
+    await stream.aclose()
+    assert idle_source.closed
+
+    # The only subscriber is cancelled while an item is being read
+    slow_source = Source(10)
+
+    async def read_one():
+        return [number async for number in single_flight.stream("slow", lambda: slow_source)]
+
+    task = asyncio.create_task(read_one())
+    await asyncio.sleep(0.01)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    await asyncio.sleep(0)
+    assert slow_source.closed
+    assert len(single_flight) == 0
@@ -1,20 +1,31 @@
+import asyncio
+import base64
+import gc
 import json
 
 import pytest
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import VectorizedQuery
-from openai.types.chat import ChatCompletion
+from openai.types import CreateEmbeddingResponse, Embedding
+from openai.types.chat import ChatCompletion, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+from openai.types.create_embedding_response import Usage
 
-from approaches.approach import Document
+from approaches.approach import DataPoints, Document, ExtraInfo
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from approaches.promptmanager import PromptyManager
+from core.answercache import SemanticAnswerCache
+from core.deadlines import DependencyCaller, DependencyTimeoutError
+from core.embeddingcache import EmbeddingCache
 from prepdocslib.embeddings import ImageEmbeddings
 
 from .mocks import (
     MOCK_EMBEDDING_DIMENSIONS,
     MOCK_EMBEDDING_MODEL_NAME,
+    MockAsyncPageIterator,
     MockAsyncSearchResultsIterator,
+    MockClient,
     mock_retrieval_response,
 )
 
@@ -139,6 +150,29 @@ def test_extract_followup_questions_no_pre_content(chat_approach):
     assert followup_questions == ["What is the dress code?"]
 
 
+class MockAuthHelper:
+    def __init__(self):
+        self.calls = 0
+
+    def build_security_filters(self, overrides, auth_claims):
+        self.calls += 1
+        return "oids/any(g:search.in(g, '{}'))".format(auth_claims.get("oid", ""))
+
+
+def test_build_filter(chat_approach):
+    chat_approach.auth_helper = MockAuthHelper()
+    overrides = {"include_category": "HR's", "use_oid_security_filter": True}
+
+    assert (
+        chat_approach.build_filter(overrides, {"oid": "OID_X"})
+        == "category eq 'HR''s' and oids/any(g:search.in(g, 'OID_X'))"
+    )
+    assert chat_approach.build_filter({**overrides, "exclude_category": "Legal"}, {"oid": "OID_X"}) == (
+        "category eq 'HR''s' and category ne 'Legal' and oids/any(g:search.in(g, 'OID_X'))"
+    )
+    assert chat_approach.auth_helper.calls == 2
+
+
 @pytest.mark.asyncio
 @pytest.mark.parametrize(
     "minimum_search_score,minimum_reranker_score,expected_result_count",
@@ -175,6 +209,89 @@ async def test_search_results_filtering_by_scores(
     ), f"Expected {expected_result_count} results with minimum_search_score={minimum_search_score} and minimum_reranker_score={minimum_reranker_score}"
 
 
+class MockPagedSearchResults:
+    def __init__(self, pages: list[list[dict]]):
+        self.pages = pages
+        self.pages_fetched = 0
+
+    def by_page(self):
+        return self.iterate_pages()
+
+    async def iterate_pages(self):
+        for page in self.pages:
+            self.pages_fetched += 1
+            yield MockAsyncPageIterator(list(page))
+
+
+@pytest.mark.asyncio
+async def test_search_documents_stops_at_top(chat_approach, monkeypatch):
+    results = MockPagedSearchResults(
+        [
+            [
+                {"id": "1", "@search.score": 0.5, "@search.reranker_score": 1.0},
+                {"id": "2", "@search.score": 0.5, "@search.reranker_score": 3.0},
+            ],
+            [
+                {"id": "3", "@search.score": 0.5, "@search.reranker_score": 2.5},
+                {"id": "4", "@search.score": 0.5, "@search.reranker_score": 2.0},
+            ],
+            [{"id": "5", "@search.score": 0.5, "@search.reranker_score": 2.0}],
+        ]
+    )
+
+    async def mock_paged_search(*args, **kwargs):
+        return results
+
+    monkeypatch.setattr(SearchClient, "search", mock_paged_search)
+
+    documents = await chat_approach.search(
+        top=2,
+        query_text="test query",
+        filter=None,
+        vectors=[],
+        use_text_search=True,
+        use_vector_search=False,
+        use_semantic_ranker=True,
+        use_semantic_captions=False,
+        minimum_reranker_score=2.0,
+    )
+
+    assert [document.id for document in documents] == ["2", "3"]
+    # The last page isn't requested once enough documents qualify
+    assert results.pages_fetched == 2
+
+
+@pytest.mark.asyncio
+async def test_search_documents_deadline(chat_approach, monkeypatch):
+    class SlowSearchResults:
+        def by_page(self):
+            return self.iterate_pages()
+
+        async def iterate_pages(self):
+            await asyncio.sleep(10)
+            yield MockAsyncPageIterator([])
+
+    async def mock_slow_search(*args, **kwargs):
+        return SlowSearchResults()
+
+    monkeypatch.setattr(SearchClient, "search", mock_slow_search)
+    chat_approach.dependency_caller = DependencyCaller(request_timeout_seconds=0.05)
+
+    with chat_approach.dependency_caller.request_deadline():
+        with pytest.raises(DependencyTimeoutError):
+            await chat_approach.search(
+                top=3,
+                query_text="test query",
+                filter=None,
+                vectors=[],
+                use_text_search=True,
+                use_vector_search=False,
+                use_semantic_ranker=False,
+                use_semantic_captions=False,
+            )
+    assert chat_approach.dependency_caller.timeouts == {"search": 1}
+
+
 @pytest.mark.asyncio
 async def test_search_results_query_rewriting(chat_approach, monkeypatch):
 
@@ -202,6 +319,293 @@ async def test_search_results_query_rewriting(chat_approach, monkeypatch):
     assert query_rewrites == "generative"
 
 
+def create_rewrite_completion(search_query: str) -> ChatCompletion:
+    return ChatCompletion.model_validate(
+        {
+            "id": "test",
+            "object": "chat.completion",
+            "created": 1,
+            "model": "gpt-4.1-mini",
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": search_query},
+                }
+            ],
+            "usage": {"completion_tokens": 5, "prompt_tokens": 100, "total_tokens": 105},
+        }
+    )
+
+
+@pytest.mark.asyncio
+async def test_run_search_approach_query_rewrite_cached(chat_approach, monkeypatch):
+    chat_approach.auth_helper = MockAuthHelper()
+    rewrite_prompts = []
+
+    async def mock_create_chat_completion(*args, **kwargs):
+        rewrite_prompts.append(kwargs["messages"])
+        return create_rewrite_completion("deductible amount")
+
+    monkeypatch.setattr(chat_approach, "create_chat_completion", mock_create_chat_completion)
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    async def run_search(content, overrides={"retrieval_mode": "text"}):
+        return await chat_approach.run_search_approach(
+            messages=[{"role": "user", "content": content}], overrides=overrides, auth_claims={}
+        )
+
+    first = await run_search("What is the deductible?")
+    second = await run_search("What is the deductible?")
+    assert len(rewrite_prompts) == 1
+    assert second.thoughts[1].description == "deductible amount"
+    assert second.thoughts[1].props["query_rewrite_cached"] is True
+    assert "query_rewrite_cached" not in first.thoughts[1].props
+    # The cached rewrite didn't cost any tokens for the second request
+    assert "token_usage" in first.thoughts[0].props
+    assert "token_usage" not in second.thoughts[0].props
+    assert chat_approach.query_rewrite_calls == 1
+    assert chat_approach.query_rewrite_calls_saved == 1
+
+    # A different question or different settings are rewritten on their own
+    await run_search("What is the copay?")
+    await run_search("What is the deductible?", overrides={"retrieval_mode": "text", "seed": 42})
+    assert len(rewrite_prompts) == 3
+
+
+@pytest.mark.asyncio
+async def test_run_search_approach_skip_single_turn_query_rewrite(chat_approach, monkeypatch):
+    chat_approach.auth_helper = MockAuthHelper()
+    rewrite_prompts = []
+
+    async def mock_create_chat_completion(*args, **kwargs):
+        rewrite_prompts.append(kwargs["messages"])
+        return create_rewrite_completion("deductible amount")
+
+    monkeypatch.setattr(chat_approach, "create_chat_completion", mock_create_chat_completion)
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    overrides = {"retrieval_mode": "text", "skip_single_turn_query_rewrite": True}
+
+    extra_info = await chat_approach.run_search_approach(
+        messages=[{"role": "user", "content": "What is the deductible?"}], overrides=overrides, auth_claims={}
+    )
+    assert rewrite_prompts == []
+    assert extra_info.thoughts[0].title == "Search using generated search query"
+    assert extra_info.thoughts[0].description == "What is the deductible?"
+    assert extra_info.thoughts[0].props["skipped_query_rewrite"] is True
+    assert chat_approach.query_rewrite_calls_saved == 1
+
+    # Follow-up questions still need the conversation turned into a search query
+    extra_info = await chat_approach.run_search_approach(
+        messages=[
+            {"role": "user", "content": "What is the deductible?"},
+            {"role": "assistant", "content": "It is $500."},
+            {"role": "user", "content": "And for families?"},
+        ],
+        overrides=overrides,
+        auth_claims={},
+    )
+    assert len(rewrite_prompts) == 1
+    assert extra_info.thoughts[1].description == "deductible amount"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "rewritten_query,expected_embedded_queries,expected_reused",
+    [
+        ("", ["What is the deductible?"], True),
+        ("deductible amount", ["What is the deductible?", "deductible amount"], False),
+    ],
+)
+async def test_run_search_approach_speculative_query_embedding(
+    chat_approach, monkeypatch, rewritten_query, expected_embedded_queries, expected_reused
+):
+    chat_approach.auth_helper = MockAuthHelper()
+    embedded_queries = []
+
+    async def mock_create_chat_completion(*args, **kwargs):
+        return create_rewrite_completion(rewritten_query)
+
+    async def mock_compute_text_embedding(q):
+        embedded_queries.append(q)
+        return VectorizedQuery(vector=[len(q)], k_nearest_neighbors=50, fields="embedding3")
+
+    searched_vectors = []
+
+    async def mock_search_with_vectors(*args, **kwargs):
+        searched_vectors.extend(kwargs.get("vector_queries"))
+        return await mock_search(*args, **kwargs)
+
+    monkeypatch.setattr(chat_approach, "create_chat_completion", mock_create_chat_completion)
+    monkeypatch.setattr(chat_approach, "compute_text_embedding", mock_compute_text_embedding)
+    monkeypatch.setattr(SearchClient, "search", mock_search_with_vectors)
+
+    extra_info = await chat_approach.run_search_approach(
+        messages=[{"role": "user", "content": "What is the deductible?"}],
+        overrides={"speculative_query_embedding": True, "include_stage_timings": True},
+        auth_claims={},
+    )
+
+    assert sorted(embedded_queries) == sorted(expected_embedded_queries)
+    query_text = rewritten_query or "What is the deductible?"
+    assert [vector.vector for vector in searched_vectors] == [[len(query_text)]]
+    assert extra_info.thoughts[1].props["reused_speculative_embedding"] is expected_reused
+    timings = extra_info.thoughts[-1]
+    assert timings.title == "Search stage timings"
+    assert {"query_rewrite_ms", "search_ms", "sources_content_ms"} <= set(timings.props)
+    if expected_reused:
+        assert "speculative_embedding_ms" in timings.props
+        assert "embedding_ms" not in timings.props
+    else:
+        assert "embedding_ms" in timings.props
+
+
+@pytest.mark.asyncio
+async def test_run_search_approach_failed_speculative_query_embedding(chat_approach, monkeypatch):
+    chat_approach.auth_helper = MockAuthHelper()
+    unhandled_errors = []
+    asyncio.get_running_loop().set_exception_handler(lambda loop, context: unhandled_errors.append(context))
+
+    async def mock_create_chat_completion(*args, **kwargs):
+        # Gives the speculative embedding time to fail before the rewritten query is known
+        await asyncio.sleep(0.01)
+        return create_rewrite_completion("deductible amount")
+
+    async def mock_compute_text_embedding(q):
+        if q == "What is the deductible?":
+            raise ValueError("Embedding deployment unavailable")
+        return VectorizedQuery(vector=[len(q)], k_nearest_neighbors=50, fields="embedding3")
+
+    monkeypatch.setattr(chat_approach, "create_chat_completion", mock_create_chat_completion)
+    monkeypatch.setattr(chat_approach, "compute_text_embedding", mock_compute_text_embedding)
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    # The failed embedding isn't used, since the rewritten query is embedded instead
+    extra_info = await chat_approach.run_search_approach(
+        messages=[{"role": "user", "content": "What is the deductible?"}],
+        overrides={"speculative_query_embedding": True},
+        auth_claims={},
+    )
+    assert extra_info.thoughts[1].props["reused_speculative_embedding"] is False
+    gc.collect()
+    assert unhandled_errors == []
+
+
+@pytest.mark.asyncio
+async def test_run_search_approach_local_reranker(chat_approach, monkeypatch):
+    chat_approach.auth_helper = MockAuthHelper()
+    searched_tops = []
+    contents = [
+        "Employees get paid time off.",
+        "The dental plan covers cleanings.",
+        "The vision plan covers glasses.",
+        "The deductible of the health plan is $500.",
+        "The deductible is waived for preventive care, so the deductible only applies to other care.",
+        "The cafeteria is open until 3pm.",
+    ]
+
+    async def mock_paged_search(*args, **kwargs):
+        searched_tops.append(kwargs.get("top"))
+        return MockPagedSearchResults(
+            [
+                [
+                    {"id": str(index), "content": content, "sourcepage": f"page{index}.pdf", "@search.score": 0.5}
+                    for index, content in enumerate(contents[: kwargs.get("top")])
+                ]
+            ]
+        )
+
+    monkeypatch.setattr(SearchClient, "search", mock_paged_search)
+
+    extra_info = await chat_approach.run_search_approach(
+        messages=[{"role": "user", "content": "What is the deductible?"}],
+        overrides={
+            "use_local_reranker": True,
+            "retrieval_mode": "text",
+            "top": 2,
+            "skip_single_turn_query_rewrite": True,
+        },
+        auth_claims={},
+    )
+    # Three times as many results are fetched, and the best matches are kept
+    assert searched_tops == [6]
+    assert extra_info.data_points.text == [
+        f"page3.pdf: {contents[3]}",
+        f"page4.pdf: {contents[4]}",
+    ]
+    assert extra_info.thoughts[0].props["use_local_reranker"] is True
+
+    # The semantic ranker takes precedence over the local reranker
+    await chat_approach.run_search_approach(
+        messages=[{"role": "user", "content": "What is the deductible?"}],
+        overrides={
+            "use_local_reranker": True,
+            "semantic_ranker": True,
+            "retrieval_mode": "text",
+            "top": 2,
+            "skip_single_turn_query_rewrite": True,
+        },
+        auth_claims={},
+    )
+    assert searched_tops[-1] == 2
+
+
+@pytest.mark.asyncio
+async def test_compute_query_vectors_concurrent(chat_approach, monkeypatch):
+    started = []
+
+    async def mock_compute_embedding(q):
+        started.append(q)
+        # Both embeddings must have started before either finishes
+        while len(started) < 2:
+            await asyncio.sleep(0)
+        return VectorizedQuery(vector=[len(started)], k_nearest_neighbors=50, fields="embedding")
+
+    async def mock_compute_multimodal_embedding(q):
+        result = await mock_compute_embedding(q)
+        return VectorizedQuery(vector=result.vector, k_nearest_neighbors=50, fields="images/embedding")
+
+    monkeypatch.setattr(chat_approach, "compute_text_embedding", mock_compute_embedding)
+    monkeypatch.setattr(chat_approach, "compute_multimodal_embedding", mock_compute_multimodal_embedding)
+
+    vectors = await asyncio.wait_for(chat_approach.compute_query_vectors("q", True, True), timeout=5)
+    # Vectors keep the text embedding first, matching the order they were requested in
+    assert [vector.fields for vector in vectors] == ["embedding", "images/embedding"]
+
+
+@pytest.mark.asyncio
+async def test_compute_embeddings_cached(monkeypatch, chat_approach):
+    text_embedding_calls = []
+    image_embedding_calls = []
+
+    class MockEmbeddings:
+        async def create(self, *args, **kwargs):
+            text_embedding_calls.append(kwargs)
+            return CreateEmbeddingResponse(
+                object="list",
+                data=[Embedding(embedding=[0.5, 0.25], index=0, object="embedding")],
+                model=MOCK_EMBEDDING_MODEL_NAME,
+                usage=Usage(prompt_tokens=8, total_tokens=8),
+            )
+
+    async def mock_create_embedding_for_text(self, q: str):
+        image_embedding_calls.append(q)
+        return [0.1, 0.2]
+
+    monkeypatch.setattr(ImageEmbeddings, "create_embedding_for_text", mock_create_embedding_for_text)
+    chat_approach.openai_client = MockClient(MockEmbeddings())
+    chat_approach.image_embeddings_client = ImageEmbeddings(endpoint="https://mock-endpoint", token_provider=None)
+    chat_approach.embedding_cache = EmbeddingCache()
+
+    for _ in range(3):
+        vectors = await chat_approach.compute_query_vectors("What is the deductible?", True, True)
+        assert vectors[0].vector == [0.5, 0.25]
+        assert vectors[1].vector == pytest.approx([0.1, 0.2])
+    assert len(text_embedding_calls) == 1
+    assert len(image_embedding_calls) == 1
+    assert chat_approach.embedding_cache.hits == 4
+
+
 @pytest.mark.asyncio
 async def test_compute_multimodal_embedding(monkeypatch, chat_approach):
     # Create a mock for the ImageEmbeddings.create_embedding_for_text method
@@ -305,3 +709,243 @@ async def test_chat_prompt_render_with_image_directive(chat_approach):
     assert "Diagram that shows the architecture of Fabric Activator." in combined
     # Original unescaped sequence should be gone
     assert ":::image" not in combined
+
+
+@pytest.mark.asyncio
+async def test_run_with_streaming_semantic_answer_cache(chat_approach, monkeypatch):
+    chat_approach.auth_helper = MockAuthHelper()
+    chat_approach.answer_cache = SemanticAnswerCache(similarity_threshold=0.95)
+    question_vectors = {
+        "whats the whistleblower policy": [1.0, 0.1],
+        "what is your whistleblower policy?": [1.0, 0.12],
+        "what are the holidays?": [0.0, 1.0],
+    }
+    answered = []
+
+    async def mock_compute_text_embedding(q):
+        return VectorizedQuery(vector=question_vectors[q], k_nearest_neighbors=50, fields="embedding3")
+
+    async def mock_stream_answer(messages, overrides, auth_claims, session_state=None):
+        answered.append(messages[-1]["content"])
+        yield {"delta": {"role": "assistant"}, "context": {}, "session_state": session_state}
+        yield {"delta": {"content": f"Answer to {messages[-1]['content']}", "role": "assistant"}}
+
+    monkeypatch.setattr(chat_approach, "compute_text_embedding", mock_compute_text_embedding)
+    monkeypatch.setattr(chat_approach, "stream_answer", mock_stream_answer)
+
+    async def ask(question, session_state, auth_claims={"oid": "OID_X"}, overrides={"use_oid_security_filter": True}):
+        return [
+            chunk
+            async for chunk in chat_approach.run_with_streaming(
+                [{"role": "user", "content": question}], overrides, auth_claims, session_state
+            )
+        ]
+
+    first = await ask("whats the whistleblower policy", "session1")
+    # A similar question replays the streamed chunks, with its own session state
+    replayed = await ask("what is your whistleblower policy?", "session2")
+    assert answered == ["whats the whistleblower policy"]
+    assert replayed[0]["session_state"] == "session2"
+    assert replayed[1] == first[1]
+
+    # Different questions, users and overrides are answered on their own
+    await ask("what are the holidays?", "session3")
+    await ask("whats the whistleblower policy", "session4", auth_claims={"oid": "OID_Y"})
+    await ask("whats the whistleblower policy", "session5", overrides={"use_oid_security_filter": True, "top": 5})
+    assert len(answered) == 4
+
+    # Multi-turn conversations are never answered from the cache
+    await ask("whats the whistleblower policy", "session6")
+    assert len(answered) == 4
+    chunks = [
+        chunk
+        async for chunk in chat_approach.run_with_streaming(
+            [
+                {"role": "user", "content": "what are the holidays?"},
+                {"role": "assistant", "content": "..."},
+                {"role": "user", "content": "whats the whistleblower policy"},
+            ],
+            {"use_oid_security_filter": True},
+            {"oid": "OID_X"},
+        )
+    ]
+    assert len(chunks) == 2
+    assert len(answered) == 5
+
+
+@pytest.mark.asyncio
+async def test_run_coalesces_identical_requests(chat_approach, monkeypatch):
+    chat_approach.auth_helper = MockAuthHelper()
+    answered = []
+
+    async def mock_run_until_final_call(messages, overrides, auth_claims, should_stream=False):
+        answered.append(messages[-1]["content"])
+        await asyncio.sleep(0.01)
+
+        async def create_completion():
+            return ChatCompletion(
+                id="test",
+                object="chat.completion",
+                created=0,
+                model="gpt-4.1-mini",
+                choices=[
+                    Choice(index=0, finish_reason="stop", message=ChatCompletionMessage(role="assistant", content="42"))
+                ],
+            )
+
+        return ExtraInfo(DataPoints(text=[])), create_completion()
+
+    monkeypatch.setattr(chat_approach, "run_until_final_call", mock_run_until_final_call)
+
+    def ask(question, session_state, overrides={}):
+        return chat_approach.run(
+            [{"role": "user", "content": question}],
+            session_state=session_state,
+            context={"overrides": overrides, "auth_claims": {}},
+        )
+
+    responses = await asyncio.gather(
+        ask("What is the answer?", "session1"),
+        ask("  what is the   ANSWER?", "session2"),
+        ask("What is the answer?", "session3", overrides={"top": 5}),
+    )
+    # Questions that only differ in case and spacing share one answer, each with its own session state
+    assert answered == ["What is the answer?", "What is the answer?"]
+    assert [response["session_state"] for response in responses] == ["session1", "session2", "session3"]
+    assert responses[1]["message"] == responses[0]["message"]
+    assert chat_approach.coalesced_requests == 1
+
+
+@pytest.mark.asyncio
+async def test_run_with_streaming_coalesces_identical_requests(chat_approach, monkeypatch):
+    chat_approach.auth_helper = MockAuthHelper()
+    answered = []
+
+    async def mock_stream_answer(messages, overrides, auth_claims, session_state=None):
+        answered.append(messages[-1]["content"])
+        yield {"delta": {"role": "assistant"}, "context": {}, "session_state": session_state}
+        for word in ["The", " answer"]:
+            await asyncio.sleep(0.01)
+            yield {"delta": {"content": word, "role": "assistant"}}
+
+    monkeypatch.setattr(chat_approach, "stream_answer", mock_stream_answer)
+
+    async def ask(session_state, delay=0.0):
+        await asyncio.sleep(delay)
+        return [
+            chunk
+            async for chunk in chat_approach.run_with_streaming(
+                [{"role": "user", "content": "What is the answer?"}], {}, {}, session_state
+            )
+        ]
+
+    leader, follower = await asyncio.gather(ask("session1"), ask("session2", delay=0.015))
+    # The follower joined mid-stream and still gets every chunk, with its own session state
+    assert len(answered) == 1
+    assert leader[0]["session_state"] == "session1"
+    assert follower[0]["session_state"] == "session2"
+    assert follower[1:] == leader[1:]
+    assert chat_approach.coalesced_requests == 1
+
+
+@pytest.mark.asyncio
+async def test_get_sources_content_downloads_images_concurrently(chat_approach, monkeypatch):
+    in_flight = []
+    max_in_flight = 0
+
+    async def mock_download_blob(self, blob_path, user_oid=None):
+        nonlocal max_in_flight
+        in_flight.append(blob_path)
+        max_in_flight = max(max_in_flight, len(in_flight))
+        # Finish in the reverse order of starting, so the order of results can't come from completion order
+        await asyncio.sleep(0.01 * (10 - int(blob_path[-5])))
+        in_flight.remove(blob_path)
+        return blob_path.encode(), {"etag": f"etag-{blob_path}"}
+
+    monkeypatch.setattr(chat_approach.global_blob_manager.__class__, "download_blob", mock_download_blob)
+
+    image_urls = [
+        f"https://test-globalstorage-account.blob.core.windows.net/test-globalstorage-container/image{i}.png"
+        for i in range(6)
+    ]
+    data_points = await chat_approach.get_sources_content(
+        [
+            Document(
+                id="doc1",
+                content="Text",
+                sourcepage="Benefit_Options-2.pdf",
+                images=[{"url": url} for url in image_urls[:4]],
+            ),
+            Document(
+                id="doc2",
+                content="Text",
+                sourcepage="Benefit_Options-3.pdf",
+                # Images already referenced by an earlier document are only downloaded once
+                images=[{"url": url} for url in [image_urls[0], *image_urls[4:]]],
+            ),
+        ],
+        use_semantic_captions=False,
+        include_text_sources=False,
+        download_image_sources=True,
+        user_oid=None,
+    )
+
+    assert 1 < max_in_flight <= chat_approach.MAX_CONCURRENT_IMAGE_DOWNLOADS
+    assert data_points.images == [
+        "data:image/png;base64," + base64.b64encode(f"image{i}.png".encode()).decode() for i in range(6)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_download_blob_as_base64_cached(chat_approach, monkeypatch):
+    downloads = []
+    etag = "0x1"
+
+    async def mock_download_blob(self, blob_path, user_oid=None):
+        downloads.append(blob_path)
+        return b"image bytes", {"etag": etag}
+
+    async def mock_get_blob_etag(self, blob_path, user_oid=None):
+        return etag
+
+    monkeypatch.setattr(chat_approach.global_blob_manager.__class__, "download_blob", mock_download_blob)
+    monkeypatch.setattr(chat_approach.global_blob_manager.__class__, "get_blob_etag", mock_get_blob_etag)
+
+    url = "https://test-globalstorage-account.blob.core.windows.net/test-globalstorage-container/image.png"
+    first = await chat_approach.download_blob_as_base64(url)
+    assert await chat_approach.download_blob_as_base64(url) == first
+    assert downloads == ["image.png"]
+
+    # A changed blob is downloaded again
+    etag = "0x2"
+    assert await chat_approach.download_blob_as_base64(url) == first
+    assert len(downloads) == 2
+
+
+@pytest.mark.asyncio
+async def test_run_until_final_call_packs_context(chat_approach, monkeypatch):
+    chat_approach.auth_helper = MockAuthHelper()
+    chat_approach.prompt_token_budget = 1000
+
+    def mock_create_chat_completion(*args, **kwargs):
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(create_rewrite_completion("deductible amount"))
+        return future
+
+    monkeypatch.setattr(chat_approach, "create_chat_completion", mock_create_chat_completion)
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    messages = [
+        {"role": "user", "content": "Tell me about my plan. " + "Please be thorough. " * 500},
+        {"role": "assistant", "content": "Your plan covers medical, dental and vision."},
+        {"role": "user", "content": "What is the deductible?"},
+    ]
+    extra_info, _ = await chat_approach.run_until_final_call(messages, {"retrieval_mode": "text"}, {})
+
+    answer_thought = extra_info.thoughts[-1]
+    assert answer_thought.props["dropped_past_messages"] == 1
+    assert answer_thought.props["prompt_tokens"] <= 1000
+    assert answer_thought.props["prompt_token_budget"] == 1000
+    assert extra_info.data_points.text
+    assert "Please be thorough." not in json.dumps(answer_thought.description)
+    assert "Your plan covers medical, dental and vision." in json.dumps(answer_thought.description)
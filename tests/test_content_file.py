@@ -1,3 +1,4 @@
+import logging
 import os
 
 import azure.storage.blob.aio
@@ -9,9 +10,12 @@ from azure.core.pipeline.transport import (
     AsyncHttpTransport,
     HttpRequest,
 )
+from azure.storage.blob import ContentSettings
 from azure.storage.blob.aio import BlobServiceClient
+from azure.storage.filedatalake import FileProperties
 
 import app
+from prepdocslib.blobmanager import record_storage_call
 
 from .mocks import (
     MockAiohttpClientResponse,
@@ -22,25 +26,33 @@ from .mocks import (
 
 
 @pytest.mark.asyncio
-async def test_content_file(monkeypatch, mock_env, mock_acs_search, mock_blob_container_client_exists):
+async def test_content_file(monkeypatch, mock_env, mock_acs_search, mock_blob_container_client_exists, caplog):
+    content = b"test content"
 
     class MockTransport(AsyncHttpTransport):
+        def __init__(self):
+            self.ranges = []
+
         async def send(self, request: HttpRequest, **kwargs) -> AioHttpTransportResponse:
             if request.url.endswith("notfound.pdf") or request.url.endswith("userdoc.pdf"):
                 raise ResourceNotFoundError(MockAiohttpClientResponse404(request.url, b""))
-            else:
-                return AioHttpTransportResponse(
-                    request,
-                    MockAiohttpClientResponse(
-                        request.url,
-                        b"test content",
-                        {
-                            "Content-Type": "application/octet-stream",
-                            "Content-Range": "bytes 0-27/28",
-                            "Content-Length": "28",
-                        },
-                    ),
-                )
+            start, end = 0, len(content) - 1
+            if "x-ms-range" in request.headers:
+                self.ranges.append(request.headers["x-ms-range"])
+                start, end = (int(position) for position in request.headers["x-ms-range"][6:].split("-"))
+            response = MockAiohttpClientResponse(
+                request.url,
+                content[start : end + 1],
+                {
+                    "Content-Type": "application/octet-stream",
+                    "Content-Range": f"bytes {start}-{end}/{len(content)}",
+                    "Content-Length": str(end + 1 - start),
+                    "ETag": '"0x8DC1"',
+                },
+            )
+            if request.method == "HEAD":
+                response._body = b""
+            return AioHttpTransportResponse(request, response)
 
         async def __aenter__(self):
             return self
@@ -54,11 +66,13 @@ async def test_content_file(monkeypatch, mock_env, mock_acs_search, mock_blob_co
         async def close(self):
             pass
 
+    mock_transport = MockTransport()
     mock_blob_service_client = BlobServiceClient(
         f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
         credential=MockAzureCredential(),
-        transport=MockTransport(),
+        transport=mock_transport,
         retry_total=0,  # Necessary to avoid unnecessary network requests during tests
+        raw_request_hook=record_storage_call,
     )
 
     quart_app = app.create_app()
@@ -69,29 +83,59 @@ async def test_content_file(monkeypatch, mock_env, mock_acs_search, mock_blob_co
         response = await client.get("/content/notfound.pdf")
         assert response.status_code == 404
 
+        caplog.set_level(logging.DEBUG, logger=test_app.app.logger.name)
         response = await client.get("/content/role_library.pdf")
         assert response.status_code == 200
         assert response.headers["Content-Type"] == "application/pdf"
         assert await response.get_data() == b"test content"
+        # Only the properties are read before the response is returned
+        assert "GET /content/role_library.pdf made 1 calls to Azure Storage" in caplog.text
 
         response = await client.get("/content/role_library.pdf#page=10")
         assert response.status_code == 200
         assert response.headers["Content-Type"] == "application/pdf"
         assert await response.get_data() == b"test content"
 
+        # The content is streamed in ranges, without loading the whole file
+        monkeypatch.setattr(app.BlobManager, "STREAM_CHUNK_SIZE", 5)
+        mock_transport.ranges.clear()
+        response = await client.get("/content/role_library.pdf")
+        assert await response.get_data() == b"test content"
+        assert response.headers["Content-Length"] == "12"
+        assert response.headers["Accept-Ranges"] == "bytes"
+        assert response.headers["ETag"] == '"0x8DC1"'
+        assert mock_transport.ranges == ["bytes=0-4", "bytes=5-9", "bytes=10-11"]
+
+        response = await client.get("/content/role_library.pdf", headers={"Range": "bytes=5-"})
+        assert response.status_code == 206
+        assert response.headers["Content-Range"] == "bytes 5-11/12"
+        assert await response.get_data() == b"content"
+
+        response = await client.get("/content/role_library.pdf", headers={"Range": "bytes=20-"})
+        assert response.status_code == 416
+        assert response.headers["Content-Range"] == "bytes */12"
+
+        # A range for an older version of the file gets the whole file
+        response = await client.get("/content/role_library.pdf", headers={"Range": "bytes=5-", "If-Range": '"0x8DC0"'})
+        assert response.status_code == 200
+        assert await response.get_data() == b"test content"
+
+        mock_transport.ranges.clear()
+        response = await client.get("/content/role_library.pdf", headers={"If-None-Match": '"0x8DC1"'})
+        assert response.status_code == 304
+        assert await response.get_data() == b""
+        assert mock_transport.ranges == []
+
 
 @pytest.mark.asyncio
 async def test_content_file_useruploaded_found(
     monkeypatch, auth_client, mock_blob_container_client, mock_blob_container_client_exists
 ):
     # We need to mock our the global blob and container client since the /content path checks that first!
-    class MockBlobClient:
-        async def download_blob(self):
-            raise ResourceNotFoundError(MockAiohttpClientResponse404("userdoc.pdf", b""))
+    async def mock_get_blob_properties(*args, **kwargs):
+        raise ResourceNotFoundError(MockAiohttpClientResponse404("userdoc.pdf", b""))
 
-    monkeypatch.setattr(
-        azure.storage.blob.aio.ContainerClient, "get_blob_client", lambda *args, **kwargs: MockBlobClient()
-    )
+    monkeypatch.setattr(azure.storage.blob.aio.BlobClient, "get_blob_properties", mock_get_blob_properties)
 
     # Track downloaded files
     downloaded_files = []
@@ -114,7 +158,14 @@ async def test_content_file_useruploaded_found(
         def __init__(self, path_name):
             self.path_name = path_name
 
-        async def download_file(self):
+        async def get_file_properties(self):
+            file_properties = FileProperties(name=self.path_name)
+            file_properties.etag = '"0x8DC2"'
+            file_properties.size = len(await MockBlob().readall())
+            file_properties.content_settings = ContentSettings(content_type="application/pdf")
+            return file_properties
+
+        async def download_file(self, offset=None, length=None, **kwargs):
             downloaded_files.append(self.path_name)
             return MockBlob()
 
@@ -127,7 +178,9 @@ async def test_content_file_useruploaded_found(
 
     response = await auth_client.get("/content/userdoc.pdf", headers={"Authorization": "Bearer test"})
     assert response.status_code == 200
-    assert len(downloaded_files) == 1
+    assert response.headers["Content-Type"] == "application/pdf"
+    assert await response.get_data() == await MockBlob().readall()
+    assert downloaded_files == ["userdoc.pdf"]
 
 
 @pytest.mark.asyncio
@@ -135,13 +188,10 @@ async def test_content_file_useruploaded_notfound(
     monkeypatch, auth_client, mock_blob_container_client, mock_blob_container_client_exists
 ):
 
-    class MockBlobClient:
-        async def download_blob(self):
-            raise ResourceNotFoundError(MockAiohttpClientResponse404("userdoc.pdf", b""))
+    async def mock_get_blob_properties(*args, **kwargs):
+        raise ResourceNotFoundError(MockAiohttpClientResponse404("userdoc.pdf", b""))
 
-    monkeypatch.setattr(
-        azure.storage.blob.aio.ContainerClient, "get_blob_client", lambda *args, **kwargs: MockBlobClient()
-    )
+    monkeypatch.setattr(azure.storage.blob.aio.BlobClient, "get_blob_properties", mock_get_blob_properties)
 
     # Mock directory client for _ensure_directory method
     class MockDirectoryClient:
@@ -161,7 +211,7 @@ async def test_content_file_useruploaded_notfound(
         def __init__(self, path_name):
             self.path_name = path_name
 
-        async def download_file(self):
+        async def get_file_properties(self):
             # Simulate file not found error
             raise ResourceNotFoundError(MockAiohttpClientResponse404(self.path_name, b""))
 
@@ -0,0 +1,68 @@
+from approaches.contextpacker import ContextPacker
+
+
+def render_prompt(text_sources, past_messages):
+    return [
+        {"role": "system", "content": "Answer the question using the sources."},
+        *past_messages,
+        {"role": "user", "content": "What is included in my plan?\n\nSources:\n" + "\n".join(text_sources)},
+    ]
+
+
+def create_source(page: int, words: int) -> str:
+    return f"Benefit_Options-{page}.pdf: " + " ".join(["coverage"] * words)
+
+
+def test_contextpacker_fits():
+    packer = ContextPacker("gpt-4.1-mini", token_budget=1000)
+    sources = [create_source(1, 10), create_source(2, 10)]
+    past_messages = [{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello!"}]
+
+    packed = packer.pack(render_prompt, sources, past_messages)
+    assert packed.text_sources == sources
+    assert packed.past_messages == past_messages
+    assert packed.messages == render_prompt(sources, past_messages)
+    assert not packed.trimmed
+
+
+def test_contextpacker_drops_lowest_ranked_sources():
+    packer = ContextPacker("gpt-4.1-mini", token_budget=220)
+    sources = [create_source(1, 100), create_source(2, 100), create_source(3, 100)]
+
+    packed = packer.pack(render_prompt, sources, [])
+    assert packed.text_sources[0] == sources[0]
+    assert packed.text_sources[1] != sources[1]
+    assert sources[1].startswith(packed.text_sources[1])
+    assert packed.dropped_sources == 1
+    assert packed.truncated_sources == 1
+    assert packed.trimmed
+    assert packed.prompt_tokens is not None and packed.prompt_tokens <= 220
+    assert packer.count_message_tokens(packed.messages) == packed.prompt_tokens
+
+
+def test_contextpacker_drops_oldest_messages():
+    packer = ContextPacker("gpt-4.1-mini", token_budget=200)
+    sources = [create_source(1, 20)]
+    past_messages = [
+        {"role": "user", "content": "What is the deductible? " + "please " * 300},
+        {"role": "assistant", "content": "The deductible is $500."},
+        {"role": "user", "content": "And for dental?"},
+        {"role": "assistant", "content": "The dental deductible is $50."},
+    ]
+
+    packed = packer.pack(render_prompt, sources, past_messages)
+    assert packed.text_sources == sources
+    assert packed.past_messages == past_messages[1:]
+    assert packed.to_props() == {
+        "prompt_token_budget": 200,
+        "prompt_tokens": packed.prompt_tokens,
+        "dropped_sources": 0,
+        "truncated_sources": 0,
+        "dropped_past_messages": 1,
+    }
+
+
+def test_contextpacker_budget_for_model():
+    assert ContextPacker.for_model("gpt-4o", 1024).token_budget == 128000 - 1024
+    assert ContextPacker.for_model("unknown-model", 1024).token_budget == 128000 - 1024
+    assert ContextPacker.for_model("gpt-4o", 1024, token_budget=4000).token_budget == 4000
@@ -0,0 +1,181 @@
+import asyncio
+
+import pytest
+
+from core.deadlines import (
+    DependencyCaller,
+    DependencyTimeoutError,
+    LatencyTracker,
+    deadline_scope,
+    get_remaining_seconds,
+)
+
+
+def create_slow_call(seconds, result, calls=None):
+    async def slow_call():
+        try:
+            await asyncio.sleep(seconds)
+        except asyncio.CancelledError:
+            if calls is not None:
+                calls.append(f"{result} cancelled")
+            raise
+        return result
+
+    return slow_call
+
+
+def test_deadline_scope():
+    assert get_remaining_seconds() is None
+    with deadline_scope(10):
+        remaining_seconds = get_remaining_seconds()
+        assert remaining_seconds is not None and 9 < remaining_seconds <= 10
+        # A nested scope can't extend the deadline
+        with deadline_scope(60):
+            remaining_seconds = get_remaining_seconds()
+            assert remaining_seconds is not None and remaining_seconds <= 10
+        with deadline_scope(1):
+            remaining_seconds = get_remaining_seconds()
+            assert remaining_seconds is not None and remaining_seconds <= 1
+    assert get_remaining_seconds() is None
+
+    with deadline_scope(None):
+        assert get_remaining_seconds() is None
+
+
+def test_latency_tracker_percentile():
+    tracker = LatencyTracker(window_size=100)
+    assert tracker.percentile(0.95) is None
+    for latency in range(1, 201):
+        tracker.record(latency / 100)
+    # Only the latest latencies are kept
+    assert len(tracker) == 100
+    assert tracker.percentile(0.95) == 1.96
+    assert tracker.percentile(1.0) == 2.0
+
+
+@pytest.mark.asyncio
+async def test_dependency_caller_timeout():
+    caller = DependencyCaller()
+    calls: list[str] = []
+    with deadline_scope(0.05):
+        with pytest.raises(DependencyTimeoutError) as exc_info:
+            await caller.call("search", create_slow_call(10, "primary", calls))
+        assert exc_info.value.dependency == "search"
+        assert calls == ["primary cancelled"]
+    with deadline_scope(10):
+        assert await caller.call("openai", create_slow_call(0, "primary")) == "primary"
+    assert caller.timeouts == {"search": 1}
+
+
+@pytest.mark.asyncio
+async def test_dependency_caller_deadline_passed():
+    caller = DependencyCaller()
+    with deadline_scope(-1):
+        with pytest.raises(DependencyTimeoutError):
+            await caller.call("embeddings", create_slow_call(0, "primary"))
+    assert caller.timeouts == {"embeddings": 1}
+
+
+@pytest.mark.asyncio
+async def test_dependency_caller_no_deadline():
+    caller = DependencyCaller(request_timeout_seconds=None)
+    with caller.request_deadline():
+        assert await caller.call("search", create_slow_call(0.01, "primary")) == "primary"
+    assert caller.timeouts == {}
+
+
+@pytest.mark.asyncio
+async def test_dependency_caller_hedged():
+    caller = DependencyCaller(hedge=True)
+    calls: list[str] = []
+
+    # Calls aren't hedged until there are enough latencies to know the p95
+    assert await caller.call("openai", create_slow_call(0.02, "primary"), create_slow_call(0, "backup")) == "primary"
+    for _ in range(caller.MIN_HEDGE_SAMPLES):
+        caller.latencies["openai"].record(0.01)
+    assert caller.get_hedge_delay("openai") == caller.MIN_HEDGE_DELAY_SECONDS
+
+    # A primary call slower than the p95 is raced against the backup call, and the loser is cancelled
+    result = await caller.call("openai", create_slow_call(10, "primary", calls), create_slow_call(0, "backup", calls))
+    assert result == "backup"
+    await asyncio.sleep(0)
+    assert calls == ["primary cancelled"]
+    assert caller.hedged_calls == {"openai": 1}
+    assert caller.backup_wins == {"openai": 1}
+
+    # A primary call faster than the p95 isn't hedged
+    assert await caller.call("openai", create_slow_call(0, "primary"), create_slow_call(0, "backup")) == "primary"
+    assert caller.hedged_calls == {"openai": 1}
+
+
+@pytest.mark.asyncio
+async def test_dependency_caller_hedged_calls_finish_together():
+    caller = DependencyCaller(hedge=True)
+    for _ in range(caller.MIN_HEDGE_SAMPLES):
+        caller.latencies["openai"].record(0.01)
+
+    class Stream:
+        def __init__(self, name: str):
+            self.name = name
+            self.closed = False
+
+        async def aclose(self):
+            self.closed = True
+
+    streams: list[Stream] = []
+    release = asyncio.Event()
+
+    def create_stream_call(name: str):
+        async def stream_call():
+            await release.wait()
+            stream = Stream(name)
+            streams.append(stream)
+            return stream
+
+        return stream_call
+
+    async def release_after_hedge():
+        await asyncio.sleep(caller.MIN_HEDGE_DELAY_SECONDS * 2)
+        release.set()
+
+    # Both calls finish in the same wait, so the losing call's stream is closed rather than leaked
+    releaser = asyncio.create_task(release_after_hedge())
+    result = await caller.call("openai", create_stream_call("primary"), create_stream_call("backup"))
+    await releaser
+    assert caller.hedged_calls == {"openai": 1}
+    assert len(streams) == 2
+    assert [stream.closed for stream in streams if stream is not result] == [True]
+    assert not result.closed
+
+    # A losing call's exception is retrieved, rather than logged as never retrieved
+    release.clear()
+
+    async def failing_call():
+        await release.wait()
+        raise ValueError("OpenAI service unavailable")
+
+    releaser = asyncio.create_task(release_after_hedge())
+    result = await caller.call("openai", failing_call, create_stream_call("backup"))
+    await releaser
+    assert result.name == "backup"
+    assert not result.closed
+
+
+@pytest.mark.asyncio
+async def test_dependency_caller_hedged_failure():
+    caller = DependencyCaller(hedge=True)
+    for _ in range(caller.MIN_HEDGE_SAMPLES):
+        caller.latencies["search"].record(0.01)
+
+    async def failing_call():
+        raise ValueError("Search service unavailable")
+
+    async def slow_failing_call():
+        await asyncio.sleep(caller.MIN_HEDGE_DELAY_SECONDS * 2)
+        raise ValueError("Search service unavailable")
+
+    # The primary call failing doesn't fail the hedged call while the backup may still succeed
+    assert await caller.call("search", slow_failing_call, create_slow_call(0.1, "backup")) == "backup"
+
+    with pytest.raises(ValueError):
+        await caller.call("search", slow_failing_call, failing_call)
@@ -0,0 +1,105 @@
+from array import array
+from typing import Optional
+
+import pytest
+
+from core.embeddingcache import EmbeddingCache, EmbeddingCacheBackend
+
+
+class MockEmbeddingCacheBackend(EmbeddingCacheBackend):
+    def __init__(self):
+        self.values: dict[str, bytes] = {}
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return self.values.get(key)
+
+    async def set(self, key: str, value: bytes) -> None:
+        self.values[key] = value
+
+
+class FailingEmbeddingCacheBackend(EmbeddingCacheBackend):
+    async def get(self, key: str) -> Optional[bytes]:
+        raise ConnectionError("unavailable")
+
+    async def set(self, key: str, value: bytes) -> None:
+        raise ConnectionError("unavailable")
+
+
+def create_embedding_counter(vector: list[float]):
+    calls = []
+
+    async def create_embedding():
+        calls.append(1)
+        return vector
+
+    return create_embedding, calls
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_hit():
+    cache = EmbeddingCache()
+    create_embedding, calls = create_embedding_counter([0.1, 0.2, 0.3])
+
+    assert await cache.get_or_create("text-embedding-3-small", 256, "What is  the deductible?", create_embedding) == [
+        0.1,
+        0.2,
+        0.3,
+    ]
+    # Whitespace differences are normalized away
+    vector = await cache.get_or_create("text-embedding-3-small", 256, " What is the deductible? ", create_embedding)
+    assert vector == pytest.approx([0.1, 0.2, 0.3])
+    assert len(calls) == 1
+    assert cache.hits == 1
+    assert cache.hit_rate == 0.5
+    assert cache.latency_saved_seconds >= 0
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_keyed_by_model_and_dimensions():
+    cache = EmbeddingCache()
+    create_embedding, calls = create_embedding_counter([0.1, 0.2])
+
+    await cache.get_or_create("text-embedding-3-small", 256, "deductible", create_embedding)
+    await cache.get_or_create("text-embedding-3-small", 512, "deductible", create_embedding)
+    await cache.get_or_create("text-embedding-3-large", 256, "deductible", create_embedding)
+    assert len(calls) == 3
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_stores_float32():
+    cache = EmbeddingCache()
+    create_embedding, _ = create_embedding_counter([0.1, 0.2])
+
+    await cache.get_or_create("text-embedding-3-small", 256, "deductible", create_embedding)
+    stored = cache.vectors.get(EmbeddingCache.get_key("text-embedding-3-small", 256, "deductible"))
+    assert isinstance(stored, array)
+    assert stored.typecode == "f"
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_shared_backend():
+    backend = MockEmbeddingCacheBackend()
+    create_embedding, calls = create_embedding_counter([0.5, 0.25])
+
+    await EmbeddingCache(backend=backend).get_or_create("text-embedding-3-small", 256, "deductible", create_embedding)
+    assert len(backend.values) == 1
+
+    # Another worker's cache finds the vector in the shared backend
+    other_cache = EmbeddingCache(backend=backend)
+    assert await other_cache.get_or_create("text-embedding-3-small", 256, "deductible", create_embedding) == [
+        0.5,
+        0.25,
+    ]
+    assert len(calls) == 1
+    assert other_cache.hits == 1
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_backend_failure():
+    cache = EmbeddingCache(backend=FailingEmbeddingCacheBackend())
+    create_embedding, calls = create_embedding_counter([0.5])
+
+    # An unavailable shared backend falls back to computing the embedding and the local cache
+    for _ in range(2):
+        assert await cache.get_or_create("text-embedding-3-small", 256, "deductible", create_embedding) == [0.5]
+    assert len(calls) == 1
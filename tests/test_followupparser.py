@@ -0,0 +1,57 @@
+import pytest
+
+from approaches.followupparser import FollowupQuestionParser
+
+ANSWER = "The deductible is $500 [Benefit_Options-2.pdf]. Costs < $50 and > $5 are covered."
+QUESTIONS = "<<What is the copay?>>\n<<Are vision exams covered?>>"
+
+
+def parse(chunks: list[str]) -> tuple[str, list[list[str]]]:
+    parser = FollowupQuestionParser()
+    answer = ""
+    questions_per_chunk = []
+    for chunk in chunks:
+        answer_content, questions = parser.feed(chunk)
+        answer += answer_content
+        questions_per_chunk.append(questions)
+    return answer + parser.finish(), questions_per_chunk
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 8, 1000])
+def test_followup_parser_chunked(chunk_size):
+    content = ANSWER + QUESTIONS
+    chunks = [content[i : i + chunk_size] for i in range(0, len(content), chunk_size)]
+
+    answer, questions_per_chunk = parse(chunks)
+    assert answer == ANSWER
+    assert [question for questions in questions_per_chunk for question in questions] == [
+        "What is the copay?",
+        "Are vision exams covered?",
+    ]
+
+
+def test_followup_parser_split_delimiters():
+    answer, questions_per_chunk = parse(["Paris.<", "<What is the capital", " of Spain?>", ">", "<", "<Why?>>"])
+    assert answer == "Paris."
+    # Each question is returned with the chunk that completes it
+    assert questions_per_chunk == [[], [], [], ["What is the capital of Spain?"], [], ["Why?"]]
+
+
+def test_followup_parser_single_angle_brackets():
+    answer, questions_per_chunk = parse(["1 <", " 2 and 3 >", " 2<", "<Is 1 > 0?>", ">"])
+    assert answer == "1 < 2 and 3 > 2"
+    assert questions_per_chunk[-1] == ["Is 1 > 0?"]
+
+
+def test_followup_parser_held_back_at_end():
+    parser = FollowupQuestionParser()
+    assert parser.feed("Is 1 <") == ("Is 1 ", [])
+    assert parser.finish() == "<"
+    assert not parser.in_followup_questions
+
+
+def test_followup_parser_unfinished_question():
+    parser = FollowupQuestionParser()
+    assert parser.feed("Paris. <<What is") == ("Paris. ", [])
+    assert parser.in_followup_questions
+    assert parser.finish() == ""
@@ -0,0 +1,192 @@
+import asyncio
+
+import pytest
+
+from core.ingestionqueue import (
+    JOB_FAILED,
+    JOB_QUEUED,
+    JOB_RUNNING,
+    JOB_SUCCEEDED,
+    IngestionJob,
+    IngestionQueue,
+    InMemoryIngestionJobStore,
+)
+
+
+async def wait_for_job(job: IngestionJob):
+    for _ in range(100):
+        if job.is_finished:
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"Job {job.id} didn't finish")  # pragma: no cover
+
+
+@pytest.mark.asyncio
+async def test_ingestion_queue_runs_stages():
+    finished_jobs = []
+
+    async def process(job, start_stage):
+        await start_stage("parsing")
+        await start_stage("indexing")
+
+    queue = IngestionQueue(process, on_job_finished=finished_jobs.append)
+    job = await queue.submit("OID_X", "a.txt", "https://test/OID_X/a.txt")
+    assert job.status == JOB_QUEUED
+
+    queue.start()
+    try:
+        await wait_for_job(job)
+    finally:
+        await queue.close()
+
+    assert job.status == JOB_SUCCEEDED
+    assert [(stage.name, stage.status) for stage in job.stages] == [
+        ("parsing", JOB_SUCCEEDED),
+        ("indexing", JOB_SUCCEEDED),
+    ]
+    assert all(stage.finished_at is not None for stage in job.stages)
+    assert finished_jobs == [job]
+    assert queue.jobs_succeeded == 1
+
+
+@pytest.mark.asyncio
+async def test_ingestion_queue_failed_job():
+    async def process(job, start_stage):
+        await start_stage("parsing")
+        raise ValueError("Unsupported file")
+
+    queue = IngestionQueue(process)
+    queue.start()
+    try:
+        job = await queue.submit("OID_X", "a.xyz", "https://test/OID_X/a.xyz")
+        await wait_for_job(job)
+        # The queue keeps working after a failed job
+        next_job = await queue.submit("OID_X", "a.xyz", "https://test/OID_X/a.xyz")
+        await wait_for_job(next_job)
+    finally:
+        await queue.close()
+
+    assert job.status == JOB_FAILED
+    assert job.error == "Unsupported file"
+    assert [(stage.name, stage.status) for stage in job.stages] == [("parsing", JOB_FAILED)]
+    assert queue.jobs_failed == 2
+
+
+@pytest.mark.asyncio
+async def test_ingestion_queue_close_fails_unfinished_jobs():
+    started = asyncio.Event()
+
+    async def process(job, start_stage):
+        await start_stage("parsing")
+        started.set()
+        await asyncio.sleep(10)
+
+    queue = IngestionQueue(process, concurrency=1)
+    queue.start()
+    running_job = await queue.submit("OID_X", "a.pdf", "https://test/OID_X/a.pdf")
+    queued_job = await queue.submit("OID_X", "b.pdf", "https://test/OID_X/b.pdf")
+    await started.wait()
+    assert running_job.status == JOB_RUNNING
+    assert queued_job.status == JOB_QUEUED
+
+    # Jobs that won't finish are failed, so that clients polling their status stop waiting
+    await queue.close()
+    for job in [running_job, queued_job]:
+        assert job.status == JOB_FAILED
+        assert job.error is not None
+        assert job.finished_at is not None
+        assert (await queue.get_job(job.id, "OID_X")) is job
+    assert [(stage.name, stage.status) for stage in running_job.stages] == [("parsing", JOB_FAILED)]
+    assert queue.jobs_failed == 1
+
+
+@pytest.mark.asyncio
+async def test_ingestion_queue_survives_store_failures(monkeypatch):
+    class FailingStore(InMemoryIngestionJobStore):
+        def __init__(self):
+            super().__init__()
+            self.failures = 2
+
+        async def save(self, job):
+            if self.failures:
+                self.failures -= 1
+                raise ConnectionError("store unavailable")
+            await super().save(job)
+
+    async def process(job, start_stage):
+        await start_stage("parsing")
+
+    monkeypatch.setattr(IngestionQueue, "WORKER_RETRY_DELAY_SECONDS", 0)
+    queue = IngestionQueue(process, store=FailingStore(), concurrency=1)
+    queue.start()
+    try:
+        # The first job fails to start, and saving its failure fails too, which the worker logs before going on
+        failed_job = await queue.submit("OID_X", "a.pdf", "https://test/OID_X/a.pdf")
+        job = await queue.submit("OID_X", "b.pdf", "https://test/OID_X/b.pdf")
+        await wait_for_job(job)
+    finally:
+        await queue.close()
+    assert failed_job.status == JOB_FAILED
+    assert failed_job.error == "store unavailable"
+    assert job.status == JOB_SUCCEEDED
+    assert queue.jobs_failed == 1
+    assert queue.jobs_succeeded == 1
+
+
+@pytest.mark.asyncio
+async def test_ingestion_queue_bounded_concurrency():
+    running = 0
+    max_running = 0
+
+    async def process(job, start_stage):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    queue = IngestionQueue(process, concurrency=2)
+    queue.start()
+    try:
+        jobs = [await queue.submit("OID_X", f"{index}.txt", f"https://test/OID_X/{index}.txt") for index in range(6)]
+        for job in jobs:
+            await wait_for_job(job)
+    finally:
+        await queue.close()
+
+    assert max_running == 2
+    assert queue.jobs_succeeded == 6
+
+
+@pytest.mark.asyncio
+async def test_ingestion_queue_get_job_checks_owner():
+    async def process(job, start_stage):
+        pass  # pragma: no cover
+
+    queue = IngestionQueue(process)
+    job = await queue.submit("OID_X", "a.txt", "https://test/OID_X/a.txt")
+
+    assert await queue.get_job(job.id, "OID_X") is job
+    assert await queue.get_job(job.id, "OID_Y") is None
+    assert await queue.get_job("missing", "OID_X") is None
+
+
+@pytest.mark.asyncio
+async def test_in_memory_store_keeps_recent_finished_jobs():
+    store = InMemoryIngestionJobStore(max_finished_jobs=2)
+    jobs = [IngestionJob(id=str(index), user_oid="OID_X", filename="a.txt", file_url="") for index in range(3)]
+    for job in jobs:
+        await store.enqueue(job)
+        job.status = JOB_SUCCEEDED
+        await store.save(job)
+
+    assert await store.get("0") is None
+    assert await store.get("1") is jobs[1]
+    assert await store.get("2") is jobs[2]
+
+
+def test_ingestion_job_round_trip():
+    job = IngestionJob(id="1", user_oid="OID_X", filename="a.txt", file_url="https://test/OID_X/a.txt")
+    job.start_stage("parsing")
+
+    assert IngestionJob.from_dict(job.to_dict()) == job
@@ -0,0 +1,289 @@
+import json
+
+import httpx
+import pytest
+from openai import AsyncAzureOpenAI, DefaultAsyncHttpxClient
+
+from prepdocslib.openailoadbalancer import (
+    LoadBalancingTransport,
+    OpenAIBackend,
+    parse_openai_backends,
+)
+from prepdocslib.ratelimiter import TokenBucketRateLimiter
+
+CHAT_URL = "https://primary.openai.azure.com/openai/deployments/chat/chat/completions?api-version=2024-10-21"
+
+
+class MockBackends:
+    """
+    Answers each request with the response set for its host, recording which hosts were called
+    """
+
+    def __init__(self, responses: dict[str, httpx.Response]):
+        self.responses = responses
+        self.requests: list[httpx.Request] = []
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        return self.responses.get(request.url.host, httpx.Response(200, json={}))
+
+    @property
+    def hosts(self) -> list[str]:
+        return [request.url.host for request in self.requests]
+
+
+def create_transport(backends: list[OpenAIBackend], responses: dict[str, httpx.Response]):
+    mock_backends = MockBackends(responses)
+    return LoadBalancingTransport(backends, transport=httpx.MockTransport(mock_backends.handle)), mock_backends
+
+
+async def send_requests(transport: LoadBalancingTransport, count: int) -> list[httpx.Response]:
+    async with httpx.AsyncClient(transport=transport) as client:
+        return [await client.post(CHAT_URL, json={"messages": []}) for _ in range(count)]
+
+
+def test_parse_openai_backends():
+    backends = parse_openai_backends(
+        json.dumps(
+            [
+                {"service": "openai-eastus2", "weight": 2},
+                {"endpoint": "https://apim.azure-api.net/", "deployments": {"chat": "chat-2"}, "api_key": "key"},
+            ]
+        )
+    )
+    assert backends == [
+        OpenAIBackend(endpoint="https://openai-eastus2.openai.azure.com", weight=2),
+        OpenAIBackend(endpoint="https://apim.azure-api.net", api_key="key", deployments={"chat": "chat-2"}),
+    ]
+    assert parse_openai_backends(None) == []
+
+    with pytest.raises(ValueError):
+        parse_openai_backends(json.dumps([{"weight": 2}]))
+
+
+def test_for_endpoint():
+    backend = OpenAIBackend(endpoint="https://secondary.openai.azure.com", weight=3)
+    transport = LoadBalancingTransport.for_endpoint("https://primary.openai.azure.com/", [backend])
+    assert [state.backend for state in transport.backends] == [
+        OpenAIBackend(endpoint="https://primary.openai.azure.com"),
+        backend,
+    ]
+
+    transport = LoadBalancingTransport.for_endpoint("https://secondary.openai.azure.com", [backend])
+    assert [state.backend for state in transport.backends] == [backend]
+
+
+@pytest.mark.asyncio
+async def test_weighted_round_robin():
+    transport, mock_backends = create_transport(
+        [
+            OpenAIBackend(endpoint="https://primary.openai.azure.com", weight=2),
+            OpenAIBackend(endpoint="https://secondary.openai.azure.com"),
+        ],
+        {},
+    )
+    await send_requests(transport, 6)
+
+    # Calls are interleaved rather than sent in bursts to each backend
+    primary, secondary = "primary.openai.azure.com", "secondary.openai.azure.com"
+    assert mock_backends.hosts == [primary, secondary, primary, primary, secondary, primary]
+    assert all(request.url.path == "/openai/deployments/chat/chat/completions" for request in mock_backends.requests)
+    assert all(json.loads(request.content) == {"messages": []} for request in mock_backends.requests)
+
+
+@pytest.mark.asyncio
+async def test_route_deployments_and_keys():
+    transport, mock_backends = create_transport(
+        [
+            OpenAIBackend(
+                endpoint="https://apim.azure-api.net/eastus", api_key="secondary-key", deployments={"chat": "chat-2"}
+            )
+        ],
+        {},
+    )
+    async with httpx.AsyncClient(transport=transport) as client:
+        await client.post(CHAT_URL, headers={"api-key": "primary-key"}, json={})
+
+    request = mock_backends.requests[0]
+    assert (
+        str(request.url)
+        == "https://apim.azure-api.net/eastus/openai/deployments/chat-2/chat/completions?api-version=2024-10-21"
+    )
+    assert request.headers["api-key"] == "secondary-key"
+    assert request.headers["host"] == "apim.azure-api.net"
+
+
+@pytest.mark.asyncio
+async def test_rate_limiters_per_backend():
+    rate_limiter = TokenBucketRateLimiter(tokens_per_minute=60000)
+    mock_backends = MockBackends(
+        {
+            "primary.openai.azure.com": httpx.Response(200, headers={"x-ratelimit-remaining-tokens": "1500"}, json={}),
+            "secondary.openai.azure.com": httpx.Response(200, json={}),
+        }
+    )
+    backends = [
+        OpenAIBackend(endpoint="https://primary.openai.azure.com"),
+        OpenAIBackend(endpoint="https://secondary.openai.azure.com", deployments={"chat": "chat-2"}),
+    ]
+    transport = LoadBalancingTransport(
+        backends, transport=httpx.MockTransport(mock_backends.handle), rate_limiters={"chat": rate_limiter}
+    )
+    await send_requests(transport, 2)
+
+    # Each backend's calls go through its own rate limiter, including for deployments with other names
+    primary_rate_limiter = rate_limiter.for_backend("https://primary.openai.azure.com")
+    secondary_rate_limiter = rate_limiter.for_backend("https://secondary.openai.azure.com")
+    assert primary_rate_limiter is not secondary_rate_limiter
+    assert primary_rate_limiter.calls_admitted == 1
+    assert secondary_rate_limiter.calls_admitted == 1
+    assert rate_limiter.calls_admitted == 0
+    # The rate limit headers of one backend don't lower the limits of the others
+    assert primary_rate_limiter.available_tokens <= 1500
+    assert secondary_rate_limiter.available_tokens > 50000
+
+    # Other clients sharing the rate limiters share each backend's rate limiter too
+    other_transport = LoadBalancingTransport(
+        backends, transport=httpx.MockTransport(mock_backends.handle), rate_limiters={"chat": rate_limiter}
+    )
+    await send_requests(other_transport, 1)
+    assert primary_rate_limiter.calls_admitted == 2
+
+
+@pytest.mark.asyncio
+async def test_throttled_backend_fails_over():
+    transport, mock_backends = create_transport(
+        [
+            OpenAIBackend(endpoint="https://primary.openai.azure.com"),
+            OpenAIBackend(endpoint="https://secondary.openai.azure.com"),
+        ],
+        {"primary.openai.azure.com": httpx.Response(429, headers={"retry-after-ms": "60000"})},
+    )
+    responses = await send_requests(transport, 3)
+
+    assert [response.status_code for response in responses] == [200, 200, 200]
+    # The throttled backend isn't called again until it asked to be retried
+    assert mock_backends.hosts == [
+        "primary.openai.azure.com",
+        "secondary.openai.azure.com",
+        "secondary.openai.azure.com",
+        "secondary.openai.azure.com",
+    ]
+    assert transport.backends[0].consecutive_failures == 0
+
+
+@pytest.mark.asyncio
+async def test_all_backends_throttled():
+    throttled = httpx.Response(429, headers={"retry-after": "5"})
+    transport, mock_backends = create_transport(
+        [
+            OpenAIBackend(endpoint="https://primary.openai.azure.com"),
+            OpenAIBackend(endpoint="https://secondary.openai.azure.com"),
+        ],
+        {"primary.openai.azure.com": throttled, "secondary.openai.azure.com": throttled},
+    )
+    responses = await send_requests(transport, 1)
+
+    # The last response is returned, so that the OpenAI client can retry it after Retry-After
+    assert responses[0].status_code == 429
+    assert len(mock_backends.requests) == 2
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker():
+    transport, mock_backends = create_transport(
+        [
+            OpenAIBackend(endpoint="https://primary.openai.azure.com"),
+            OpenAIBackend(endpoint="https://secondary.openai.azure.com"),
+        ],
+        {"primary.openai.azure.com": httpx.Response(500)},
+    )
+    await send_requests(transport, 2 * LoadBalancingTransport.CIRCUIT_FAILURE_THRESHOLD + 2)
+
+    primary_calls = mock_backends.hosts.count("primary.openai.azure.com")
+    assert primary_calls == LoadBalancingTransport.CIRCUIT_FAILURE_THRESHOLD
+    assert transport.backends[0].unavailable_until > 0
+
+
+@pytest.mark.asyncio
+async def test_low_remaining_tokens():
+    transport, mock_backends = create_transport(
+        [
+            OpenAIBackend(endpoint="https://primary.openai.azure.com"),
+            OpenAIBackend(endpoint="https://secondary.openai.azure.com"),
+        ],
+        {
+            "primary.openai.azure.com": httpx.Response(
+                200, headers={"x-ratelimit-remaining-tokens": "10", "x-ratelimit-remaining-requests": "50"}, json={}
+            )
+        },
+    )
+    await send_requests(transport, 4)
+
+    # Once the primary backend reports it's almost out of tokens, calls go to the other backend
+    assert mock_backends.hosts == [
+        "primary.openai.azure.com",
+        "secondary.openai.azure.com",
+        "secondary.openai.azure.com",
+        "secondary.openai.azure.com",
+    ]
+    assert transport.backends[0].remaining_tokens == 10
+    assert transport.backends[0].remaining_requests == 50
+
+
+@pytest.mark.asyncio
+async def test_connection_error_fails_over():
+    requests = []
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        requests.append(request.url.host)
+        if request.url.host == "primary.openai.azure.com":
+            raise httpx.ConnectError("Connection refused")
+        return httpx.Response(200, json={})
+
+    transport = LoadBalancingTransport(
+        [
+            OpenAIBackend(endpoint="https://primary.openai.azure.com"),
+            OpenAIBackend(endpoint="https://secondary.openai.azure.com"),
+        ],
+        transport=httpx.MockTransport(handle),
+    )
+    responses = await send_requests(transport, 1)
+    assert responses[0].status_code == 200
+    assert requests == ["primary.openai.azure.com", "secondary.openai.azure.com"]
+    assert transport.backends[0].consecutive_failures == 1
+
+
+@pytest.mark.asyncio
+async def test_openai_client_embeddings():
+    hosts = []
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        hosts.append(request.url.host)
+        return httpx.Response(
+            200,
+            json={
+                "object": "list",
+                "data": [{"object": "embedding", "index": 0, "embedding": [0.1, 0.2]}],
+                "model": "text-embedding-3-small",
+                "usage": {"prompt_tokens": 2, "total_tokens": 2},
+            },
+        )
+
+    transport = LoadBalancingTransport(
+        [
+            OpenAIBackend(endpoint="https://primary.openai.azure.com"),
+            OpenAIBackend(endpoint="https://secondary.openai.azure.com"),
+        ],
+        transport=httpx.MockTransport(handle),
+    )
+    client = AsyncAzureOpenAI(
+        azure_endpoint="https://primary.openai.azure.com",
+        api_version="2024-10-21",
+        api_key="key",
+        http_client=DefaultAsyncHttpxClient(transport=transport),
+    )
+    for _ in range(2):
+        embedding = await client.embeddings.create(model="embedding", input="hello")
+        assert embedding.data[0].embedding == [0.1, 0.2]
+    assert hosts == ["primary.openai.azure.com", "secondary.openai.azure.com"]
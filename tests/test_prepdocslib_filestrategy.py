@@ -3,9 +3,9 @@ import os
 import pytest
 from azure.search.documents.aio import SearchClient
 
-from prepdocslib.blobmanager import BlobManager
+from prepdocslib.blobmanager import AdlsBlobManager, BlobManager
 from prepdocslib.fileprocessor import FileProcessor
-from prepdocslib.filestrategy import FileStrategy
+from prepdocslib.filestrategy import FileStrategy, UploadUserFileStrategy
 from prepdocslib.listfilestrategy import (
     ADLSGen2ListFileStrategy,
 )
@@ -100,3 +100,76 @@ async def test_file_strategy_adls2(monkeypatch, mock_env, mock_data_lake_service
             "storageUrl": "https://test.blob.core.windows.net/c.txt",
         },
     ]
+
+
+@pytest.mark.asyncio
+async def test_upload_user_file_strategy_add_uploaded_file(monkeypatch, mock_env):
+    blob_manager = AdlsBlobManager(
+        endpoint="https://test-storage-account.dfs.core.windows.net",
+        container="test-storage-container",
+        credential=MockAzureCredential(),
+    )
+
+    async def mock_download_blob(self, blob_path, user_oid=None):
+        assert (blob_path, user_oid) == ("a.txt", "OID_X")
+        return b"texttext", {"content_settings": {"content_type": "text/plain"}}
+
+    monkeypatch.setattr(AdlsBlobManager, "download_blob", mock_download_blob)
+
+    uploaded_to_search = []
+
+    async def mock_upload_documents(self, documents):
+        uploaded_to_search.extend(documents)
+
+    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+
+    ingester = UploadUserFileStrategy(
+        search_info=SearchInfo(
+            endpoint="https://testsearchclient.blob.core.windows.net",
+            credential=MockAzureCredential(),
+            index_name="test",
+        ),
+        file_processors={".txt": FileProcessor(TextParser(), SimpleTextSplitter())},
+        blob_manager=blob_manager,
+    )
+    stages = []
+
+    async def start_stage(name: str):
+        stages.append(name)
+
+    await ingester.add_uploaded_file(
+        "a.txt", "https://test.dfs.core.windows.net/OID_X/a.txt", "OID_X", start_stage=start_stage
+    )
+
+    assert stages == ["downloading", "parsing", "indexing"]
+    assert len(uploaded_to_search) == 1
+    assert uploaded_to_search[0]["content"] == "texttext"
+    assert uploaded_to_search[0]["sourcefile"] == "a.txt"
+    assert uploaded_to_search[0]["oids"] == ["OID_X"]
+
+
+@pytest.mark.asyncio
+async def test_upload_user_file_strategy_add_uploaded_file_not_found(monkeypatch, mock_env):
+    blob_manager = AdlsBlobManager(
+        endpoint="https://test-storage-account.dfs.core.windows.net",
+        container="test-storage-container",
+        credential=MockAzureCredential(),
+    )
+
+    async def mock_download_blob(self, blob_path, user_oid=None):
+        return None
+
+    monkeypatch.setattr(AdlsBlobManager, "download_blob", mock_download_blob)
+
+    ingester = UploadUserFileStrategy(
+        search_info=SearchInfo(
+            endpoint="https://testsearchclient.blob.core.windows.net",
+            credential=MockAzureCredential(),
+            index_name="test",
+        ),
+        file_processors={".txt": FileProcessor(TextParser(), SimpleTextSplitter())},
+        blob_manager=blob_manager,
+    )
+
+    with pytest.raises(FileNotFoundError):
+        await ingester.add_uploaded_file("a.txt", "https://test.dfs.core.windows.net/OID_X/a.txt", "OID_X")
@@ -0,0 +1,149 @@
+import asyncio
+
+import httpx
+import pytest
+
+from prepdocslib.ratelimiter import (
+    RateLimitingTransport,
+    RequestTokenEstimator,
+    TokenBucketRateLimiter,
+)
+
+
+def test_estimate_chat_completion_tokens():
+    estimator = RequestTokenEstimator()
+    body = {
+        "model": "chat",
+        "messages": [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": "What is in this image?"},
+                    {"type": "image_url", "image_url": {"url": "data:image/png;base64,AAAA"}},
+                ],
+            },
+        ],
+        "max_tokens": 100,
+        "n": 2,
+    }
+    prompt_tokens = (
+        2 * estimator.TOKENS_PER_MESSAGE
+        + estimator.count_text_tokens("You are a helpful assistant.")
+        + estimator.count_text_tokens("What is in this image?")
+        + estimator.TOKENS_PER_IMAGE
+    )
+    assert estimator.estimate(body) == prompt_tokens + 200
+
+    del body["max_tokens"]
+    assert estimator.estimate(body) == prompt_tokens + 2 * estimator.DEFAULT_COMPLETION_TOKENS
+
+
+def test_estimate_embeddings_tokens():
+    estimator = RequestTokenEstimator()
+    assert estimator.estimate({"model": "embedding", "input": "hello world"}) == 2
+    assert estimator.estimate({"model": "embedding", "input": ["hello", "world", [1, 2, 3]]}) == 5
+    # Special tokens are counted as text rather than rejected
+    assert estimator.estimate({"input": "<|endoftext|>"}) > 1
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_waits_for_tokens():
+    # 100 tokens per second
+    rate_limiter = TokenBucketRateLimiter(tokens_per_minute=6000)
+    await rate_limiter.acquire(6000)
+    assert rate_limiter.max_wait_seconds < 0.05
+
+    await rate_limiter.acquire(5)
+    assert rate_limiter.max_wait_seconds >= 0.04
+    assert rate_limiter.calls_admitted == 2
+    assert rate_limiter.average_wait_seconds == rate_limiter.total_wait_seconds / 2
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_waits_for_requests():
+    rate_limiter = TokenBucketRateLimiter(tokens_per_minute=6000, requests_per_minute=600)
+    rate_limiter.available_requests = 0
+    await rate_limiter.acquire(1)
+    assert rate_limiter.max_wait_seconds >= 0.09
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_admits_in_order():
+    rate_limiter = TokenBucketRateLimiter(tokens_per_minute=60000)
+    rate_limiter.available_tokens = 0
+    admitted = []
+
+    async def call(index: int, tokens: int):
+        await rate_limiter.acquire(tokens)
+        admitted.append(index)
+
+    # A small call that arrives later doesn't overtake a large call that's waiting
+    tasks = [asyncio.create_task(call(0, 50)), asyncio.create_task(call(1, 1)), asyncio.create_task(call(2, 1))]
+    await asyncio.sleep(0.01)
+    assert rate_limiter.queue_depth == 3
+    await asyncio.gather(*tasks)
+    assert admitted == [0, 1, 2]
+    assert rate_limiter.queue_depth == 0
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_call_larger_than_bucket():
+    rate_limiter = TokenBucketRateLimiter(tokens_per_minute=1000)
+    await asyncio.wait_for(rate_limiter.acquire(5000), timeout=1)
+    assert rate_limiter.available_tokens <= 0
+
+
+def test_rate_limiter_throttled():
+    rate_limiter = TokenBucketRateLimiter(tokens_per_minute=6000)
+    rate_limiter.record_response(429, httpx.Headers({"retry-after-ms": "2000"}))
+
+    assert rate_limiter.calls_throttled == 1
+    assert rate_limiter.rate_fraction == TokenBucketRateLimiter.THROTTLED_RATE_FACTOR
+    assert rate_limiter.available_tokens <= 0
+    assert rate_limiter.get_wait_seconds(1, rate_limiter.updated_at) >= 1.9
+
+    # The rate recovers as calls succeed
+    for _ in range(10):
+        rate_limiter.record_response(200, httpx.Headers())
+    assert rate_limiter.rate_fraction == 1.0
+
+
+def test_rate_limiter_remaining_headers():
+    rate_limiter = TokenBucketRateLimiter(tokens_per_minute=6000)
+    rate_limiter.record_response(
+        200, httpx.Headers({"x-ratelimit-remaining-tokens": "100", "x-ratelimit-remaining-requests": "3"})
+    )
+    assert rate_limiter.available_tokens <= 100.1
+    assert rate_limiter.available_requests <= 3.1
+
+    # Remaining limits higher than the buckets don't raise them
+    rate_limiter.record_response(200, httpx.Headers({"x-ratelimit-remaining-tokens": "5000"}))
+    assert rate_limiter.available_tokens < 200
+
+
+@pytest.mark.asyncio
+async def test_rate_limiting_transport():
+    chat_rate_limiter = TokenBucketRateLimiter(tokens_per_minute=60000)
+    embedding_rate_limiter = TokenBucketRateLimiter(tokens_per_minute=60000)
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, headers={"x-ratelimit-remaining-tokens": "50000"}, json={})
+
+    transport = RateLimitingTransport(
+        {"chat": chat_rate_limiter, "text-embedding-3-large": embedding_rate_limiter},
+        transport=httpx.MockTransport(handle),
+    )
+    async with httpx.AsyncClient(transport=transport) as client:
+        await client.post(
+            "https://test.openai.azure.com/openai/deployments/chat/chat/completions",
+            json={"messages": [{"role": "user", "content": "Hi"}], "max_tokens": 10},
+        )
+        await client.post(
+            "https://api.openai.com/v1/embeddings", json={"model": "text-embedding-3-large", "input": "Hi"}
+        )
+        await client.post("https://test.openai.azure.com/openai/deployments/other/embeddings", json={"input": "Hi"})
+
+    assert chat_rate_limiter.calls_admitted == 1
+    assert embedding_rate_limiter.calls_admitted == 1
+    assert chat_rate_limiter.available_tokens <= 50000
@@ -0,0 +1,36 @@
+import pytest
+
+from core.reranker import BM25Reranker
+
+
+def test_bm25_score():
+    reranker = BM25Reranker()
+    scores = reranker.score(
+        "Whistleblower policy",
+        [
+            "The whistleblower policy protects employees who report misconduct.",
+            "Employees get 20 days of paid time off.",
+            "WHISTLEBLOWER: see the policy on whistleblower protections, and the whistleblower hotline.",
+        ],
+    )
+    assert scores[1] == 0
+    assert scores[0] > 0
+    # Repeated terms score higher, regardless of case
+    assert scores[2] > scores[0]
+    assert reranker.score("", ["some text"]) == [0.0]
+    assert reranker.score("policy", []) == []
+
+
+def test_bm25_rank_keeps_search_order_for_ties():
+    reranker = BM25Reranker()
+    texts = ["Paid time off", "Dental plans", "Vision plans", "The deductible of the health plan"]
+    assert reranker.rank("deductible", texts) == [3, 0, 1, 2]
+    assert reranker.rank("dental and vision plans", texts) == [1, 2, 0, 3]
+    assert reranker.rank("nothing matches", texts) == [0, 1, 2, 3]
+
+
+def test_candidate_count():
+    assert BM25Reranker().get_candidate_count(3) == 9
+    assert BM25Reranker(candidates_factor=5).get_candidate_count(2) == 10
+    with pytest.raises(ValueError):
+        BM25Reranker(candidates_factor=0)
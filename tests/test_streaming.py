@@ -0,0 +1,103 @@
+import asyncio
+import json
+
+import pytest
+
+from core.streaming import coalesce_delta_events, encode_delta_event
+
+
+@pytest.mark.parametrize(
+    "content, role",
+    [
+        ("Hello", "assistant"),
+        ('She said "I ❤️ 🐍"\n\tand left \\o/', "assistant"),
+        ("", None),
+        (None, "assistant"),
+    ],
+)
+def test_encode_delta_event(content, role):
+    event = {"delta": {"content": content, "role": role}}
+    assert encode_delta_event(event) == json.dumps(event, ensure_ascii=False) + "\n"
+
+
+@pytest.mark.parametrize(
+    "event",
+    [
+        {"delta": {"role": "assistant"}, "context": {}},
+        {"delta": {"role": "assistant", "content": "Hello"}},
+        {"delta": {"content": "Hello", "role": "user"}},
+        {"delta": {"content": ["Hello"], "role": "assistant"}},
+        {"error": "Something went wrong"},
+    ],
+)
+def test_encode_delta_event_other_events(event):
+    assert encode_delta_event(event) is None
+
+
+async def create_events(events, delay_seconds=0.0):
+    for event in events:
+        if delay_seconds:
+            await asyncio.sleep(delay_seconds)
+        yield event
+
+
+def delta(content, role="assistant"):
+    return {"delta": {"content": content, "role": role}}
+
+
+@pytest.mark.asyncio
+async def test_coalesce_delta_events():
+    events = [
+        {"delta": {"role": "assistant"}, "context": {"thoughts": []}},
+        delta("The "),
+        delta("deductible "),
+        delta("is ", role=None),
+        delta("$500."),
+        {"delta": {"role": "assistant"}, "context": {"followup_questions": []}},
+    ]
+
+    coalesced = [event async for event in coalesce_delta_events(create_events(events), 60, 256)]
+    assert coalesced == [
+        events[0],
+        delta("The deductible "),
+        delta("is ", role=None),
+        delta("$500."),
+        events[-1],
+    ]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_delta_events_max_chars():
+    events = [delta("abc"), delta("def"), delta("ghi")]
+
+    coalesced = [event async for event in coalesce_delta_events(create_events(events), 60, 5)]
+    assert coalesced == [delta("abcdef"), delta("ghi")]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_delta_events_max_delay():
+    events = [delta("abc"), delta("def"), delta("ghi")]
+
+    # Deltas are sent once the delay passes, even while waiting for the next one
+    coalesced = [event async for event in coalesce_delta_events(create_events(events, 0.05), 0.01, 256)]
+    assert coalesced == events
+
+
+@pytest.mark.asyncio
+async def test_coalesce_delta_events_closed():
+    closed = False
+
+    async def slow_events():
+        nonlocal closed
+        try:
+            yield delta("abc")
+            await asyncio.sleep(10)
+            yield delta("def")
+        finally:
+            closed = True
+
+    coalesced = coalesce_delta_events(slow_events(), 0.01, 256)
+    assert await coalesced.__anext__() == delta("abc")
+    await coalesced.aclose()
+    await asyncio.sleep(0)
+    assert closed
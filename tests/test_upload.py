@@ -1,3 +1,4 @@
+import asyncio
 from io import BytesIO
 
 import azure.core.exceptions
@@ -13,6 +14,9 @@ from openai.types.create_embedding_response import (
 )
 from quart.datastructures import FileStorage
 
+from config import CONFIG_ANSWER_CACHE, CONFIG_INGESTION_QUEUE
+from core.answercache import SemanticAnswerCache
+from core.ingestionqueue import IngestionQueue
 from prepdocslib.embeddings import AzureOpenAIEmbeddingService
 
 from .mocks import MockClient, MockEmbeddingsClient
@@ -269,12 +273,60 @@ async def test_delete_uploaded(auth_client, monkeypatch, mock_data_lake_service_
 
     monkeypatch.setattr(DataLakeDirectoryClient, "delete_directory", mock_delete_directory)
 
+    answer_cache = SemanticAnswerCache()
+    auth_client.app.config[CONFIG_ANSWER_CACHE] = answer_cache
+
     response = await auth_client.post(
         "/delete_uploaded", headers={"Authorization": "Bearer test"}, json={"filename": "a's doc.txt"}
     )
     assert response.status_code == 200
+    assert answer_cache.generation == 1, "It should have invalidated cached answers that may cite the file"
     assert len(searched_filters) == 2, "It should have searched twice (with no results on second try)"
     assert searched_filters[0] == "sourcefile eq 'a''s doc.txt'"
     assert len(deleted_documents) == 1, "It should have only deleted the document solely owned by OID_X"
     assert deleted_documents[0]["id"] == "file-a_txt-7465737420646F63756D656E742E706466"
     assert len(deleted_directories) == 1, "It should have deleted the directory for the file"
+
+
+@pytest.mark.asyncio
+async def test_upload_file_queued(auth_client, monkeypatch, mock_data_lake_service_client):
+    async def mock_upload_file(self, *args, **kwargs):
+        return None
+
+    monkeypatch.setattr(DataLakeFileClient, "upload_data", mock_upload_file)
+
+    processed_files = []
+
+    async def process(job, start_stage):
+        await start_stage("parsing")
+        processed_files.append((job.user_oid, job.filename))
+
+    ingestion_queue = IngestionQueue(process)
+    ingestion_queue.start()
+    auth_client.app.config[CONFIG_INGESTION_QUEUE] = ingestion_queue
+    try:
+        response = await auth_client.post(
+            "/upload",
+            headers={"Authorization": "Bearer test"},
+            files={"file": FileStorage(BytesIO(b"foo;bar"), filename="a.txt")},
+        )
+        assert response.status_code == 202
+        job_id = (await response.get_json())["job_id"]
+
+        for _ in range(100):
+            response = await auth_client.get(f"/upload_status/{job_id}", headers={"Authorization": "Bearer test"})
+            assert response.status_code == 200
+            status = await response.get_json()
+            if status["status"] == "succeeded":
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        await ingestion_queue.close()
+
+    assert processed_files == [("OID_X", "a.txt")]
+    assert status["filename"] == "a.txt"
+    assert [stage["name"] for stage in status["stages"]] == ["parsing"]
+    assert "user_oid" not in status
+
+    response = await auth_client.get("/upload_status/missing", headers={"Authorization": "Bearer test"})
+    assert response.status_code == 404